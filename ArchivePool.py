@@ -0,0 +1,334 @@
+#!/usr/local/bin/python
+
+import os, json, time, hashlib, logging, threading
+from subprocess import Popen, PIPE
+from CephPool import *
+
+
+class ArchivePool(object):
+	"""
+	Backup target storing each snapshot as an 'rbd export-diff' stream file
+	in a local or NFS directory, one sub-directory per image:
+	<directory>/<image>/<snapshot>.diff plus a manifest.json describing the
+	chain (base, from-snap, to-snap, size, sha256).
+	Exposes the CephPool methods used by backup_vm and CephSnapshotsCleanup.
+	"""
+	isArchive = True
+	bufferSize = 8 * 1024**2
+	# fsync every fsyncBytes written instead of only at the end
+	fsyncBytes = 256 * 1024**2
+
+	def __init__(self, directory, dryrun=True, datasetFilter=None):
+		self.name = directory
+		self.directory = directory
+		self.dryrun = dryrun
+		self.datasetFilter = datasetFilter
+		self.cephRbdArgs = []
+		self.maxCapacity = 0.8
+		self.bestEffortPolicy = "morerem"
+		self._lock = threading.RLock()
+		if not os.path.isdir(directory):
+			raise CephError(self, 'Archive directory %s does not exist' % directory)
+		stats = os.statvfs(directory)
+		self.__used = (stats.f_blocks - stats.f_bfree) * stats.f_frsize // 1024
+		self.__available = stats.f_bavail * stats.f_frsize // 1024
+		self.refreshDatasets()
+
+
+	def refreshDatasets(self):
+		logging.info("Getting archives information in %s" % (self.directory))
+		datasets = DatasetRegistry()
+		with self._lock:
+			for image in os.listdir(self.directory):
+				if not os.path.isdir(os.path.join(self.directory, image)) or not self.acceptDataset(image):
+					continue
+				datasets.add(ArchiveDataset(image, self, self.dryrun))
+			self.datasets = datasets
+
+
+	def refreshDataset(self, name):
+		with self._lock:
+			dataset = self.getDataset(name)
+			if dataset != None:
+				self.datasets.discard(dataset)
+			if not os.path.isdir(os.path.join(self.directory, name)):
+				return None
+			dataset = ArchiveDataset(name, self, self.dryrun)
+			self.datasets.add(dataset)
+		return dataset
+
+
+	def invalidate(self, name=None):
+		if name == None:
+			self.refreshDatasets()
+		else:
+			self.refreshDataset(name)
+
+
+	def acceptDataset(self, name):
+		if self.datasetFilter == None:
+			return True
+		if callable(self.datasetFilter):
+			return self.datasetFilter(name)
+		return name in self.datasetFilter
+
+
+	def getDataset(self, name):
+		return self.datasets.get(name)
+
+
+	def getDatasetOrCreate(self, name):
+		with self._lock:
+			dataset = self.getDataset(name)
+			if dataset == None:
+				path = os.path.join(self.directory, name)
+				logging.info("Create archive directory %s" % path)
+				if not self.dryrun and not os.path.isdir(path):
+					os.makedirs(path)
+				dataset = ArchiveDataset(name, self, self.dryrun)
+				self.datasets.add(dataset)
+		return dataset
+
+
+	getDatasetOrEmpty = getDatasetOrCreate
+
+
+	def invalidateClusterStats(self):
+		# statvfs is read on every call
+		pass
+
+
+	def close(self):
+		# plain files, no cluster connection to release
+		pass
+
+
+	def getUsed(self):
+		if self.dryrun:
+			return self.__used
+		stats = os.statvfs(self.directory)
+		return (stats.f_blocks - stats.f_bfree) * stats.f_frsize // 1024
+
+
+	def setUsed(self, value):
+		self.__used = value
+
+
+	used = property(getUsed, setUsed)
+
+	def getAvailable(self):
+		if self.dryrun:
+			return self.__available
+		stats = os.statvfs(self.directory)
+		return stats.f_bavail * stats.f_frsize // 1024
+
+
+	def setAvailable(self, value):
+		self.__available = value
+
+
+	available = property(getAvailable, setAvailable)
+
+	def getCapacity(self):
+		return float(self.used) / (self.used + self.available)
+
+
+	capacity = property(getCapacity)
+
+
+class ArchiveDataset(Dataset):
+	"""Archived diff streams of one image, loaded from its manifest."""
+
+	def __init__(self, name, pool, dryrun=True):
+		Dataset.__init__(self, name, pool, dryrun, False)
+		self.path = os.path.join(pool.directory, name)
+		self.manifestPath = os.path.join(self.path, 'manifest.json')
+		self.entries = dict()
+		try:
+			with open(self.manifestPath) as f:
+				for entry in json.load(f)['snapshots']:
+					self.entries[entry['snapshot']] = entry
+		except IOError:
+			pass
+		for entry in self.entries.values():
+			snapshot = ArchiveSnapshot(None, entry['snapshot'], self, self.dryrun)
+			snapshot.used = entry['size']
+			self.snapshots.append(snapshot)
+
+
+	def addSnapshot(self, name, id=None, used=0):
+		snapshot = self.getSnapshot(name)
+		if snapshot == None:
+			snapshot = ArchiveSnapshot(id, name, self, self.dryrun)
+			snapshot.used = used
+			self.snapshots.append(snapshot)
+		return snapshot
+
+
+	def getFile(self, name):
+		return os.path.join(self.path, name + '.diff')
+
+
+	def getChain(self, name):
+		"""Entries to apply in order (full first) to restore snapshot name."""
+		chain = []
+		entry = self.entries.get(name)
+		while entry != None:
+			chain.insert(0, entry)
+			if entry['from'] == None:
+				return chain
+			entry = self.entries.get(entry['from'])
+		raise CephError(self.pool, "Broken archive chain for %s@%s" % (self.name, name))
+
+
+	def saveManifest(self):
+		tmp = self.manifestPath + '.tmp'
+		with open(tmp, 'w') as f:
+			json.dump({ 'image': self.name, 'snapshots': sorted(self.entries.values(), key=lambda entry: entry['snapshot']) }, f, indent=1)
+			f.flush()
+			os.fsync(f.fileno())
+		os.rename(tmp, self.manifestPath)
+		self._fsyncDirectory()
+
+
+	def _fsyncDirectory(self):
+		fd = os.open(self.path, os.O_RDONLY)
+		try:
+			os.fsync(fd)
+		finally:
+			os.close(fd)
+
+
+	def importExportDiff(self, cmd, localsnapshot, incrementalSnap=None):
+		"""Write the output of cmd (rbd export-diff ... -) as the archive of localsnapshot."""
+		name = localsnapshot.name
+		if name in self.entries:
+			return 17, "snapshot '%s' already exists" % name
+		fromName = incrementalSnap.name if incrementalSnap != None else None
+		if fromName != None and fromName not in self.entries:
+			return 2, "start snapshot '%s' does not exist in the archive" % fromName
+
+		path = self.getFile(name)
+		tmp = path + '.part'
+		stats = TransferStats()
+		start = time.time()
+		checksum = hashlib.sha256()
+		throttle = localsnapshot.dataset.getThrottle()
+		p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+		errors = []
+		drain = threading.Thread(target=lambda: errors.append(p.stderr.read()))
+		drain.daemon = True
+		drain.start()
+		try:
+			src = p.stdout.fileno()
+			with open(tmp, 'wb', ArchivePool.bufferSize) as f:
+				synced = 0
+				while True:
+					data = os.read(src, ArchivePool.bufferSize)
+					if not data:
+						break
+					checksum.update(data)
+					f.write(data)
+					stats.bytes += len(data)
+					if throttle != None:
+						throttle.consume(len(data))
+					if stats.bytes - synced >= ArchivePool.fsyncBytes:
+						f.flush()
+						os.fsync(f.fileno())
+						synced = stats.bytes
+				f.flush()
+				os.fsync(f.fileno())
+		finally:
+			p.stdout.close()
+			p.wait()
+			drain.join()
+		stderr = ''.join(errors)
+		if p.returncode:
+			os.remove(tmp)
+			return p.returncode, stderr
+		os.rename(tmp, path)
+
+		base = name
+		if fromName != None:
+			base = self.entries[fromName]['base']
+		self.entries[name] = { 'snapshot': name, 'from': fromName, 'base': base, 'file': os.path.basename(path),
+			'size': stats.bytes, 'sha256': checksum.hexdigest(), 'created': int(time.time()) }
+		self.saveManifest()
+		stats.seconds = time.time() - start
+		localsnapshot.dataset.lastTransfer = stats
+		self.addSnapshot(name, used=stats.bytes)
+		return 0, stderr
+
+
+	def removeArchive(self, name):
+		"""
+		Remove the archive of snapshot name. Diffs based on it are merged with
+		it first ('rbd merge-diff') so that their chain stays restorable.
+		Removing a base (full stream), as the retention does with the oldest
+		snapshot of each rotation, rewrites a whole full stream: about the
+		allocated size of the image is read and written again.
+		"""
+		entry = self.entries[name]
+		for child in [e for e in self.entries.values() if e['from'] == name]:
+			if entry['from'] == None:
+				logging.info("Rewriting %s@%s as a full stream (%d bytes of base)" % (self.name, child['snapshot'], entry['size']))
+			childPath = os.path.join(self.path, child['file'])
+			merged = childPath + '.merge'
+			cmd = ['rbd', 'merge-diff', os.path.join(self.path, entry['file']), childPath, merged]
+			logging.debug(" ".join(cmd))
+			p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+			stdout, stderr = p.communicate()
+			if p.returncode:
+				if os.path.exists(merged):
+					os.remove(merged)
+				raise CephError(self.pool, "merge-diff failed for %s@%s - %s" % (self.name, child['snapshot'], stderr))
+			checksum = hashlib.sha256()
+			with open(merged, 'rb') as f:
+				for data in iter(lambda: f.read(ArchivePool.bufferSize), ''):
+					checksum.update(data)
+				os.fsync(f.fileno())
+			os.rename(merged, childPath)
+			child['from'] = entry['from']
+			child['size'] = os.path.getsize(childPath)
+			child['sha256'] = checksum.hexdigest()
+			if entry['from'] == None:
+				# the child became a full stream: it is the base of its descendants
+				self._rebase(child['snapshot'], child['snapshot'])
+		del self.entries[name]
+		self.saveManifest()
+		os.remove(os.path.join(self.path, entry['file']))
+
+
+	def _rebase(self, name, base):
+		self.entries[name]['base'] = base
+		for child in self.entries.values():
+			if child['from'] == name:
+				self._rebase(child['snapshot'], base)
+
+
+class ArchiveSnapshot(Snapshot):
+	__slots__ = ()
+
+	def remove(self):
+		if self.dryrun:
+			logging.info("ArchiveDataset.removeArchive("+self.name+")")
+		else:
+			self.dataset.removeArchive(self.name)
+
+		logging.info("Archive '%s/%s' has been destroyed" % (self.dataset.name, self.name))
+		self.dataset.snapshots.remove(self)
+
+
+	def destroy(self):
+		try:
+			self.remove()
+			return True
+		except (CephError, OSError), e:
+			logging.error("Archive '%s/%s' failed to be destroyed: %s" % (self.dataset.name, self.name, e))
+			return False
+
+
+	def getTags(self):
+		return set()
+
+	tags = property(getTags)
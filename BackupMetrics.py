@@ -0,0 +1,151 @@
+#!/usr/local/bin/python
+
+import os, re, time, threading, logging
+
+
+def escapeLabel(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def unescapeLabel(value):
+	return re.sub(r'\\(.)', lambda match: '\n' if match.group(1) == 'n' else match.group(1), value)
+
+
+class BackupMetrics(object):
+	"""
+	Metrics of a run written at its end in the Prometheus node_exporter
+	textfile collector format. The file is replaced atomically (temporary
+	file in the same directory, fsync, rename). Last success timestamps of
+	images not backed up by this run are carried over from the former file.
+	Disabled while textfile is None.
+	"""
+	textfile = None
+
+	# (name, type, help) in output order
+	definitions = [
+		('cephbackup_run_timestamp_seconds', 'gauge', 'Start time of the last run.'),
+		('cephbackup_run_duration_seconds', 'gauge', 'Duration of the last run.'),
+		('cephbackup_backup_success', 'gauge', '1 if the last backup of the image succeeded.'),
+		('cephbackup_last_success_timestamp_seconds', 'gauge', 'End time of the last successful backup of the image.'),
+		('cephbackup_transfer_bytes', 'gauge', 'Bytes sent by the last transfer of the image, when measured (relay, compression, librbd or archive).'),
+		('cephbackup_transfer_duration_seconds', 'gauge', 'Duration of the last transfer of the image.'),
+		('cephbackup_transfer_compression_ratio', 'gauge', 'Uncompressed to compressed bytes of the last transfer of the image, when compressed.'),
+		('cephbackup_vm_pause_duration_seconds', 'gauge', 'Time the VM was paused for the snapshots of its disks.'),
+		('cephbackup_snapshots', 'gauge', 'Snapshots of the backup image before and after the retention cleanup.'),
+		('cephbackup_pool_used_bytes', 'gauge', 'Used bytes of the pool cluster.'),
+		('cephbackup_pool_available_bytes', 'gauge', 'Available bytes of the pool cluster.'),
+		('cephbackup_pool_capacity_ratio', 'gauge', 'Used fraction of the pool cluster.'),
+	]
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.started = time.time()
+		# name -> { labels tuple: value }
+		self.samples = dict()
+
+
+	def _set(self, name, labels, value):
+		if BackupMetrics.textfile == None or value == None:
+			return
+		with self._lock:
+			self.samples.setdefault(name, dict())[tuple(labels)] = value
+
+
+	def recordTransfer(self, image, bytes, seconds, ratio=None):
+		self._set('cephbackup_transfer_bytes', [('image', image)], bytes)
+		self._set('cephbackup_transfer_duration_seconds', [('image', image)], seconds)
+		self._set('cephbackup_transfer_compression_ratio', [('image', image)], ratio)
+
+
+	def recordPause(self, vm, seconds):
+		self._set('cephbackup_vm_pause_duration_seconds', [('vm', vm)], seconds)
+
+
+	def recordCleanup(self, image, before, after):
+		self._set('cephbackup_snapshots', [('image', image), ('stage', 'before_cleanup')], before)
+		self._set('cephbackup_snapshots', [('image', image), ('stage', 'after_cleanup')], after)
+
+
+	def recordResult(self, image, success):
+		self._set('cephbackup_backup_success', [('image', image)], 1 if success else 0)
+		if success:
+			self._set('cephbackup_last_success_timestamp_seconds', [('image', image)], time.time())
+
+
+	def recordPool(self, role, pool):
+		"""Capacity of pool (CephPool from its cluster stats, or ArchivePool)."""
+		if BackupMetrics.textfile == None or pool == None:
+			return
+		labels = [('pool', pool.name), ('role', role)]
+		try:
+			used = pool.used
+			available = pool.available
+		except Exception, e:
+			logging.warning("Cannot read capacity of pool %s: %s" % (pool.name, e))
+			return
+		self._set('cephbackup_pool_used_bytes', labels, used * 1024)
+		self._set('cephbackup_pool_available_bytes', labels, available * 1024)
+		if used + available > 0:
+			self._set('cephbackup_pool_capacity_ratio', labels, float(used) / (used + available))
+
+
+	def _loadLastSuccess(self):
+		"""Last success timestamps found in the former textfile."""
+		pattern = re.compile(r'^cephbackup_last_success_timestamp_seconds\{image="((?:[^"\\]|\\.)*)"\} (\S+)$')
+		timestamps = dict()
+		try:
+			with open(BackupMetrics.textfile) as f:
+				for line in f:
+					match = pattern.match(line.strip())
+					if match:
+						timestamps[unescapeLabel(match.group(1))] = float(match.group(2))
+		except (IOError, ValueError):
+			pass
+		return timestamps
+
+
+	def format(self):
+		self._set('cephbackup_run_timestamp_seconds', [], self.started)
+		self._set('cephbackup_run_duration_seconds', [], time.time() - self.started)
+		for (image, timestamp) in self._loadLastSuccess().items():
+			with self._lock:
+				current = self.samples.setdefault('cephbackup_last_success_timestamp_seconds', dict())
+				current.setdefault((('image', image),), timestamp)
+		lines = []
+		with self._lock:
+			for (name, kind, help) in BackupMetrics.definitions:
+				samples = self.samples.get(name)
+				if not samples:
+					continue
+				lines.append("# HELP %s %s" % (name, help))
+				lines.append("# TYPE %s %s" % (name, kind))
+				for labels in sorted(samples.keys()):
+					text = ','.join(['%s="%s"' % (key, escapeLabel(value)) for (key, value) in labels])
+					lines.append("%s%s %s" % (name, '{%s}' % text if text else '', repr(float(samples[labels]))))
+		return '\n'.join(lines) + '\n'
+
+
+	def write(self):
+		if BackupMetrics.textfile == None:
+			return
+		directory = os.path.dirname(os.path.abspath(BackupMetrics.textfile))
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		# the collector only reads *.prom files: the temporary file is ignored
+		tmp = "%s.%d.tmp" % (BackupMetrics.textfile, os.getpid())
+		try:
+			with open(tmp, 'w') as f:
+				f.write(self.format())
+				f.flush()
+				os.fsync(f.fileno())
+			os.chmod(tmp, 0644)
+			os.rename(tmp, BackupMetrics.textfile)
+		except (IOError, OSError), e:
+			logging.error("Cannot write metrics to %s: %s" % (BackupMetrics.textfile, e))
+			if os.path.exists(tmp):
+				os.remove(tmp)
+			return
+		logging.info("Metrics written to %s" % BackupMetrics.textfile)
+
+
+metrics = BackupMetrics()
@@ -0,0 +1,122 @@
+#!/usr/local/bin/python
+
+import logging, threading, time, sys
+from Queue import Queue, Empty
+
+
+class _NoLimit(object):
+	"""Context manager used when a resource has no concurrency cap."""
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		return False
+
+
+def _semaphore(count):
+	if count == None or count <= 0:
+		return _NoLimit()
+	return threading.BoundedSemaphore(count)
+
+
+class ConcurrencyLimits(object):
+	"""
+	Caps shared by all backup workers.
+	sourceReads: concurrent transfers reading from the source cluster
+	backupWrites: concurrent transfers/cleanups writing to the backup cluster
+	xapiPauses: concurrent paused VMs
+	A value of 0 or None means unlimited.
+	"""
+
+	def __init__(self, sourceReads=None, backupWrites=None, xapiPauses=None):
+		self.sourceReads = _semaphore(sourceReads)
+		self.backupWrites = _semaphore(backupWrites)
+		self.xapiPauses = _semaphore(xapiPauses)
+		# the XenAPI session shares one xmlrpc transport: serialize the calls
+		self.xapiLock = threading.RLock()
+
+
+class BackupResult(object):
+
+	def __init__(self, name):
+		self.name = name
+		self.success = None
+		self.error = None
+		self.started = None
+		self.ended = None
+
+	def getDuration(self):
+		if self.started == None or self.ended == None:
+			return None
+		return self.ended - self.started
+
+	duration = property(getDuration)
+
+
+class BackupScheduler(object):
+	"""
+	Run one job per image on a pool of worker threads.
+	Each job is run as a whole by a single worker, so the steps of one image
+	(snapshot, transfer, cleanup) keep their order. A failing job is recorded
+	in its BackupResult and does not stop the other ones.
+	"""
+
+	def __init__(self, workers=1, limits=None):
+		self.workers = max(1, int(workers))
+		self.limits = limits if limits != None else ConcurrencyLimits()
+		self._jobs = []
+		self.results = []
+
+	def submit(self, name, job, *args, **kwargs):
+		self._jobs.append((name, job, args, kwargs))
+
+	def run(self):
+		queue = Queue()
+		self.results = []
+		for (name, job, args, kwargs) in self._jobs:
+			result = BackupResult(name)
+			self.results.append(result)
+			queue.put((result, job, args, kwargs))
+		self._jobs = []
+
+		threads = []
+		for i in range(min(self.workers, len(self.results))):
+			thread = threading.Thread(target=self._worker, args=(queue,), name="backup-%d" % i)
+			thread.daemon = True
+			thread.start()
+			threads.append(thread)
+		for thread in threads:
+			# join with timeout so the main thread still receives signals
+			while thread.is_alive():
+				thread.join(1)
+		return self.results
+
+	def _worker(self, queue):
+		while True:
+			try:
+				(result, job, args, kwargs) = queue.get_nowait()
+			except Empty:
+				return
+			result.started = time.time()
+			try:
+				ret = job(*args, **kwargs)
+				result.success = ret != False
+			except (Exception, SystemExit), e:
+				logging.exception("Backup of %s failed" % result.name)
+				result.success = False
+				result.error = e
+			result.ended = time.time()
+
+	def getFailures(self):
+		return [result for result in self.results if not result.success]
+
+	failures = property(getFailures)
+
+	def logSummary(self):
+		for result in self.results:
+			if result.success:
+				logging.info("Backup of %s succeeded in %.1fs" % (result.name, result.duration))
+			else:
+				logging.error("Backup of %s failed in %.1fs: %s" % (result.name, result.duration, result.error))
+		logging.info("%d image(s) backed up, %d failure(s)" % (len(self.results) - len(self.failures), len(self.failures)))
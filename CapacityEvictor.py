@@ -0,0 +1,93 @@
+#!/usr/local/bin/python
+
+import logging
+from RetentionPlanner import *
+from SnapshotRemover import *
+
+
+class EvictionReport(object):
+
+	def __init__(self, capacity, maxCapacity):
+		self.capacity = capacity
+		self.maxCapacity = maxCapacity
+		# [(snapshot, estimated bytes)] in eviction order
+		self.evicted = []
+		self.projectedCapacity = capacity
+		self.failures = []
+
+	def getFreedBytes(self):
+		return sum([estimate for (snapshot, estimate) in self.evicted])
+
+	freedBytes = property(getFreedBytes)
+
+	def log(self, dryRun):
+		verb = "would free" if dryRun else "freed"
+		logging.info("Capacity %.1f%% above %.1f%%: evicting %d snapshot(s) %s about %.1f MiB, capacity %.1f%% after" % (
+			self.capacity * 100, self.maxCapacity * 100, len(self.evicted), verb, self.freedBytes / 1024.0**2, self.projectedCapacity * 100))
+		for (snapshot, estimate) in self.evicted:
+			logging.info("  %s@%s: %.1f MiB" % (snapshot.dataset.name, snapshot.name, estimate / 1024.0**2))
+
+
+class CapacityEvictor(object):
+	"""
+	Best effort eviction run after the retention cleanup: while the pool is
+	above pool.maxCapacity, snapshots kept by the policy are removed across
+	all images, except the mandatory ones (the two most recent snapshots of
+	each image, needed for increments) and the ones without creation time.
+	pool.bestEffortPolicy orders the candidates: 'morerem' removes first the
+	snapshots with the largest estimated reclaimed space (snapshot.used),
+	'oldest' the oldest ones. Ceph frees space asynchronously, so the
+	capacity is projected from the estimates instead of being read again.
+	"""
+
+	def __init__(self, pool, policy, dryRun=False):
+		self.pool = pool
+		self.planner = RetentionPlanner(policy)
+		self.dryRun = dryRun
+
+
+	def getCandidates(self, datasets):
+		candidates = []
+		for dataset in datasets:
+			keep = self.planner.plan(dataset.snapshots).keep
+			for tier in TIERS:
+				candidates.extend(keep[tier])
+		policy = getattr(self.pool, 'bestEffortPolicy', 'morerem')
+		if policy == 'oldest':
+			candidates.sort(key=lambda snapshot: snapshot.creation)
+		else:
+			# largest first, older first among equals
+			candidates.sort(key=lambda snapshot: (-snapshot.used, snapshot.creation))
+		return candidates
+
+
+	def plan(self, datasets=None):
+		"""EvictionReport of the snapshots to remove, empty when the pool is below maxCapacity."""
+		if datasets == None:
+			datasets = list(self.pool.datasets)
+		used = self.pool.used * 1024
+		total = used + self.pool.available * 1024
+		report = EvictionReport(self.pool.capacity, self.pool.maxCapacity)
+		if total <= 0 or report.capacity <= self.pool.maxCapacity:
+			return report
+		for snapshot in self.getCandidates(datasets):
+			if float(used) / total <= self.pool.maxCapacity:
+				break
+			report.evicted.append((snapshot, snapshot.used))
+			used -= snapshot.used
+		report.projectedCapacity = float(max(used, 0)) / total
+		if report.projectedCapacity > self.pool.maxCapacity:
+			logging.warning("Pool %s stays above %.1f%% after evicting every non mandatory snapshot" % (self.pool.name, self.pool.maxCapacity * 100))
+		return report
+
+
+	def evict(self, datasets=None):
+		report = self.plan(datasets)
+		if not report.evicted:
+			return report
+		report.log(self.dryRun)
+		if not self.dryRun:
+			remover = SnapshotRemover()
+			remover.remove([snapshot for (snapshot, estimate) in report.evicted])
+			report.failures = remover.failures
+		return report
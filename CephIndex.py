@@ -0,0 +1,157 @@
+#!/usr/local/bin/python
+
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+
+
+class DatasetRegistry(object):
+	"""
+	Datasets of a pool indexed by name.
+	Iterates over datasets like the former set, with O(1) lookup by name.
+	"""
+
+	def __init__(self, datasets=()):
+		self._byName = dict()
+		for dataset in datasets:
+			self.add(dataset)
+
+	def __iter__(self):
+		return iter(list(self._byName.values()))
+
+	def __len__(self):
+		return len(self._byName)
+
+	def __contains__(self, dataset):
+		return self._byName.get(dataset.name) is dataset
+
+	def add(self, dataset):
+		self._byName[dataset.name] = dataset
+
+	def discard(self, dataset):
+		if dataset in self:
+			del self._byName[dataset.name]
+
+	remove = discard
+
+	def get(self, name):
+		return self._byName.get(name)
+
+	def names(self):
+		return self._byName.keys()
+
+
+def _creationKey(snapshot):
+	# snapshots without parsable creation time sort as the oldest ones
+	if snapshot.creation == None:
+		return datetime.min
+	return snapshot.creation
+
+
+class SnapshotIndex(object):
+	"""
+	Snapshots of a dataset, kept sorted latest first on insert.
+	Supports the list operations used on Dataset.snapshots (iteration,
+	indexing, slicing, append, remove) plus O(1) lookup by name and by
+	creation time.
+	"""
+
+	def __init__(self, snapshots=()):
+		# ascending order internally, exposed in descending order
+		self._items = []
+		self._keys = []
+		self._byName = dict()
+		self._byCreation = dict()
+		for snapshot in snapshots:
+			self.append(snapshot)
+
+	def __len__(self):
+		return len(self._items)
+
+	def __iter__(self):
+		return reversed(self._items)
+
+	def __reversed__(self):
+		return iter(self._items)
+
+	def __getitem__(self, index):
+		if isinstance(index, slice):
+			return list(reversed(self._items))[index]
+		if index < 0:
+			index += len(self._items)
+		if index < 0 or index >= len(self._items):
+			raise IndexError("snapshot index out of range")
+		return self._items[len(self._items) - 1 - index]
+
+	def __contains__(self, snapshot):
+		return self._byName.get(snapshot.name) is snapshot
+
+	def append(self, snapshot):
+		key = _creationKey(snapshot)
+		# after existing equal keys: shows first in descending order
+		position = bisect_right(self._keys, key)
+		self._items.insert(position, snapshot)
+		self._keys.insert(position, key)
+		self._byName[snapshot.name] = snapshot
+		self._byCreation.setdefault(snapshot.creation, []).append(snapshot)
+
+	add = append
+
+	def extend(self, snapshots):
+		for snapshot in snapshots:
+			self.append(snapshot)
+
+	def remove(self, snapshot):
+		key = _creationKey(snapshot)
+		position = bisect_left(self._keys, key)
+		while position < len(self._items) and self._keys[position] == key:
+			if self._items[position] is snapshot:
+				del self._items[position]
+				del self._keys[position]
+				if self._byName.get(snapshot.name) is snapshot:
+					del self._byName[snapshot.name]
+				sameCreation = self._byCreation[snapshot.creation]
+				sameCreation.remove(snapshot)
+				if not sameCreation:
+					del self._byCreation[snapshot.creation]
+				return
+			position += 1
+		raise ValueError("snapshot %s not in index" % snapshot.name)
+
+	def get(self, name):
+		return self._byName.get(name)
+
+	def getByCreation(self, creation):
+		sameCreation = self._byCreation.get(creation)
+		if not sameCreation:
+			return None
+		return sameCreation[-1]
+
+	def creations(self):
+		return self._byCreation.viewkeys()
+
+
+def matchSnapshots(local, remote):
+	"""
+	Hash join of two snapshot collections on creation time.
+	Returns (local, remote) pairs of snapshots sharing a creation time,
+	latest first, in time linear to the number of snapshots.
+	"""
+	if isinstance(remote, SnapshotIndex):
+		lookup = remote.getByCreation
+	else:
+		byCreation = dict()
+		for snapshot in remote:
+			if snapshot.creation != None:
+				byCreation[snapshot.creation] = snapshot
+		lookup = byCreation.get
+	if not isinstance(local, SnapshotIndex):
+		local = sorted(local, key=_creationKey, reverse=True)
+
+	matches = []
+	for snapshot in local:
+		if snapshot.creation == None:
+			continue
+		remoteSnapshot = lookup(snapshot.creation)
+		if remoteSnapshot != None:
+			matches.append((snapshot, remoteSnapshot))
+	return matches
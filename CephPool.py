@@ -1,11 +1,22 @@
 #!/usr/local/bin/python
 
-import sys, getopt, re, fcntl, os
+import sys, getopt, re, fcntl, os, threading, time, pipes
 import logging
 from xml.dom.minidom import parse
 from subprocess import Popen, PIPE, check_output, CalledProcessError, STDOUT
 from datetime import datetime, timedelta, date
 from CephError import *
+from RbdDiffEngine import *
+from CephIndex import *
+from PipeRelay import *
+from StreamCompressor import *
+from RateLimiter import *
+from ExportCheckpoint import *
+from SnapshotRemover import *
+from ClusterStatsCache import *
+from RadosRegistry import *
+from SnapshotUsage import *
+from BackupMetrics import BackupMetrics
 try:
 	import rados
 	import rbd
@@ -15,32 +26,37 @@ except ImportError:
 
 
 class CephPool(object):
-	_clusterStats = None
-
-	def __init__(self, name, conf, user, keyring, dryrun=True):
+	# shared by all pools, keyed by their Rados client
+	_clusterStats = ClusterStatsCache()
+	# connections shared by the pools of a cluster
+	_registry = RadosRegistry()
+	# ArchivePool stores diff streams in a directory instead
+	isArchive = False
+
+	def __init__(self, name, conf, user, keyring, dryrun=True, datasetFilter=None):
 		self.name = name
 		self.dryrun = dryrun
+		# only images accepted by datasetFilter (list of names or predicate) are loaded
+		self.datasetFilter = datasetFilter
 		self.maxCapacity = 0.8
 		self.bestEffortPolicy = "morerem"
+		# SnapshotUsageCache: snapshot.used is the provisioned size without it
+		self.usageCache = None
 		self.cephRbdArgs = ['-c', conf, '--id', user]
 		if keyring != None:
 			self.cephRbdArgs.extend(['--keyring', keyring])
 		self._conf = conf
 		self._user=user
 		self._keyring=keyring
+		# datasets are shared between backup workers
+		self._lock = threading.RLock()
 		logging.info("Loading rbd config at %s" % (conf))
-		config = dict()
-		if (keyring != None):
-			config["keyring"] = keyring
-		self._client = rados.Rados(conffile=conf, rados_id=user, conf=config)
+		self.ioctx = None
 		try:
-			self._client.connect()
 			try:
-				self.ioctx = self._client.open_ioctx(self.name)
+				self._client, self.ioctx = CephPool._registry.openIoctx(conf, user, keyring, self.name, self)
 				self.rbd = rbd.RBD()
 			except rados.Error:
-				# shutdown cannot raise an exception
-				self._client.shutdown()
 				raise CephError(self, 'Cannot connect to Pool')
 
 			if self.isScrubActive():
@@ -51,26 +67,77 @@ class CephPool(object):
 				self.refreshDatasets()
 
 		except rados.Error, e:
+			self._disconnect_from_rados()
 			raise CephError(self, 'Pool Exception for %s: %s' % (self.name, e))
+		except CephError:
+			self._disconnect_from_rados()
+			raise
 
 
 	def __exit__(self, exc_type, exc_value, traceback):
 		self._disconnect_from_rados()
 
 
+	def close(self):
+		self._disconnect_from_rados()
+
+
 	def _disconnect_from_rados(self):
-		"""Terminate connection with the Ceph cluster."""
-		# closing an ioctx cannot raise an exception
-		self.ioctx.close()
-		self._client.shutdown()
+		"""
+		Close the rbd images of the datasets, then release this pool's ioctx:
+		the cluster connection closes with its last pool.
+		"""
+		with self._lock:
+			for dataset in getattr(self, 'datasets', ()):
+				dataset.close()
+		if self.ioctx != None:
+			self.ioctx = None
+			CephPool._registry.closeIoctx(self._conf, self._user, self._keyring, self.name, self)
 
 
 	def refreshDatasets(self):
-		self.datasets = set()
 		logging.info("Getting rbd volumes information for pool %s" % (self.name))
-		for image in self.rbd.list(self.ioctx):
-			dataset = Dataset(image, self, self.dryrun)
+		datasets = DatasetRegistry()
+		with self._lock:
+			for image in self.rbd.list(self.ioctx):
+				if not self.acceptDataset(image):
+					continue
+				dataset = Dataset(image, self, self.dryrun)
+				datasets.add(dataset)
+			self.datasets = datasets
+
+
+	def refreshDataset(self, name):
+		"""Reload a single dataset from the cluster, or drop it if the image is gone."""
+		with self._lock:
+			dataset = self.getDataset(name)
+			if dataset != None:
+				self.datasets.discard(dataset)
+			dataset = Dataset(name, self, self.dryrun)
+			try:
+				dataset.snapshots
+			except rbd.ImageNotFound:
+				return None
 			self.datasets.add(dataset)
+		return dataset
+
+
+	def invalidate(self, name=None):
+		"""Forget cached snapshots of one dataset, or rescan the whole pool."""
+		if name == None:
+			self.refreshDatasets()
+			return
+		dataset = self.getDataset(name)
+		if dataset != None:
+			dataset.refresh()
+
+
+	def acceptDataset(self, name):
+		if self.datasetFilter == None:
+			return True
+		if callable(self.datasetFilter):
+			return self.datasetFilter(name)
+		return name in self.datasetFilter
 
 
 	def isScrubActive(self):
@@ -92,13 +159,16 @@ class CephPool(object):
 		if self.dryrun:
 			return self.__used
 		else:
-			return self.getClusterStats().kb_used
+			return self.getClusterStats()["kb_used"]
 
 
-	def getClusterStats(self):
-		if CephPool._clusterStats == None or self.dryrun:
-			CephPool._clusterStats = self._client.get_cluster_stats()
-		return CephPool._clusterStats
+	def getClusterStats(self, refresh=False):
+		return CephPool._clusterStats.get(self._client, refresh)
+
+
+	def invalidateClusterStats(self):
+		"""Call after large writes or deletes: next capacity check reads fresh stats."""
+		CephPool._clusterStats.invalidate(self._client)
 
 
 	def setUsed(self, value):
@@ -111,7 +181,7 @@ class CephPool(object):
 		if self.dryrun:
 			return self.__available
 		else:
-			return self.getClusterStats().kb_avail
+			return self.getClusterStats()["kb_avail"]
 
 
 	def setAvailable(self, value):
@@ -127,28 +197,31 @@ class CephPool(object):
 	capacity = property(getCapacity)
 
 	def getDataset(self, name):
-		for dataset in self.datasets:
-			if dataset.name == name:
-				return dataset
-		return None
+		return self.datasets.get(name)
 
 
 	def getDatasetOrEmpty(self, name):
-		dataset = self.getDataset(name)
-		if dataset == None:
-			dataset = Dataset(name, self, self.dryrun, False)
-			self.datasets.add(dataset)
+		with self._lock:
+			dataset = self.getDataset(name)
+			if dataset == None:
+				dataset = Dataset(name, self, self.dryrun, False)
+				self.datasets.add(dataset)
 		return dataset
 
 
 	def getDatasetOrCreate(self, name):
-		dataset = self.getDataset(name)
-		if dataset == None:
-			logging.info("Create Image %s on pool %s" % (name, self.name))
-			size = 1 # 4 * 1024**2  # 4 MiB
-			self.rbd.create(self.ioctx, name, size)
-			dataset = Dataset(name, self, self.dryrun)
-			self.datasets.add(dataset)
+		with self._lock:
+			dataset = self.getDataset(name)
+			if dataset == None:
+				logging.info("Create Image %s on pool %s" % (name, self.name))
+				size = 1 # 4 * 1024**2  # 4 MiB
+				try:
+					self.rbd.create(self.ioctx, name, size)
+				except rbd.ImageExists:
+					# filtered out when the pool was loaded
+					logging.debug("Image %s already exists on pool %s" % (name, self.name))
+				dataset = Dataset(name, self, self.dryrun)
+				self.datasets.add(dataset)
 		return dataset
 
 
@@ -165,47 +238,134 @@ class CephPool(object):
 class Dataset(object):
 	snapshotPattern = 'backup%Y-%m-%dT%H.%M.%S'
 	today = datetime.now()
+	# 'cli': rbd export-diff | rbd import-diff, 'librbd': in-process RbdDiffEngine
+	transferEngine = 'cli'
+	# relay the cli pipe through PipeRelay to measure throughput
+	transferRelay = False
+	# None or 'zstd', 'lz4', 'gzip': compress the cli pipe with StreamCompressor
+	compression = None
+	compressionLevel = None
+	compressionThreads = None
+	# command prefix running decompression and import-diff near the backup cluster, ie: ['ssh', 'gateway']
+	importPrefix = []
+	# RateLimiter.Throttle shared by all transfers
+	throttle = Throttle()
+	# full sends in chunks with an ExportCheckpoint in checkpointDir (librbd)
+	resumableFull = False
+	checkpointDir = '/var/lib/cephbackup/checkpoints'
+	checkpointChunkSize = 1024**3
+	# full sends skip unallocated extents and blocks of zeros (librbd)
+	sparseFull = False
 
 	def __init__(self, name, pool, dryrun=True, exists=True):
 		self.name = name
 		self.pool = pool
 		self.dryrun = dryrun
-		self.snapshots = []
 		self.__maxRetention = None
 		self.__retentionPolicy = None
 		self._exists = exists
 		self.userrefs = None
-		self._rbdImage = None
-		if exists:
-			self._rbdImage = rbd.Image(self.pool.ioctx, name)
-			self.stats = self._rbdImage.stat()
-			if name.count('/') > 0:
-				self.parent = pool.getDataset(name.rsplit('/', 1)[0])
-			else:
-				self.parent = None
+		# image handle, stats and snapshots are loaded on first access
+		self.__image = None
+		self.__stats = None
+		self.__snapshots = None
+		# TransferStats of the last exportSnapshot, None when not measured
+		self.lastTransfer = None
+		if not exists:
+			self.__snapshots = SnapshotIndex()
+
+
+	def __del__(self):
+		"""Delete Dataset."""
+		self.close()
+
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		"""Close Dataset."""
+		self.close()
+
+
+	def close(self):
+		if self.__image != None:
+			self.__image.close()
+			self.__image = None
+
+
+	def getRbdImage(self):
+		if self.__image == None and self._exists:
+			self.__image = rbd.Image(self.pool.ioctx, self.name)
+		return self.__image
+
+	_rbdImage = property(getRbdImage)
+
+	def getStats(self):
+		if self.__stats == None and self._exists:
+			self.__stats = self._rbdImage.stat()
+		return self.__stats
+
+	stats = property(getStats)
+
+	def getParent(self):
+		if self.name.count('/') > 0:
+			return self.pool.getDataset(self.name.rsplit('/', 1)[0])
+		return None
+
+	parent = property(getParent)
+
+	def getSnapshots(self):
+		if self.__snapshots == None:
+			self.__snapshots = SnapshotIndex()
 			for snap in self._rbdImage.list_snaps():
 				snapshot = Snapshot(snap['id'], snap['name'], self, self.dryrun)
 				snapshot.used = snap['size']
-				self.snapshots.append(snapshot)
-			self.sortSnaps()
+				self.__snapshots.append(snapshot)
+			if getattr(self.pool, 'usageCache', None) != None:
+				try:
+					self.pool.usageCache.apply(self, self.__snapshots)
+				except rbd.Error, e:
+					logging.warning("Cannot compute snapshot usage of %s: %s" % (self.name, e))
 			#for s in self.snapshots:
 			#	logging.debug("%s/%s (%s)" % (self.name, s.name, s.creation))
+		return self.__snapshots
 
 
-	def __del__(self):
-		"""Delete Dataset."""
-		if self._exists and self._rbdImage != None:
-			self._rbdImage.close()
+	def setSnapshots(self, value):
+		if not isinstance(value, SnapshotIndex):
+			value = SnapshotIndex(value)
+		self.__snapshots = value
 
 
-	def __exit__(self, exc_type, exc_value, traceback):
-		"""Close Dataset."""
-		if self._exists and self._rbdImage != None:
-			self._rbdImage.close()
+	snapshots = property(getSnapshots, setSnapshots)
+
+
+	def getReferenced(self):
+		"""Bytes held by the snapshots (exclusive bytes with a SnapshotUsageCache)."""
+		return sum([snapshot.used for snapshot in self.snapshots])
+
+
+	referenced = property(getReferenced)
+
+	def refresh(self):
+		"""Drop cached stats and snapshots, they are reloaded on next access."""
+		if self._exists:
+			self.__stats = None
+			self.__snapshots = None
+
+
+	def addSnapshot(self, name, id=None, used=0):
+		"""Register a snapshot created outside of this object."""
+		snapshot = self.getSnapshot(name)
+		if snapshot == None:
+			snapshot = Snapshot(id, name, self, self.dryrun)
+			snapshot.used = used
+			self.snapshots.append(snapshot)
+		return snapshot
 
 
 	def sortSnaps(self):
-		self.snapshots = sorted(self.snapshots, key=lambda snapshot: snapshot.creation, reverse=True) # sorted latest first
+		# SnapshotIndex keeps snapshots sorted latest first on insert
+		if not isinstance(self.snapshots, SnapshotIndex):
+			self.snapshots = SnapshotIndex(self.snapshots)
 
 
 	def getRemovableSnapshots(self):
@@ -220,14 +380,7 @@ class Dataset(object):
 
 	def destroySnapshotsOutOfMaxRetention(self):
 		# Destroy snapshots out of maxRetention policy
-		for snapshot in self.snapshots[:]:
-			if snapshot.keep == False:
-				if self.dryrun:
-					logging.info("Image.remove_snap("+snapshot.name+")")
-				else:
-					self._rbdImage.remove_snap(snapshot.name)
-					logging.info("Snapshot '%s/%s@%s' has been destroyed" % (self.pool.name, self.name, snapshot.name))
-				self.snapshots.remove(snapshot)
+		SnapshotRemover().remove([snapshot for snapshot in self.snapshots[:] if snapshot.keep == False])
 
 
 	def createBackupSnapshot(self):
@@ -244,42 +397,39 @@ class Dataset(object):
 			logging.info("Snapshot '%s' has been created" % snapshotname)
 		snapshot = Snapshot(None, snapshotname, self, self.dryrun)
 		self.snapshots.append(snapshot)
-		self.sortSnaps()
 		return snapshot
 
 
+	def getMatchingSnapshots(self, remotesnapshots):
+		"""(local, remote) snapshot pairs sharing a creation time, latest first."""
+		return matchSnapshots(self.snapshots, remotesnapshots)
+
+
 	def getMostRecentMatchingSnapshot(self, remotesnapshots):
-		matchingSnap = None
-		for snapshot in self.snapshots[:]:
-			#if snapshot.isLastBackup():
-			#	return snapshot
-			#elif
-			if matchingSnap == None or matchingSnap.creation < snapshot.creation:
-				for remotesnapshot in remotesnapshots[:]:
-					if remotesnapshot.creation == snapshot.creation:
-						matchingSnap = snapshot
-		return matchingSnap
+		matches = self.getMatchingSnapshots(remotesnapshots)
+		if matches:
+			return matches[0][0]
+		return None
 
 
 	def getLastBackupSnapshot(self):
-		for snapshot in self.snapshots[:]:
-			if snapshot.isLastBackup():
-				return snapshot
+		if len(self.snapshots) >= 2:
+			return self.snapshots[1]
 		return None
 
 
 	def getCurrentBackupSnapshot(self):
-		for snapshot in self.snapshots[:]:
-			if snapshot.isCurrentBackup():
-				return snapshot
+		if len(self.snapshots) >= 1:
+			return self.snapshots[0]
 		return None
 
 
 	def getSnapshot(self, name):
-		for snapshot in self.snapshots[:]:
-			if snapshot.name == name:
-				return snapshot
-		return None
+		return self.snapshots.get(name)
+
+
+	def getSnapshotByCreation(self, creation):
+		return self.snapshots.getByCreation(creation)
 
 
 	def rollBackupNames(self):
@@ -312,10 +462,52 @@ class Dataset(object):
 		cmd2.extend(['-', rbd_path])
 
 		if self.dryrun:
-			logging.info(" ".join(cmd1) + ' | ' + " ".join(cmd2))
+			if remoteDataset.pool.isArchive:
+				logging.info(" ".join(cmd1) + ' > ' + remoteDataset.getFile(localsnapshot.name))
+			else:
+				logging.info(" ".join(cmd1) + ' | ' + " ".join(cmd2))
 			result = None
 			stderr = ''
+		elif remoteDataset.pool.isArchive:
+			result, stderr = remoteDataset.importExportDiff(cmd1, localsnapshot, incrementalSnap)
+			if result:
+				msg = "RBD diff archive failed - (ret=%(ret)s stderr=%(stderr)s)" % {'ret': result, 'stderr': stderr}
+				raise CephError(self.pool,msg)
+		elif incrementalSnap == None and Dataset.resumableFull:
+			engine = RbdDiffEngine(throttle=self.getThrottle(), sparse=Dataset.sparseFull)
+			checkpoint = ExportCheckpoint(Dataset.checkpointDir, self.pool.name, self.name, localsnapshot.name)
+			start = time.time()
+			result, stderr = engine.transferChunked(self, remoteDataset, localsnapshot, checkpoint, Dataset.checkpointChunkSize)
+			self.lastTransfer = TransferStats(engine.bytes, time.time() - start)
+			if result:
+				msg = "librbd chunked export failed - (ret=%(ret)s stderr=%(stderr)s)" % {'ret': result, 'stderr': stderr}
+				raise CephError(self.pool,msg)
+		elif Dataset.transferEngine == 'librbd' or (incrementalSnap == None and Dataset.sparseFull):
+			engine = RbdDiffEngine(throttle=self.getThrottle(), sparse=incrementalSnap == None and Dataset.sparseFull)
+			start = time.time()
+			result, stderr = engine.transfer(self, remoteDataset, localsnapshot, incrementalSnap)
+			self.lastTransfer = TransferStats(engine.bytes, time.time() - start)
+			if result:
+				msg = "librbd diff op failed - (ret=%(ret)s stderr=%(stderr)s)" % {'ret': result, 'stderr': stderr}
+				raise CephError(self.pool,msg)
+		elif Dataset.compression:
+			label = "%s@%s" % (self.name, localsnapshot.name)
+			compressor = StreamCompressor(Dataset.compression, Dataset.compressionLevel, Dataset.compressionThreads, label, self.getThrottle())
+			decompress = ' '.join([pipes.quote(arg) for arg in compressor.getDecompressCommand()])
+			cmd2 = shellCommand(Dataset.importPrefix, decompress + ' | ' + ' '.join([pipes.quote(arg) for arg in cmd2]))
+			result, stderr = self._relayed_execute(cmd1, cmd2, label, compressor)
+			if result:
+				msg = "RBD diff op failed - (ret=%(ret)s stderr=%(stderr)s)" % {'ret': result, 'stderr': stderr}
+				raise CephError(self.pool,msg)
+		elif Dataset.transferRelay or Dataset.throttle.active or BackupMetrics.textfile != None:
+			# the relay counts the bytes and time reported by the metrics
+			label = "%s@%s" % (self.name, localsnapshot.name)
+			result, stderr = self._relayed_execute(cmd1, cmd2, label, PipeRelay(label, self.getThrottle()))
+			if result:
+				msg = "RBD diff op failed - (ret=%(ret)s stderr=%(stderr)s)" % {'ret': result, 'stderr': stderr}
+				raise CephError(self.pool,msg)
 		else:
+			self.lastTransfer = None
 			result, stderr = self._piped_execute(cmd1, cmd2)
 			if result:
 				msg = "RBD diff op failed - (ret=%(ret)s stderr=%(stderr)s)" % {'ret': result, 'stderr': stderr}
@@ -339,14 +531,39 @@ class Dataset(object):
 				return self.exportSnapshot(remoteDataset, localsnapshot)
 		elif not result:
 			logging.info("Snapshot '%s' has been exported to %s" % (localsnapshot.name, self.name))
+			if self.lastTransfer != None:
+				logging.info("Transfer of %s@%s: %s" % (self.name, localsnapshot.name, self.lastTransfer))
 		else:
 			logging.error("Snapshot '%s' failed to be exported to %s" % (localsnapshot.name, self.name))
 
 		if not result:
-			remoteDataset.pool.refreshDatasets()
+			# import-diff created the snapshot: apply it instead of rescanning the pool
+			remoteDataset.addSnapshot(localsnapshot.name)
+			remoteDataset.pool.invalidateClusterStats()
 		return not result
 
 
+	def getPendingFullExport(self):
+		"""Snapshot whose resumable full export did not finish, or None."""
+		if not Dataset.resumableFull:
+			return None
+		name = ExportCheckpoint.pending(Dataset.checkpointDir, self.pool.name, self.name)
+		if name == None:
+			return None
+		snapshot = self.getSnapshot(name)
+		if snapshot == None:
+			logging.info("Snapshot '%s' of %s is gone, dropping its full export checkpoint" % (name, self.name))
+			if not self.dryrun:
+				ExportCheckpoint(Dataset.checkpointDir, self.pool.name, self.name, name).discard()
+		return snapshot
+
+
+	def getThrottle(self):
+		if not Dataset.throttle.active:
+			return None
+		return Dataset.throttle.forImage(self.name)
+
+
 	def _piped_execute(self, cmd1, cmd2):
 		"""Pipe output of cmd1 into cmd2."""
 		logging.debug("Piping cmd1='%s' into...", ' '.join(cmd1))
@@ -375,14 +592,91 @@ class Dataset(object):
 		return p2.returncode, stderr
 
 
+	def _relayed_execute(self, cmd1, cmd2, label, stage=None):
+		"""Pipe output of cmd1 into cmd2 through stage (a PipeRelay by default), stats go to self.lastTransfer."""
+		logging.debug("Relaying cmd1='%s' into...", ' '.join(cmd1))
+		logging.debug("cmd2='%s'", ' '.join(cmd2))
+
+		p1 = Popen(cmd1, stdout=PIPE, stderr=PIPE)
+		try:
+			p2 = Popen(cmd2, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+		except OSError:
+			p1.kill()
+			p1.wait()
+			raise
+
+		outputs = dict()
+		def drain(key, stream):
+			outputs[key] = stream.read()
+		drains = []
+		for (key, stream) in (('stderr1', p1.stderr), ('stdout2', p2.stdout), ('stderr2', p2.stderr)):
+			thread = threading.Thread(target=drain, args=(key, stream))
+			thread.daemon = True
+			thread.start()
+			drains.append(thread)
+
+		relay = stage if stage != None else PipeRelay(label)
+		try:
+			relay.run(p1.stdout.fileno(), p2.stdin.fileno())
+		except (OSError, IOError), e:
+			# import side died (EPIPE): its return code tells why
+			logging.error("Relay %s interrupted: %s" % (label, e))
+		finally:
+			p1.stdout.close()
+			p2.stdin.close()
+		p1.wait()
+		p2.wait()
+		for thread in drains:
+			thread.join()
+		self.lastTransfer = relay.stats
+
+		if p2.returncode:
+			return p2.returncode, outputs.get('stderr2', '')
+		return p1.returncode, outputs.get('stderr1', '')
+
+
 class Volume(Dataset):
 	pass
 
 
+def shellCommand(prefix, script):
+	"""
+	Command running script with sh through prefix. A remote shell prefix
+	(ssh) joins its arguments with spaces before the remote shell parses
+	them again: the script is then quoted once more to stay one argument.
+	"""
+	if len(prefix) == 0:
+		return ['sh', '-c', script]
+	return prefix + ['sh', '-c', pipes.quote(script)]
+
+
+def parseSnapshotCreation(name):
+	"""Creation time of a 'backup%Y-%m-%dT%H.%M.%S' snapshot name, None if it does not match."""
+	# fixed format fast path: slice the fields instead of strptime
+	if len(name) == 25 and name.startswith('backup') and name[10] == '-' and name[13] == '-' \
+			and name[16] == 'T' and name[19] == '.' and name[22] == '.':
+		try:
+			return datetime(int(name[6:10]), int(name[11:13]), int(name[14:16]),
+				int(name[17:19]), int(name[20:22]), int(name[23:25]))
+		except ValueError:
+			pass
+	match = Snapshot.namePattern.match(name)
+	if match == None:
+		return None
+	try:
+		return datetime(*[int(field) for field in match.groups()])
+	except ValueError:
+		return None
+
+
 class Snapshot(object):
 	snapshotPattern = "^backup\d{4}-\d{2}-\d{2}T\d{2}\.\d{2}\.\d{2}$"
+	namePattern = re.compile("^backup(\d{4})-(\d{2})-(\d{2})T(\d{2})\.(\d{2})\.(\d{2})$")
 	currentPattern = re.compile("^backup\d{4}-\d{2}-\d{2}T\d{2}\.\d{2}\.\d{2}C$")
 	lastPattern = re.compile("^backup\d{4}-\d{2}-\d{2}T\d{2}\.\d{2}\.\d{2}L$")
+	# no per instance __dict__: pools may hold hundreds of thousands of snapshots
+	__slots__ = ('id', 'name', 'dataset', 'dryrun', '_Snapshot__keep', '_Snapshot__keepTested', '_Snapshot__tags',
+		'creation', 'used', 'isCurrent', 'isLast', 'userrefs', '__weakref__')
 
 	def __init__(self, id, name, dataset, dryrun=True):
 		self.id = id
@@ -392,22 +686,20 @@ class Snapshot(object):
 		self.__keep = None
 		self.__keepTested = False
 		self.__tags = None
-		self.creation = None
 		self.used = 0
 		self.isCurrent = False
 		self.isLast = False
-		try:
-			snaptime = re.search("("+Snapshot.snapshotPattern+")", name).group(1)
-			self.creation = datetime.strptime(snaptime, Dataset.snapshotPattern )
-			#logging.debug("%s creation time %s" % (name, self.creation))
-		except AttributeError:
+		self.userrefs = 0
+		self.creation = parseSnapshotCreation(name)
+		if self.creation == None:
 			logging.info("Cannot determine %s creation time for pattern %s" % (name,Snapshot.snapshotPattern))
 
 
 	def __del__(self):
 		if self.dryrun:
-			self.dataset.pool.used -= self.used
-			self.dataset.pool.available += self.used
+			# pool figures are in KiB
+			self.dataset.pool.used -= self.used // 1024
+			self.dataset.pool.available += self.used // 1024
 
 
 	def isLastBackup(self):
@@ -449,16 +741,20 @@ class Snapshot(object):
 		return result == ''
 
 
+	def remove(self):
+		"""Remove the snapshot, errors are raised."""
+		if self.dryrun:
+			logging.info("Image.remove_snap("+self.name+")")
+		else:
+			self.dataset._rbdImage.remove_snap(self.name)
+
+		logging.info("Snapshot '%s' has been destroyed" % self.name)
+		self.dataset.snapshots.remove(self)
+
+
 	def destroy(self):
 		try:
-			if self.dryrun:
-				logging.info("Image.remove_snap("+self.name+")")
-				result = ''
-			else:
-				self.dataset._rbdImage.remove_snap(self.name)
-
-			logging.info("Snapshot '%s' has been destroyed" % self.name)
-			self.dataset.snapshots.remove(self)
+			self.remove()
 			return True
 		except rados.Error:
 			logging.error("Snapshot '%s' failed to be destroyed" % self.name)
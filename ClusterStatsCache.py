@@ -0,0 +1,35 @@
+#!/usr/local/bin/python
+
+import time, threading
+
+
+class ClusterStatsCache(object):
+	"""
+	get_cluster_stats() results cached per Rados client for 'ttl' seconds,
+	so source and backup clusters keep separate stats and capacity checks do
+	not go to the monitors on every call.
+	"""
+	ttl = 30
+
+	def __init__(self, ttl=None):
+		self.ttl = ttl if ttl != None else ClusterStatsCache.ttl
+		self._lock = threading.Lock()
+		# client -> (timestamp, stats)
+		self._entries = dict()
+
+	def get(self, client, refresh=False):
+		with self._lock:
+			entry = self._entries.get(client)
+			if not refresh and entry != None and time.time() - entry[0] < self.ttl:
+				return entry[1]
+		stats = client.get_cluster_stats()
+		with self._lock:
+			self._entries[client] = (time.time(), stats)
+		return stats
+
+	def invalidate(self, client=None):
+		with self._lock:
+			if client == None:
+				self._entries.clear()
+			else:
+				self._entries.pop(client, None)
@@ -0,0 +1,106 @@
+#!/usr/local/bin/python
+
+import os, json, logging
+
+
+class ExportCheckpoint(object):
+	"""
+	On-disk record of the chunks of a full export already written on the
+	backup image, so that a failed full send of a snapshot resumes where it
+	stopped. There is at most one checkpoint per source image: it is
+	discarded when the snapshot is finalized on the backup side, or replaced
+	when another snapshot is sent.
+	"""
+
+	def __init__(self, directory, pool, image, snapshot, size=None, chunkSize=None):
+		self.directory = directory
+		self.pool = pool
+		self.image = image
+		self.snapshot = snapshot
+		self.size = size
+		self.chunkSize = chunkSize
+		self.done = set()
+		# True once load found a checkpoint of this snapshot and layout
+		self.resumed = False
+		# whether the backup image was empty when the export started
+		self.fresh = False
+		self.path = ExportCheckpoint.getPath(directory, pool, image)
+
+
+	@staticmethod
+	def getPath(directory, pool, image):
+		return os.path.join(directory, "%s_%s.json" % (pool.replace('/', '_'), image.replace('/', '_')))
+
+
+	@staticmethod
+	def pending(directory, pool, image):
+		"""Name of the snapshot with an unfinished full export, or None."""
+		data = ExportCheckpoint._read(ExportCheckpoint.getPath(directory, pool, image))
+		if data == None:
+			return None
+		return data.get('snapshot')
+
+
+	@staticmethod
+	def _read(path):
+		try:
+			with open(path) as f:
+				return json.load(f)
+		except IOError:
+			return None
+		except ValueError:
+			logging.warning("Ignoring corrupted checkpoint %s" % path)
+			return None
+
+
+	def load(self, size, chunkSize):
+		"""Load completed chunks, unless the checkpoint was made for another snapshot or layout."""
+		self.size = size
+		self.chunkSize = chunkSize
+		self.done = set()
+		self.resumed = False
+		data = ExportCheckpoint._read(self.path)
+		if data == None:
+			return 0
+		if data.get('snapshot') != self.snapshot or data.get('size') != size or data.get('chunkSize') != chunkSize:
+			logging.info("Checkpoint %s does not match %s@%s, starting over" % (self.path, self.image, self.snapshot))
+			return 0
+		self.done = set(data.get('done', []))
+		# checkpoints without it: not fresh, zeros are always written
+		self.fresh = data.get('fresh', False)
+		self.resumed = True
+		logging.info("Resuming full export of %s@%s: %d/%d chunks already done" % (self.image, self.snapshot, len(self.done), self.getChunkCount()))
+		return len(self.done)
+
+
+	def getChunkCount(self):
+		if not self.chunkSize:
+			return 0
+		return (self.size + self.chunkSize - 1) // self.chunkSize
+
+
+	def isDone(self, offset):
+		return offset in self.done
+
+
+	def markDone(self, offset):
+		self.done.add(offset)
+		self.save()
+
+
+	def save(self):
+		if not os.path.exists(self.directory):
+			os.makedirs(self.directory)
+		tmp = self.path + '.tmp'
+		with open(tmp, 'w') as f:
+			json.dump({ 'pool': self.pool, 'image': self.image, 'snapshot': self.snapshot, 'size': self.size,
+				'chunkSize': self.chunkSize, 'fresh': self.fresh, 'done': sorted(self.done) }, f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.rename(tmp, self.path)
+
+
+	def discard(self):
+		if os.path.exists(self.path):
+			os.remove(self.path)
+			logging.debug("Checkpoint %s discarded" % self.path)
@@ -0,0 +1,171 @@
+#!/usr/local/bin/python
+
+import os, time, threading, logging, ctypes, ctypes.util
+import cProfile
+
+CLOCK_THREAD_CPUTIME_ID = 3 # linux/time.h
+
+
+class _Timespec(ctypes.Structure):
+	_fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+_clock_gettime = None
+try:
+	_clock_gettime = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).clock_gettime
+	_clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+except (OSError, AttributeError, TypeError):
+	_clock_gettime = None
+
+
+def threadCpuTime():
+	"""CPU seconds of the calling thread, process CPU time when unavailable."""
+	if _clock_gettime != None:
+		spec = _Timespec()
+		if _clock_gettime(CLOCK_THREAD_CPUTIME_ID, ctypes.byref(spec)) == 0:
+			return spec.tv_sec + spec.tv_nsec * 1e-9
+	return time.clock()
+
+
+class _NoPhase(object):
+	"""Context manager returned while profiling is disabled."""
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		return False
+
+_noPhase = _NoPhase()
+
+
+class PhaseTimes(object):
+
+	def __init__(self):
+		self.count = 0
+		self.wall = 0.0
+		self.cpu = 0.0
+		self.maxWall = 0.0
+
+	def add(self, wall, cpu):
+		self.count += 1
+		self.wall += wall
+		self.cpu += cpu
+		self.maxWall = max(self.maxWall, wall)
+
+
+class _Phase(object):
+
+	def __init__(self, profiler, image, name):
+		self.profiler = profiler
+		self.image = image
+		self.name = name
+		self.profile = None
+
+	def __enter__(self):
+		self.profile = self.profiler._startProfile(self.image, self.name)
+		self.cpu = threadCpuTime()
+		self.wall = time.time()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		wall = time.time() - self.wall
+		cpu = threadCpuTime() - self.cpu
+		if self.profile != None:
+			self.profile.disable()
+			self.profiler._local.profiling = False
+		self.profiler._record(self.image, self.name, wall, cpu)
+		return False
+
+
+class PhaseProfiler(object):
+	"""
+	Wall and CPU (of the calling thread, rbd commands excluded) time of the
+	phases of each image: with profiler.phase(image, 'transfer'): ...
+	With profileDir, each phase also runs under cProfile, one stats file per
+	image and phase (<image>.<phase>.prof) written by dump(). Nested phases
+	are timed but profiled as part of the outermost one.
+	Disabled, phase() returns a shared no-op context manager.
+	"""
+	enabled = False
+	profileDir = None
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._local = threading.local()
+		# (image, phase) -> PhaseTimes, in first seen order
+		self.times = dict()
+		self._order = []
+		self._profiles = dict()
+
+
+	def phase(self, image, name):
+		if not PhaseProfiler.enabled:
+			return _noPhase
+		return _Phase(self, image, name)
+
+
+	def _startProfile(self, image, name):
+		if PhaseProfiler.profileDir == None or getattr(self._local, 'profiling', False):
+			return None
+		with self._lock:
+			profile = self._profiles.get((image, name))
+			if profile == None:
+				profile = self._profiles[(image, name)] = cProfile.Profile()
+		self._local.profiling = True
+		profile.enable()
+		return profile
+
+
+	def _record(self, image, name, wall, cpu):
+		with self._lock:
+			times = self.times.get((image, name))
+			if times == None:
+				times = self.times[(image, name)] = PhaseTimes()
+				self._order.append((image, name))
+			times.add(wall, cpu)
+
+
+	def dump(self):
+		"""Write the cProfile stats of every profiled phase."""
+		if PhaseProfiler.profileDir == None:
+			return
+		if not os.path.isdir(PhaseProfiler.profileDir):
+			os.makedirs(PhaseProfiler.profileDir)
+		with self._lock:
+			for ((image, name), profile) in self._profiles.items():
+				path = os.path.join(PhaseProfiler.profileDir, "%s.%s.prof" % (str(image).replace('/', '_'), name))
+				profile.dump_stats(path)
+		logging.info("cProfile stats written in %s" % PhaseProfiler.profileDir)
+
+
+	def logSummary(self, top=10):
+		"""Log the totals of each phase and the slowest image phases."""
+		if not PhaseProfiler.enabled:
+			return
+		with self._lock:
+			order = list(self._order)
+			times = dict(self.times)
+		phases = []
+		totals = dict()
+		for (image, name) in order:
+			if name not in totals:
+				totals[name] = PhaseTimes()
+				phases.append(name)
+			total = totals[name]
+			total.count += times[(image, name)].count
+			total.wall += times[(image, name)].wall
+			total.cpu += times[(image, name)].cpu
+			total.maxWall = max(total.maxWall, times[(image, name)].maxWall)
+
+		logging.info("%-12s %6s %10s %10s %10s" % ('phase', 'count', 'wall (s)', 'max (s)', 'cpu (s)'))
+		for name in phases:
+			total = totals[name]
+			logging.info("%-12s %6d %10.3f %10.3f %10.3f" % (name, total.count, total.wall, total.maxWall, total.cpu))
+		slowest = sorted(order, key=lambda key: times[key].wall, reverse=True)[:top]
+		if slowest:
+			logging.info("Slowest image phases:")
+		for (image, name) in slowest:
+			logging.info("  %-40s %-12s %10.3f s wall %10.3f s cpu" % (image, name, times[(image, name)].wall, times[(image, name)].cpu))
+
+
+profiler = PhaseProfiler()
@@ -0,0 +1,125 @@
+#!/usr/local/bin/python
+
+import os, time, select, fcntl, errno, logging, ctypes, ctypes.util
+
+F_SETPIPE_SZ = 1031 # linux/fcntl.h
+SPLICE_F_MOVE = 1
+SPLICE_F_MORE = 4
+
+_libc = None
+try:
+	_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+	_libc.splice
+	_libc.splice.restype = ctypes.c_ssize_t
+	_libc.splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+except (OSError, AttributeError, TypeError):
+	_libc = None
+
+
+class TransferStats(object):
+
+	def __init__(self, bytes=0, seconds=0.0, compressedBytes=None):
+		self.bytes = bytes
+		self.seconds = seconds
+		# bytes after compression, None when the stream is not compressed
+		self.compressedBytes = compressedBytes
+
+	def getRate(self):
+		if self.seconds <= 0:
+			return 0.0
+		return self.bytes / self.seconds
+
+	rate = property(getRate)
+
+	def getRatio(self):
+		if self.compressedBytes == None or self.compressedBytes == 0:
+			return None
+		return float(self.bytes) / self.compressedBytes
+
+	ratio = property(getRatio)
+
+	def __str__(self):
+		result = "%d bytes in %.1fs (%.1f MiB/s)" % (self.bytes, self.seconds, self.rate / 1024**2)
+		if self.ratio != None:
+			result += ", compressed to %d bytes (ratio %.2f)" % (self.compressedBytes, self.ratio)
+		return result
+
+
+class PipeRelay(object):
+	"""
+	Copy a pipe into another one, counting bytes.
+	Uses splice(2) when the kernel supports it (no copy through userspace),
+	read/write with large buffers otherwise. Throughput is logged every
+	reportInterval seconds and a warning is logged when no data came for
+	stallTimeout seconds.
+	"""
+	pipeSize = 1024**2
+	chunkSize = 1024**2
+	reportInterval = 30
+	stallTimeout = 300
+
+	def __init__(self, label='', throttle=None):
+		self.label = label
+		# RateLimiter.ImageThrottle or None
+		self.throttle = throttle
+		self.stats = TransferStats()
+		self._splice = _libc != None
+
+
+	def setPipeSize(self, fd):
+		try:
+			fcntl.fcntl(fd, F_SETPIPE_SZ, self.pipeSize)
+		except IOError:
+			# not a pipe, not linux or over /proc/sys/fs/pipe-max-size
+			pass
+
+
+	def run(self, src, dst):
+		self.setPipeSize(src)
+		self.setPipeSize(dst)
+		start = time.time()
+		lastReport = start
+		lastData = start
+		stalled = False
+		while True:
+			ready, _, _ = select.select([src], [], [], min(self.reportInterval, self.stallTimeout))
+			now = time.time()
+			if not ready:
+				if now - lastData >= self.stallTimeout and not stalled:
+					logging.warning("Transfer %s stalled: no data for %ds" % (self.label, now - lastData))
+					stalled = True
+			else:
+				count = self._copy(src, dst)
+				if count == 0:
+					break
+				self.stats.bytes += count
+				if self.throttle != None:
+					self.throttle.consume(count)
+				lastData = time.time()
+				if stalled:
+					logging.info("Transfer %s resumed" % self.label)
+					stalled = False
+			if now - lastReport >= self.reportInterval:
+				self.stats.seconds = now - start
+				logging.info("Transfer %s: %s" % (self.label, self.stats))
+				lastReport = now
+		self.stats.seconds = time.time() - start
+		return self.stats
+
+
+	def _copy(self, src, dst):
+		if self._splice:
+			count = _libc.splice(src, None, dst, None, self.chunkSize, SPLICE_F_MOVE | SPLICE_F_MORE)
+			if count >= 0:
+				return count
+			err = ctypes.get_errno()
+			if err not in (errno.EINVAL, errno.ENOSYS):
+				raise OSError(err, os.strerror(err))
+			logging.debug("splice not supported (%s), falling back to read/write" % os.strerror(err))
+			self._splice = False
+		data = os.read(src, self.chunkSize)
+		view = memoryview(data)
+		while len(view):
+			written = os.write(dst, view)
+			view = view[written:]
+		return len(data)
@@ -0,0 +1,105 @@
+#!/usr/local/bin/python
+
+import logging, threading
+try:
+	import rados
+except ImportError:
+	rados = None
+
+
+class RadosRegistry(object):
+	"""
+	One connected rados.Rados client per (conf, user, keyring), shared by
+	every pool of that cluster, and one ioctx per pool name on it. Clients
+	and ioctxs are reference counted: the last release closes them.
+	Owners (pools) passed to openIoctx are closed by shutdown before the
+	ioctxs, so that their rbd images never outlive the cluster connection.
+	"""
+
+	def __init__(self):
+		self._lock = threading.RLock()
+		# key -> [client, refs]
+		self._clients = dict()
+		# (key, pool) -> [ioctx, refs]
+		self._ioctxs = dict()
+		# objects with a close() releasing their ioctx, in opening order
+		self._owners = []
+
+
+	def acquire(self, conf, user, keyring):
+		key = (conf, user, keyring)
+		with self._lock:
+			entry = self._clients.get(key)
+			if entry == None:
+				logging.info("Connecting to cluster %s as %s" % (conf, user))
+				config = dict()
+				if (keyring != None):
+					config["keyring"] = keyring
+				client = rados.Rados(conffile=conf, rados_id=user, conf=config)
+				client.connect()
+				entry = [client, 0]
+				self._clients[key] = entry
+			entry[1] += 1
+			return entry[0]
+
+
+	def release(self, conf, user, keyring):
+		key = (conf, user, keyring)
+		with self._lock:
+			entry = self._clients.get(key)
+			if entry == None:
+				return
+			entry[1] -= 1
+			if entry[1] <= 0:
+				del self._clients[key]
+				# shutdown cannot raise an exception
+				entry[0].shutdown()
+				logging.debug("Disconnected from cluster %s" % conf)
+
+
+	def openIoctx(self, conf, user, keyring, pool, owner=None):
+		"""Returns (client, ioctx), both released by closeIoctx."""
+		key = (conf, user, keyring)
+		with self._lock:
+			client = self.acquire(conf, user, keyring)
+			entry = self._ioctxs.get((key, pool))
+			if entry == None:
+				try:
+					entry = [client.open_ioctx(pool), 0]
+				except:
+					self.release(conf, user, keyring)
+					raise
+				self._ioctxs[(key, pool)] = entry
+			entry[1] += 1
+			if owner != None:
+				self._owners.append(owner)
+			return client, entry[0]
+
+
+	def closeIoctx(self, conf, user, keyring, pool, owner=None):
+		key = (conf, user, keyring)
+		with self._lock:
+			if owner in self._owners:
+				self._owners.remove(owner)
+			entry = self._ioctxs.get((key, pool))
+			if entry != None:
+				entry[1] -= 1
+				if entry[1] <= 0:
+					del self._ioctxs[(key, pool)]
+					# closing an ioctx cannot raise an exception
+					entry[0].close()
+			self.release(conf, user, keyring)
+
+
+	def shutdown(self):
+		"""Close the owners, then every ioctx and client left whatever their reference counts."""
+		with self._lock:
+			for owner in reversed(list(self._owners)):
+				owner.close()
+			del self._owners[:]
+			for entry in self._ioctxs.values():
+				entry[0].close()
+			self._ioctxs.clear()
+			for entry in self._clients.values():
+				entry[0].shutdown()
+			self._clients.clear()
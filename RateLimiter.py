@@ -0,0 +1,133 @@
+#!/usr/local/bin/python
+
+import re, time, threading
+from datetime import datetime
+
+_units = { '': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3, 't': 1024**4 }
+
+
+def parseSize(value):
+	"""'4M', '1.5G', '2000' -> bytes (binary units)."""
+	match = re.match("^\s*(\d+(?:\.\d+)?)\s*([kKmMgGtT]?)[bB]?\s*$", str(value))
+	if not match:
+		raise ValueError("Invalid size %s" % value)
+	return int(float(match.group(1)) * _units[match.group(2).lower()])
+
+
+def parseRate(value):
+	"""'50M', '1.5G', '2000' -> per second amount, 0 means unlimited."""
+	if value == None:
+		return 0
+	value = str(value).strip()
+	if value.endswith('/s'):
+		value = value[:-2]
+	return parseSize(value)
+
+
+def parseProfiles(value):
+	"""'08:00-20:00=50M 20:00-08:00=0' -> [((start, end), rate)], times as minutes of the day."""
+	profiles = []
+	for profile in re.split("[\s,]+", value or ''):
+		if profile == '':
+			continue
+		match = re.match("^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=(.+)$", profile)
+		if not match:
+			raise ValueError("Invalid time profile %s" % profile)
+		start = int(match.group(1)) * 60 + int(match.group(2))
+		end = int(match.group(3)) * 60 + int(match.group(4))
+		profiles.append(((start, end), parseRate(match.group(5))))
+	return profiles
+
+
+class TokenBucket(object):
+	"""
+	Thread safe token bucket: consume() blocks until the amount is available.
+	A rate of 0 disables the bucket. An amount larger than the burst is
+	granted on credit and paid back by the next callers.
+	"""
+
+	def __init__(self, rate, burst=None):
+		self._lock = threading.Lock()
+		self.rate = 0
+		self.burst = 0
+		self.setRate(rate, burst)
+		self._tokens = self.burst
+		self._last = time.time()
+
+	def setRate(self, rate, burst=None):
+		self.rate = rate
+		# one second worth of tokens by default
+		self.burst = burst if burst != None else rate
+
+	def consume(self, amount):
+		if self.rate <= 0 or amount <= 0:
+			return 0
+		with self._lock:
+			now = time.time()
+			self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+			self._last = now
+			self._tokens -= amount
+			wait = 0
+			if self._tokens < 0:
+				wait = -self._tokens / float(self.rate)
+		if wait > 0:
+			time.sleep(wait)
+		return wait
+
+
+class Throttle(object):
+	"""
+	Bandwidth (bytes/s) and IOPS limits for backup transfers: one global
+	bucket of each, optionally overridden by time of day profiles, plus a
+	bandwidth bucket per image.
+	"""
+
+	def __init__(self, bandwidth=0, iops=0, imageBandwidth=0, imageBandwidths=None, profiles=None):
+		self.bandwidth = bandwidth
+		self.profiles = profiles or []
+		self.imageBandwidth = imageBandwidth
+		self.imageBandwidths = imageBandwidths or dict()
+		self._bandwidth = TokenBucket(self.getBandwidth())
+		self._iops = TokenBucket(iops)
+		self._lock = threading.Lock()
+		self._images = dict()
+
+	def getBandwidth(self, now=None):
+		"""Global bandwidth for the time of day, first matching profile wins."""
+		if now == None:
+			now = datetime.now()
+		minute = now.hour * 60 + now.minute
+		for ((start, end), rate) in self.profiles:
+			if (start <= end and start <= minute < end) or (start > end and (minute >= start or minute < end)):
+				return rate
+		return self.bandwidth
+
+	def isActive(self):
+		return self.bandwidth > 0 or self._iops.rate > 0 or self.imageBandwidth > 0 \
+			or len(self.imageBandwidths) > 0 or len(self.profiles) > 0
+
+	active = property(isActive)
+
+	def forImage(self, name):
+		with self._lock:
+			if name not in self._images:
+				self._images[name] = ImageThrottle(self, TokenBucket(self.imageBandwidths.get(name, self.imageBandwidth)))
+			return self._images[name]
+
+	def consume(self, bytes, ops=0):
+		rate = self.getBandwidth()
+		if rate != self._bandwidth.rate:
+			self._bandwidth.setRate(rate)
+		self._iops.consume(ops)
+		self._bandwidth.consume(bytes)
+
+
+class ImageThrottle(object):
+
+	def __init__(self, throttle, bucket):
+		self.throttle = throttle
+		self.bucket = bucket
+
+	def consume(self, bytes, ops=0):
+		self.bucket.consume(bytes)
+		self.throttle.consume(bytes, ops)
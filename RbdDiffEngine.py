@@ -0,0 +1,231 @@
+#!/usr/local/bin/python
+
+import logging, threading
+try:
+	import rados
+	import rbd
+except ImportError:
+	rados = None
+	rbd = None
+
+
+class RbdDiffEngine(object):
+	"""
+	In-process equivalent of 'rbd export-diff | rbd import-diff'.
+	Extents changed between two snapshots are listed with diff_iterate on the
+	source image and written (or discarded) on the backup image through the
+	ioctxs already opened by the pools, then the snapshot is created on the
+	backup side.
+	transfer() returns (returncode, stderr) like Dataset._piped_execute.
+	In sparse mode, blocks of zeros found in allocated extents are not
+	written: skipped when the backup image is new, discarded otherwise.
+	"""
+	readSize = 4 * 1024**2 # 4 MiB
+	queueDepth = 8
+	zeroBlockSize = 64 * 1024
+
+	def __init__(self, readSize=None, queueDepth=None, throttle=None, sparse=False):
+		self.readSize = readSize or RbdDiffEngine.readSize
+		self.queueDepth = queueDepth or RbdDiffEngine.queueDepth
+		# RateLimiter.ImageThrottle or None
+		self.throttle = throttle
+		self.sparse = sparse
+		# bytes read from the source / zero bytes not written
+		self.bytes = 0
+		self.zeroBytes = 0
+		self._fresh = False
+		self._zeros = '\0' * RbdDiffEngine.zeroBlockSize
+		self._inflight = None
+		self._errors = []
+
+
+	def transfer(self, sourceDataset, remoteDataset, localsnapshot, incrementalSnap=None):
+		fromSnap = None
+		if incrementalSnap != None:
+			fromSnap = incrementalSnap.name
+		logging.debug("librbd diff %s/%s@%s (from %s) into %s/%s" % (sourceDataset.pool.name, sourceDataset.name, localsnapshot.name, fromSnap, remoteDataset.pool.name, remoteDataset.name))
+
+		src = None
+		try:
+			dst = remoteDataset._rbdImage
+			if fromSnap != None and fromSnap not in [s['name'] for s in dst.list_snaps()]:
+				return 2, "start snapshot '%s' does not exist in the image" % fromSnap
+			if localsnapshot.name in [s['name'] for s in dst.list_snaps()]:
+				return 17, "snapshot '%s' already exists" % localsnapshot.name
+
+			src = rbd.Image(sourceDataset.pool.ioctx, sourceDataset.name, snapshot=localsnapshot.name, read_only=True)
+			size = src.size()
+			self._fresh = self._isFresh(dst)
+			if dst.size() != size:
+				dst.resize(size)
+
+			extents = []
+			def collect(offset, length, exists):
+				extents.append((offset, length, exists))
+			self._diffIterate(src, 0, size, fromSnap, collect)
+
+			self._copyExtents(src, dst, extents)
+			dst.flush()
+			dst.create_snap(localsnapshot.name)
+			logging.debug("librbd diff transferred %d bytes in %d extents, %d zero bytes skipped" % (self.bytes, len(extents), self.zeroBytes))
+			return 0, ''
+		except rbd.ImageExists, e:
+			return 17, "snapshot '%s' already exists: %s" % (localsnapshot.name, e)
+		except (rbd.Error, rados.Error, IOError), e:
+			return 1, str(e)
+		finally:
+			if src != None:
+				src.close()
+
+
+	def transferChunked(self, sourceDataset, remoteDataset, localsnapshot, checkpoint, chunkSize):
+		"""Full send split in chunkSize ranges, completed ranges are recorded in checkpoint."""
+		logging.debug("librbd chunked full export %s/%s@%s into %s/%s" % (sourceDataset.pool.name, sourceDataset.name, localsnapshot.name, remoteDataset.pool.name, remoteDataset.name))
+
+		src = None
+		try:
+			dst = remoteDataset._rbdImage
+			if localsnapshot.name in [s['name'] for s in dst.list_snaps()]:
+				# names carry the creation time: a previous run finished the
+				# export but stopped before discarding the checkpoint
+				logging.info("Snapshot '%s' already exported to %s, full export complete" % (localsnapshot.name, remoteDataset.name))
+				checkpoint.discard()
+				return 0, ''
+
+			src = rbd.Image(sourceDataset.pool.ioctx, sourceDataset.name, snapshot=localsnapshot.name, read_only=True)
+			size = src.size()
+			checkpoint.load(size, chunkSize)
+			# decided when the export started: resumed, the image is no longer empty
+			if not checkpoint.resumed:
+				checkpoint.fresh = self._isFresh(dst)
+			self._fresh = checkpoint.fresh
+			# recorded before the first chunk: an interrupted one is resumed too
+			checkpoint.save()
+			if dst.size() != size:
+				dst.resize(size)
+
+			for offset in range(0, size, chunkSize):
+				if checkpoint.isDone(offset):
+					continue
+				extents = []
+				def collect(extentOffset, length, exists):
+					extents.append((extentOffset, length, exists))
+				self._diffIterate(src, offset, min(chunkSize, size - offset), None, collect)
+				self._copyExtents(src, dst, extents)
+				dst.flush()
+				checkpoint.markDone(offset)
+
+			dst.create_snap(localsnapshot.name)
+			checkpoint.discard()
+			logging.debug("librbd chunked full export transferred %d bytes" % self.bytes)
+			return 0, ''
+		except rbd.ImageExists, e:
+			return 17, "snapshot '%s' already exists: %s" % (localsnapshot.name, e)
+		except (rbd.Error, rados.Error, IOError), e:
+			return 1, str(e)
+		finally:
+			if src != None:
+				src.close()
+
+
+	def _isFresh(self, dst):
+		# created by CephPool.getDatasetOrCreate and never written
+		return dst.size() <= 1 and len(list(dst.list_snaps())) == 0
+
+
+	def _diffIterate(self, src, offset, length, fromSnap, collect):
+		# with fast-diff, whole objects come from the object map without scanning extents
+		if self.sparse and fromSnap == None and src.features() & getattr(rbd, 'RBD_FEATURE_FAST_DIFF', 0):
+			try:
+				return src.diff_iterate(offset, length, fromSnap, collect, whole_object=True)
+			except TypeError:
+				# python-rbd without whole_object
+				pass
+		return src.diff_iterate(offset, length, fromSnap, collect)
+
+
+	def _nonZeroRuns(self, data):
+		"""(start, end) ranges of data made of blocks holding at least one non-zero byte."""
+		runs = []
+		blockSize = RbdDiffEngine.zeroBlockSize
+		start = None
+		for position in range(0, len(data), blockSize):
+			block = buffer(data, position, blockSize)
+			isZero = block == buffer(self._zeros, 0, len(block))
+			if not isZero and start == None:
+				start = position
+			elif isZero and start != None:
+				runs.append((start, position))
+				start = None
+		if start != None:
+			runs.append((start, len(data)))
+		return runs
+
+
+	def _copyExtents(self, src, dst, extents):
+		self._inflight = threading.BoundedSemaphore(self.queueDepth)
+		self._errors = []
+		useAio = hasattr(dst, 'aio_write')
+		for (offset, length, exists) in extents:
+			if not exists:
+				if self.throttle != None:
+					self.throttle.consume(0, 1)
+				self._submit(useAio, dst, 'discard', offset, length)
+				continue
+			end = offset + length
+			while offset < end:
+				chunk = min(self.readSize, end - offset)
+				if self.throttle != None:
+					# one read and one write
+					self.throttle.consume(chunk, 2)
+				data = src.read(offset, chunk)
+				if self.sparse:
+					self._submitSparse(useAio, dst, offset, data)
+				else:
+					self._submit(useAio, dst, 'write', offset, data)
+				self.bytes += chunk
+				offset += chunk
+		# wait for every in-flight request
+		for i in range(self.queueDepth):
+			self._inflight.acquire()
+		for i in range(self.queueDepth):
+			self._inflight.release()
+		if self._errors:
+			raise IOError("%d write(s) failed on backup image, first error: %s" % (len(self._errors), self._errors[0]))
+
+
+	def _submitSparse(self, useAio, dst, offset, data):
+		position = 0
+		for (start, end) in self._nonZeroRuns(data) + [(len(data), len(data))]:
+			if start > position:
+				# zeros between position and start
+				self.zeroBytes += start - position
+				if not self._fresh:
+					self._submit(useAio, dst, 'discard', offset + position, start - position)
+			if end > start:
+				self._submit(useAio, dst, 'write', offset + start, data[start:end])
+			position = end
+
+
+	def _submit(self, useAio, dst, op, offset, arg):
+		if not useAio:
+			if op == 'write':
+				dst.write(arg, offset)
+			else:
+				dst.discard(offset, arg)
+			return
+
+		self._inflight.acquire()
+		def oncomplete(completion):
+			ret = completion.get_return_value()
+			if ret < 0:
+				self._errors.append("%s at %d returned %d" % (op, offset, ret))
+			self._inflight.release()
+		try:
+			if op == 'write':
+				dst.aio_write(arg, offset, oncomplete)
+			else:
+				dst.aio_discard(offset, arg, oncomplete)
+		except:
+			self._inflight.release()
+			raise
@@ -0,0 +1,117 @@
+#!/usr/local/bin/python
+import re
+from datetime import date
+
+# h: 1 every hour, d: 1 every day, w: 1 every week, m: 1 every month, y: 1 every year
+TIERS = ('h', 'd', 'w', 'm', 'y')
+
+
+def periodKeys(creation):
+	"""Integer key of the hour, day, ISO week, month and year of creation."""
+	day = creation.toordinal()
+	return (
+		day * 24 + creation.hour,
+		day,
+		day - creation.weekday(), # monday of the ISO week
+		creation.year * 12 + creation.month - 1,
+		creation.year,
+	)
+
+
+def windowStart(index, creation):
+	"""
+	Oldest period key tier TIERS[index] reaches from its first (most recent)
+	snapshot created at creation: the same day for hours, 31 days, 52 weeks
+	and 12 months back for days, weeks and months. None: years are unbounded.
+	"""
+	day = creation.toordinal()
+	if index == 0:
+		return day * 24
+	if index == 1:
+		return day - 31
+	if index == 2:
+		return day - creation.weekday() - 52 * 7
+	if index == 3:
+		start = date.fromordinal(day - 365)
+		return start.year * 12 + start.month - 1
+	return None
+
+
+def parsePolicy(policy):
+	"""'30d,4w,12m,1y' -> { 'h': 0, 'd': 30, 'w': 4, 'm': 12, 'y': 1 }"""
+	counts = dict([(tier, 0) for tier in TIERS])
+	for ttl in re.split("\W+", policy):
+		name = re.search("[a-zA-Z]", ttl)
+		value = re.search("\d+", ttl)
+		if name and value:
+			counts[name.group(0)] = int(value.group(0))
+	return counts
+
+
+class RetentionPlan(object):
+
+	def __init__(self):
+		self.keep = dict([(tier, []) for tier in TIERS + ('mandatory', 'unknown')])
+		self.trash = []
+
+
+class RetentionPlanner(object):
+	"""
+	Keep/trash decision for snapshots of an image in one pass, newest first.
+	The two most recent snapshots are mandatory (current and last backup,
+	needed for increments). Tiers then take snapshots in cascade: a tier
+	keeps a snapshot when it still has room, the snapshot lies in a period
+	older than every period already kept, and within the time window of
+	the tier (see windowStart) counted from its first snapshot. '30d,4w'
+	keeps up to 30 daily snapshots of the last 31 days, then up to 4
+	weekly ones: gaps in the backups are not made up with older snapshots.
+	Snapshots without creation time are never trashed.
+	"""
+
+	def __init__(self, policy):
+		self.policy = policy
+		self.counts = parsePolicy(policy)
+		self._tiers = [(index, tier) for (index, tier) in enumerate(TIERS) if self.counts.get(tier, 0) > 0]
+
+
+	def plan(self, snapshots):
+		"""snapshots: sorted latest first, like Dataset.snapshots."""
+		plan = RetentionPlan()
+		# oldest period key kept so far, and window of each tier
+		oldest = [None] * len(TIERS)
+		start = [None] * len(TIERS)
+		mandatory = 0
+		for snapshot in snapshots:
+			if snapshot.creation == None:
+				plan.keep['unknown'].append(snapshot)
+				continue
+			keys = periodKeys(snapshot.creation)
+			if mandatory < 2:
+				mandatory += 1
+				plan.keep['mandatory'].append(snapshot)
+				oldest = list(keys)
+				continue
+			kept = False
+			for (index, tier) in self._tiers:
+				if len(plan.keep[tier]) >= self.counts[tier] or keys[index] >= oldest[index]:
+					continue
+				if len(plan.keep[tier]) == 0:
+					start[index] = windowStart(index, snapshot.creation)
+				elif start[index] != None and keys[index] < start[index]:
+					continue
+				plan.keep[tier].append(snapshot)
+				kept = True
+				break
+			if kept:
+				oldest = list(keys)
+			else:
+				plan.trash.append(snapshot)
+		return plan
+
+
+	def planAll(self, datasets):
+		"""Plan a batch of datasets: { dataset name: RetentionPlan }"""
+		plans = dict()
+		for dataset in datasets:
+			plans[dataset.name] = self.plan(dataset.snapshots)
+		return plans
@@ -0,0 +1,72 @@
+#!/usr/local/bin/python
+
+import logging
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+
+class SnapshotRemover(object):
+	"""
+	Remove a batch of snapshots. Snapshots of one image are removed one
+	after the other, different images are processed concurrently by up to
+	'concurrency' threads (librbd releases the GIL while trimming).
+	Snapshot.remove() keeps Dataset.snapshots up to date.
+	"""
+	concurrency = 4
+
+	def __init__(self, concurrency=None):
+		self.concurrency = concurrency or SnapshotRemover.concurrency
+		self.results = []
+
+
+	def remove(self, snapshots):
+		"""Returns [(snapshot, None or exception)] in the order removals completed."""
+		groups = OrderedDict()
+		for snapshot in snapshots:
+			groups.setdefault(id(snapshot.dataset), []).append(snapshot)
+		self.results = []
+		if len(groups) == 0:
+			return self.results
+		if len(groups) == 1 or self.concurrency <= 1:
+			for group in groups.values():
+				self.results.extend(self._removeGroup(group))
+		else:
+			pool = ThreadPool(min(self.concurrency, len(groups)))
+			try:
+				for groupResults in pool.imap_unordered(self._removeGroup, groups.values()):
+					self.results.extend(groupResults)
+			finally:
+				pool.close()
+				pool.join()
+		self._invalidateStats(snapshots)
+		failures = self.getFailures()
+		if failures:
+			logging.error("%d of %d snapshot(s) could not be removed" % (len(failures), len(self.results)))
+		return self.results
+
+
+	def _invalidateStats(self, snapshots):
+		pools = dict()
+		for snapshot in snapshots:
+			pools[id(snapshot.dataset.pool)] = snapshot.dataset.pool
+		for pool in pools.values():
+			if hasattr(pool, 'invalidateClusterStats'):
+				pool.invalidateClusterStats()
+
+
+	def _removeGroup(self, snapshots):
+		results = []
+		for snapshot in snapshots:
+			try:
+				snapshot.remove()
+				results.append((snapshot, None))
+			except Exception, e:
+				logging.error("Snapshot '%s/%s' failed to be destroyed: %s" % (snapshot.dataset.name, snapshot.name, e))
+				results.append((snapshot, e))
+		return results
+
+
+	def getFailures(self):
+		return [(snapshot, error) for (snapshot, error) in self.results if error != None]
+
+	failures = property(getFailures)
@@ -0,0 +1,129 @@
+#!/usr/local/bin/python
+
+import os, json, threading, logging
+try:
+	import rbd
+except ImportError:
+	rbd = None
+
+
+def intersectExtents(first, second):
+	"""Bytes covered by both lists of sorted, non overlapping (offset, length, ...)."""
+	total = 0
+	i = 0
+	j = 0
+	while i < len(first) and j < len(second):
+		start = max(first[i][0], second[j][0])
+		end = min(first[i][0] + first[i][1], second[j][0] + second[j][1])
+		if end > start:
+			total += end - start
+		if first[i][0] + first[i][1] < second[j][0] + second[j][1]:
+			i += 1
+		else:
+			j += 1
+	return total
+
+
+class SnapshotUsageCache(object):
+	"""
+	Exclusive bytes of snapshots: the data written between the previous
+	snapshot and a snapshot, and overwritten before the next one, which is
+	what removing the snapshot frees. The extents written between two
+	snapshots (diff_iterate, whole objects with fast-diff) never change:
+	they are saved in a json file keyed by pool, image and snapshot id,
+	with the id of the previous snapshot they were computed from, so each
+	run only diffs the snapshots created (or whose previous snapshot was
+	removed) since the last one. The diff of the latest snapshot against
+	the image head is not cached.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		self._lock = threading.Lock()
+		# pool -> image -> snap id (str) -> { 'from': id or None, 'extents': [[offset, length, exists]] }
+		self.entries = dict()
+		self.computed = 0
+		self._changed = False
+		try:
+			with open(path) as f:
+				self.entries = json.load(f)
+		except IOError:
+			pass
+		except ValueError:
+			logging.warning("Ignoring corrupted snapshot usage cache %s" % path)
+
+
+	def apply(self, dataset, snapshots):
+		"""Set snapshot.used to the exclusive bytes of each snapshot of dataset."""
+		snapshots = sorted([snapshot for snapshot in snapshots if snapshot.id != None], key=lambda snapshot: snapshot.id)
+		if len(snapshots) == 0:
+			return
+		with self._lock:
+			cached = self.entries.setdefault(dataset.pool.name, dict()).get(dataset.name, dict())
+		entries = dict()
+		deltas = []
+		previous = None
+		for snapshot in snapshots:
+			fromId = previous.id if previous != None else None
+			entry = cached.get(str(snapshot.id))
+			if entry == None or entry['from'] != fromId:
+				entry = { 'from': fromId, 'extents': self._diff(dataset, snapshot.name, previous) }
+				self.computed += 1
+			entries[str(snapshot.id)] = entry
+			deltas.append(entry['extents'])
+			previous = snapshot
+		# what the head overwrote from the latest snapshot
+		deltas.append(self._diff(dataset, None, previous))
+		for (index, snapshot) in enumerate(snapshots):
+			# data written up to the snapshot, then overwritten or discarded
+			written = [extent for extent in deltas[index] if extent[2]]
+			snapshot.used = intersectExtents(written, deltas[index + 1])
+		with self._lock:
+			# snapshots removed since the last run are dropped
+			if entries != cached:
+				self._changed = True
+			self.entries[dataset.pool.name][dataset.name] = entries
+
+
+	def _diff(self, dataset, snapshotName, fromSnapshot):
+		"""Sorted [offset, length, exists] changed after fromSnapshot up to snapshotName (None: head)."""
+		image = dataset._rbdImage
+		if snapshotName != None:
+			image = rbd.Image(dataset.pool.ioctx, dataset.name, snapshot=snapshotName, read_only=True)
+		try:
+			extents = []
+			def collect(offset, length, exists):
+				exists = bool(exists)
+				if extents and extents[-1][0] + extents[-1][1] == offset and extents[-1][2] == exists:
+					extents[-1][1] += length
+				else:
+					extents.append([offset, length, exists])
+			fromName = fromSnapshot.name if fromSnapshot != None else None
+			if image.features() & getattr(rbd, 'RBD_FEATURE_FAST_DIFF', 0):
+				try:
+					image.diff_iterate(0, image.size(), fromName, collect, whole_object=True)
+					return extents
+				except TypeError:
+					# python-rbd without whole_object
+					del extents[:]
+			image.diff_iterate(0, image.size(), fromName, collect)
+			return extents
+		finally:
+			if snapshotName != None:
+				image.close()
+
+
+	def save(self):
+		if not self._changed:
+			return
+		directory = os.path.dirname(os.path.abspath(self.path))
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+		tmp = self.path + '.tmp'
+		with self._lock:
+			with open(tmp, 'w') as f:
+				json.dump(self.entries, f)
+				f.flush()
+				os.fsync(f.fileno())
+		os.rename(tmp, self.path)
+		logging.debug("Snapshot usage cache %s saved, %d diff(s) computed" % (self.path, self.computed))
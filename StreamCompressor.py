@@ -0,0 +1,105 @@
+#!/usr/local/bin/python
+
+import os, time, threading, zlib, logging, multiprocessing
+from multiprocessing.pool import ThreadPool
+from PipeRelay import TransferStats
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+try:
+	import lz4.frame
+except ImportError:
+	lz4 = None
+
+
+class StreamCompressor(object):
+	"""
+	Compress a stream chunk by chunk on a pool of threads.
+	Every chunk is compressed as an independent frame (gzip member, zstd or
+	lz4 frame): concatenated frames are a valid stream for the matching
+	'-dc' command line tool, returned by getDecompressCommand().
+	"""
+	chunkSize = 4 * 1024**2
+	defaultLevels = { 'zstd': 3, 'lz4': 0, 'gzip': 6 }
+
+	def __init__(self, algorithm='zstd', level=None, threads=None, label='', throttle=None):
+		if algorithm not in StreamCompressor.defaultLevels:
+			raise ValueError("Unknown compression algorithm %s" % algorithm)
+		if algorithm == 'zstd' and zstandard == None:
+			raise ValueError("zstd compression needs the python zstandard module")
+		if algorithm == 'lz4' and lz4 == None:
+			raise ValueError("lz4 compression needs the python lz4 module")
+		self.algorithm = algorithm
+		self.level = level if level != None else StreamCompressor.defaultLevels[algorithm]
+		self.threads = threads or multiprocessing.cpu_count()
+		self.label = label
+		# RateLimiter.ImageThrottle applied to uncompressed bytes, or None
+		self.throttle = throttle
+		self.stats = TransferStats(compressedBytes=0)
+
+
+	def getDecompressCommand(self):
+		return [self.algorithm, '-dcq']
+
+
+	def compressChunk(self, data):
+		if self.algorithm == 'zstd':
+			return zstandard.ZstdCompressor(level=self.level).compress(data)
+		if self.algorithm == 'lz4':
+			return lz4.frame.compress(data, compression_level=self.level)
+		compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31) # 31: gzip member
+		return compressor.compress(data) + compressor.flush()
+
+
+	def run(self, src, dst):
+		start = time.time()
+		# bound the chunks read ahead of the writer
+		window = threading.Semaphore(self.threads * 2)
+		aborted = []
+		def chunks():
+			while True:
+				window.acquire()
+				if aborted:
+					return
+				data = self._readChunk(src)
+				if not data:
+					window.release()
+					return
+				self.stats.bytes += len(data)
+				if self.throttle != None:
+					self.throttle.consume(len(data))
+				yield data
+
+		pool = ThreadPool(self.threads)
+		try:
+			for compressed in pool.imap(self.compressChunk, chunks()):
+				view = memoryview(compressed)
+				while len(view):
+					written = os.write(dst, view)
+					view = view[written:]
+				self.stats.compressedBytes += len(compressed)
+				window.release()
+		except:
+			# unblock the reader so the pool can stop
+			aborted.append(True)
+			window.release()
+			raise
+		finally:
+			pool.terminate()
+			pool.join()
+		self.stats.seconds = time.time() - start
+		logging.debug("Compressed %s with %s: %s" % (self.label, self.algorithm, self.stats))
+		return self.stats
+
+
+	def _readChunk(self, src):
+		buf = []
+		size = 0
+		while size < self.chunkSize:
+			data = os.read(src, self.chunkSize - size)
+			if not data:
+				break
+			buf.append(data)
+			size += len(data)
+		return ''.join(buf)
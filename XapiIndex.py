@@ -0,0 +1,62 @@
+#!/usr/local/bin/python
+
+import logging
+
+
+class XapiIndex(object):
+	"""
+	VM, VBD and VDI records of the pool fetched once with get_all_records,
+	indexed by VM name label and by VDI uuid, so that resolving the VMs of
+	an image costs no XAPI call. Power states are not cached: they are read
+	right before pausing.
+	"""
+
+	def __init__(self, xapi_session):
+		self.session = xapi_session
+		self.vms = dict()
+		self._vmsByName = dict()
+		self._vmsByVdi = dict()
+		self.refresh()
+
+
+	def refresh(self):
+		# one request when the server supports system.multicall
+		batch = self.session.multicall()
+		batch.VM.get_all_records()
+		batch.VBD.get_all_records()
+		batch.VDI.get_all_records()
+		results = batch()
+		for result in results:
+			if isinstance(result, Exception):
+				raise result
+		(vms, vbds, vdis) = results
+
+		vmsByName = dict()
+		for (vm_ref, record) in vms.items():
+			if record.get('is_a_template') or record.get('is_a_snapshot') or record.get('is_control_domain'):
+				continue
+			vmsByName.setdefault(record['name_label'], []).append(vm_ref)
+
+		vmsByVdi = dict()
+		for record in vbds.values():
+			vdi = vdis.get(record['VDI'])
+			if vdi == None or record['VM'] not in vms:
+				# empty CD drive or record removed meanwhile
+				continue
+			refs = vmsByVdi.setdefault(vdi['uuid'], [])
+			if record['VM'] not in refs:
+				refs.append(record['VM'])
+
+		self.vms = vms
+		self._vmsByName = vmsByName
+		self._vmsByVdi = vmsByVdi
+		logging.info("XAPI records loaded: %d VMs, %d VBDs, %d VDIs" % (len(vms), len(vbds), len(vdis)))
+
+
+	def getVMs(self, name):
+		"""(vm_ref, name label) of the VMs using image name: VHD-<vdi uuid> or a VM name."""
+		if name.startswith("VHD-"):
+			refs = self._vmsByVdi.get(name.replace("VHD-",""), [])
+		else:
+			refs = self._vmsByName.get(name, [])[:1]
+		return [(vm_ref, self.vms[vm_ref]['name_label']) for vm_ref in refs]
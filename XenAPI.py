@@ -113,6 +113,38 @@ class UDSTransport(xmlrpclib.Transport):
         for key, value in self._extra_headers:
             connection.putheader(key, value)
 
+class KeepAliveTransport(xmlrpclib.SafeTransport):
+    """Transport keeping one persistent HTTP(S) connection to the server.
+
+    Requests reuse the connection (and its TLS session) until it fails;
+    the socket is opened with TCP keep-alive, so that it survives the long
+    idle periods between XAPI calls of a backup run, and TCP_NODELAY.
+    connections counts the connections opened.
+    """
+
+    def __init__(self, use_datetime=0, context=None, secure=True,
+                 timeout=None):
+        xmlrpclib.SafeTransport.__init__(self, use_datetime=use_datetime,
+                                         context=context)
+        self.secure = secure
+        self.timeout = timeout
+        self.connections = 0
+
+    def make_connection(self, host):
+        if self._connection and host == self._connection[0]:
+            return self._connection[1]
+        if self.secure:
+            connection = xmlrpclib.SafeTransport.make_connection(self, host)
+        else:
+            connection = xmlrpclib.Transport.make_connection(self, host)
+        if self.timeout is not None:
+            connection.timeout = self.timeout
+        connection.connect()
+        connection.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connections += 1
+        return connection
+
 class Session(xmlrpclib.ServerProxy):
     """A server proxy and session manager for communicating with xapi using
     the Xen-API.
@@ -126,10 +158,20 @@ class Session(xmlrpclib.ServerProxy):
     """
 
     def __init__(self, uri, transport=None, encoding=None, verbose=0,
-                 allow_none=1, ignore_ssl=False):
+                 allow_none=1, ignore_ssl=False, keep_alive=True):
 
         # Fix for CA-172901 (+ Python 2.4 compatibility)
-        if not (sys.version_info[0] <= 2 and sys.version_info[1] < 7) \
+        if transport is None and keep_alive and \
+                sys.version_info[:3] >= (2, 7, 9):
+            context = None
+            if ignore_ssl:
+                import ssl
+                context = ssl._create_unverified_context()
+            transport = KeepAliveTransport(
+                context=context, secure=uri.startswith('https'))
+            xmlrpclib.ServerProxy.__init__(self, uri, transport, encoding,
+                                           verbose, allow_none)
+        elif not (sys.version_info[0] <= 2 and sys.version_info[1] < 7) \
                 and ignore_ssl:
             import ssl
             ctx = ssl._create_unverified_context()
@@ -143,6 +185,75 @@ class Session(xmlrpclib.ServerProxy):
         self.last_login_method = None
         self.last_login_params = None
         self.API_version = API_VERSION_1_1
+        # None until the first batch tells whether system.multicall exists
+        self.multicall_supported = None
+
+
+    def multicall(self):
+        """Batch of independent calls sent in a single request, see
+        _MultiCall."""
+        return _MultiCall(self)
+
+    def _multicall(self, calls):
+        """One value per call, or the Failure or xmlrpclib.Fault it
+        raised."""
+        if not calls:
+            return []
+        if self.multicall_supported is not False:
+            values = [_RECONNECT_AND_RETRY] * len(calls)
+            # only the calls rejected with SESSION_INVALID are sent again:
+            # they were not executed, the others must not be replayed
+            pending = range(len(calls))
+            retry_count = 0
+            while True:
+                batch = [{'methodName': calls[i][0],
+                          'params': (self._session,) + tuple(calls[i][1])}
+                         for i in pending]
+                try:
+                    results = getattr(self, 'system.multicall')(batch)
+                except xmlrpclib.Fault:
+                    results = None
+                if type(results) != list or len(results) != len(batch):
+                    if self.multicall_supported:
+                        raise xmlrpclib.Fault(
+                            500, 'Invalid system.multicall response')
+                    # xapi answers MESSAGE_METHOD_UNKNOWN as a plain result
+                    self.multicall_supported = False
+                    break
+                self.multicall_supported = True
+                for (i, item) in zip(pending, results):
+                    if type(item) == dict and 'faultCode' in item:
+                        values[i] = xmlrpclib.Fault(item['faultCode'],
+                                                    item['faultString'])
+                        continue
+                    try:
+                        values[i] = _parse_result(item[0])
+                    except (Failure, xmlrpclib.Fault) as e:
+                        values[i] = e
+                pending = [i for i in pending
+                           if values[i] is _RECONNECT_AND_RETRY]
+                if not pending:
+                    return values
+                retry_count += 1
+                if retry_count >= 3:
+                    fault = xmlrpclib.Fault(
+                        500, 'Tried 3 times to get a valid session, but failed')
+                elif not self.last_login_method:
+                    fault = xmlrpclib.Fault(401, 'You must log in')
+                else:
+                    self._login(self.last_login_method,
+                                self.last_login_params)
+                    continue
+                for i in pending:
+                    values[i] = fault
+                return values
+        values = []
+        for (methodname, params) in calls:
+            try:
+                values.append(self.xenapi_request(methodname, tuple(params)))
+            except (Failure, xmlrpclib.Fault) as e:
+                values.append(e)
+        return values
 
 
     def xenapi_request(self, methodname, params):
@@ -217,6 +328,39 @@ class Session(xmlrpclib.ServerProxy):
         else:
             return xmlrpclib.ServerProxy.__getattr__(self, name)
 
+class _MultiCall(object):
+    """Independent XenAPI calls queued and sent as one system.multicall
+    request, or one by one when the server does not support it.
+
+    batch = session.multicall()
+    batch.VM.get_power_state(vm1)
+    batch.VM.get_power_state(vm2)
+    state1, state2 = batch()
+
+    The calls are all executed: a failed call leaves its Failure or
+    xmlrpclib.Fault in the results instead of a value, the other results
+    are kept. Only calls refused with SESSION_INVALID are sent again after
+    logging in, so non idempotent calls (VM.pause) are never replayed.
+    """
+
+    def __init__(self, session):
+        self.__session = session
+        self.__calls = []
+
+    def __len__(self):
+        return len(self.__calls)
+
+    def __getattr__(self, name):
+        return _Dispatcher(self.__session.API_version, self.__add, name)
+
+    def __add(self, methodname, params):
+        self.__calls.append((methodname, params))
+
+    def __call__(self):
+        calls = self.__calls
+        self.__calls = []
+        return self.__session._multicall(calls)
+
 def xapi_local():
     return Session("http://_var_lib_xcp_xapi/", transport=UDSTransport())
 
@@ -1,110 +1,341 @@
 #!/usr/local/bin/python
 
-import subprocess, time, re, logging
+import subprocess, time, re, logging, sys
+from contextlib import contextmanager
+from BackupScheduler import ConcurrencyLimits
+from SnapshotRemover import SnapshotRemover
+from PhaseProfiler import profiler
+from BackupMetrics import metrics
+
+def getVMs(xapi_session, name):
+	"""(vm_ref, name label) of the VMs using image name: VHD-<vdi uuid> or a VM name."""
+	# records prefetched for the run (XapiIndex)
+	index = getattr(backup_vm, 'xapiIndex', None)
+	if index != None:
+		vms = index.getVMs(name)
+		if len(vms) == 0:
+			logging.info( "VM not recognised  : %s" % (name) )
+		return vms
 
-def toggleVMState(xapi_session, name, toPause=True):
 	if name.startswith("VHD-"):
+		vms = []
 		try:
 			vdi_ref = xapi_session.xenapi.VDI.get_by_uuid(name.replace("VHD-",""))
-			vbd_refs = xapi_session.xenapi.VDI.get_VBDs(vdi_ref)
-			for vbd_ref in vbd_refs:
+			for vbd_ref in xapi_session.xenapi.VDI.get_VBDs(vdi_ref):
 				vm_ref = xapi_session.xenapi.VBD.get_VM(vbd_ref)
-				name = xapi_session.xenapi.VM.get_name_label(vm_ref)
-				toggleVMState(xapi_session, name, toPause=toPause)
-		except e:
-			loggin.error(e)
-		finally:
-			return
-			
+				vms.append((vm_ref, xapi_session.xenapi.VM.get_name_label(vm_ref)))
+		except Exception, e:
+			logging.error("Cannot find VM of %s: %s" % (name, e))
+		return vms
+
 	vm_ref = next(iter(xapi_session.xenapi.VM.get_by_name_label(name) or []), None)
-	if vm_ref is not None:
-		#record = xapi_session.xenapi.VM.get_record(vm_ref)
-		#logging.info( "Details of vm-100 : %s" % record)
-		power = xapi_session.xenapi.VM.get_power_state(vm_ref)
-		logging.debug( "Existing powerstate of %s : %s" % (name, power) )
+	if vm_ref is None:
+		logging.info( "VM not recognised  : %s" % (name) )
+		return []
+	return [(vm_ref, name)]
+
+
+def setVMPaused(xapi_session, vm_ref, name, toPause=True):
+	"""Pause or unpause a VM, return True if its power state changed."""
+	# the only per VM call besides pause/unpause: power states are not prefetched
+	power = xapi_session.xenapi.VM.get_power_state(vm_ref)
+	logging.debug( "Existing powerstate of %s : %s" % (name, power) )
+	changed = False
+	if power == "Running" and toPause:
+		xapi_session.xenapi.VM.pause(vm_ref)
+		changed = True
+		power = "Paused"
+	if power == "Paused" and not toPause:
+		xapi_session.xenapi.VM.unpause(vm_ref)
+		changed = True
+		power = "Running"
+	if changed:
+		logging.info( "New powerstate of %s : %s" % (name, power) )
+	return changed
+
+
+def setVMsPaused(xapi_session, vms, toPause=True, changed=None):
+	"""
+	setVMPaused for several VMs, the XAPI calls of each step sent as one
+	batch. The VMs whose state changed are appended to changed (and
+	returned) as they are, so that it is complete even when a failure of
+	one of them is raised once all the VMs were handled.
+	"""
+	if changed == None:
+		changed = []
+	if len(vms) < 2:
+		for (vm_ref, vm_name) in vms:
+			if setVMPaused(xapi_session, vm_ref, vm_name, toPause):
+				changed.append((vm_ref, vm_name))
+		return changed
+	failures = []
+	batch = xapi_session.multicall()
+	for (vm_ref, vm_name) in vms:
+		batch.VM.get_power_state(vm_ref)
+	candidates = []
+	for ((vm_ref, vm_name), power) in zip(vms, batch()):
+		if isinstance(power, Exception):
+			logging.error("Cannot get the power state of %s: %s" % (vm_name, power))
+			failures.append(power)
+			continue
+		logging.debug( "Existing powerstate of %s : %s" % (vm_name, power) )
 		if power == "Running" and toPause:
-			xapi_session.xenapi.VM.pause(vm_ref)
+			batch.VM.pause(vm_ref)
+			candidates.append((vm_ref, vm_name))
 		if power == "Paused" and not toPause:
-			xapi_session.xenapi.VM.unpause(vm_ref)
-		power = xapi_session.xenapi.VM.get_power_state(vm_ref)
-		logging.info( "New powerstate of %s : %s" % (name, power) )
-	else:
-		logging.info( "VM not recognised  : %s" % (name) )
-	
-
-
-def backup_vm( image_name , xapi_session = None):
-	data = re.split('-', image_name)
-	if ( len(data) > 1 ):
-		vmid = data[1]
-	else:
-		vmid = data[0]
-
-	# image_name = 'vm-'+vmid or VHD-UUID
-	sourceDataset = backup_vm.sourcePool.getDataset( image_name )
-	backupDataset = backup_vm.backupPool.getDatasetOrCreate( image_name )
-
-	lastBackupIncrementSnapshot = None
-	lastSourceIncrementSnapshot = None
-	if sourceDataset != None :
-		lastSourceIncrementSnapshot = sourceDataset.getLastBackupSnapshot()
-		# do some cleaning if last run failed
-		currentSourceSnapshot = sourceDataset.getCurrentBackupSnapshot()
-		if currentSourceSnapshot != None:
-			if not currentSourceSnapshot.renameToLastBackup():
-				sys.exit(2)
-
-		# be sure it exists or maybe we could find another old one
-		if backupDataset != None and ( lastSourceIncrementSnapshot == None or backupDataset.getSnapshot( lastSourceIncrementSnapshot.name ) == None ) :
-			lastSourceIncrementSnapshot = backupDataset.getMostRecentMatchingSnapshot( sourceDataset.snapshots )
-	else:
-		logging.error("Impossible to find source dataset for VM %s" % (vmid) )
-
-	if backupDataset != None:
-		# do some cleaning if last failed
-		currentBackupSnapshot = backupDataset.getCurrentBackupSnapshot()
-		if currentBackupSnapshot != None:
-			if not currentBackupSnapshot.renameToLastBackup():
-				sys.exit(2)
-
-		lastBackupIncrementSnapshot = backupDataset.getLastBackupSnapshot()
-		# be sure it exists or maybe we could find another old one
-		if sourceDataset != None and ( lastBackupIncrementSnapshot == None or sourceDataset.getSnapshot( lastBackupIncrementSnapshot.name ) == None ) :
-			lastBackupIncrementSnapshot = sourceDataset.getMostRecentMatchingSnapshot( backupDataset.snapshots )
-	else:
-		logging.error("Impossible to find backup dataset for VM %s" % (vmid) )
-
-	if xapi_session is not None:
-		toggleVMState(xapi_session, image_name)
-
-	newsnapshot = sourceDataset.createBackupSnapshot()
-
-	if xapi_session is not None:
-		toggleVMState(xapi_session, image_name, False)
-
-	
-	if lastSourceIncrementSnapshot != None and lastBackupIncrementSnapshot != None:
-		# incremental send possible
-		success = sourceDataset.exportSnapshot(backupDataset, newsnapshot, lastSourceIncrementSnapshot)
-	else:
-		# we create a new fresh send
-		success = sourceDataset.exportSnapshot(backupDataset, newsnapshot)
-
-	if success:
-		#if lastLocalIncrementSnapshot != None:
-		#    lastLocalIncrementSnapshot.destroy()
-		newsnapshot.renameToLastBackup()
-		backupDataset = backup_vm.backupPool.getDataset( image_name )
-		lastBackupSnapshot = None
+			batch.VM.unpause(vm_ref)
+			candidates.append((vm_ref, vm_name))
+	for ((vm_ref, vm_name), result) in zip(candidates, batch()):
+		if isinstance(result, Exception):
+			logging.error("Cannot %s %s: %s" % ("pause" if toPause else "unpause", vm_name, result))
+			failures.append(result)
+			continue
+		changed.append((vm_ref, vm_name))
+		logging.info( "New powerstate of %s : %s" % (vm_name, "Paused" if toPause else "Running") )
+	if failures:
+		raise failures[0]
+	return changed
+
+
+def toggleVMState(xapi_session, name, toPause=True):
+	for (vm_ref, vm_name) in getVMs(xapi_session, name):
+		setVMPaused(xapi_session, vm_ref, vm_name, toPause)
+
+
+def groupByVM(xapi_session, image_names):
+	"""
+	[(group name, vms, image names)] keeping the order of image_names: the
+	images of a VM are grouped so that it is paused once for all its disks.
+	Images without VM (or without XAPI) are in a group of their own.
+	"""
+	groups = []
+	byVM = dict()
+	for name in image_names:
+		vms = []
+		if xapi_session is not None:
+			vms = getVMs(xapi_session, name)
+		if len(vms) == 0:
+			groups.append((name, [], [name]))
+			continue
+		key = tuple(sorted([vm_ref for (vm_ref, vm_name) in vms]))
+		if key not in byVM:
+			byVM[key] = (", ".join([vm_name for (vm_ref, vm_name) in vms]), vms, [])
+			groups.append(byVM[key])
+		byVM[key][2].append(name)
+	return groups
+
+
+@contextmanager
+def pausedVMs(xapi_session, vms, limits, label=None):
+	"""Keep vms paused for the duration of the block and log how long they were."""
+	if xapi_session is None or len(vms) == 0:
+		# nothing to pause: snapshots of other workers are not serialized
+		yield
+		return
+	if label == None:
+		label = ", ".join([vm_name for (vm_ref, vm_name) in vms])
+	with limits.xapiPauses:
+		with profiler.phase(label, 'pause'):
+			paused = []
+			start = time.time()
+			try:
+				with limits.xapiLock:
+					# filled as VMs pause, even if one of them fails
+					setVMsPaused(xapi_session, vms, True, paused)
+				start = time.time()
+				yield
+			finally:
+				if paused:
+					# VMs paused before the run stay paused
+					try:
+						with limits.xapiLock:
+							setVMsPaused(xapi_session, paused, False)
+					finally:
+						duration = time.time() - start
+						logging.info("VM %s paused for %.3fs" % (", ".join([vm_name for (vm_ref, vm_name) in paused]), duration))
+						for (vm_ref, vm_name) in paused:
+							metrics.recordPause(vm_name, duration)
+
+
+class ImageBackup(object):
+	"""Steps of the backup of one image: prepare, snapshot, transfer and prune."""
+
+	def __init__(self, image_name):
+		self.name = image_name
+		self.sourceDataset = None
+		self.backupDataset = None
+		self.lastSourceIncrementSnapshot = None
+		self.lastBackupIncrementSnapshot = None
+		self.snapshot = None
+
+
+	def prepare(self):
+		"""Find the increment base on both sides, return True if a new snapshot is needed."""
+		with profiler.phase(self.name, 'prepare'):
+			return self._prepare()
+
+
+	def _prepare(self):
+		image_name = self.name
+		data = re.split('-', image_name)
+		if ( len(data) > 1 ):
+			vmid = data[1]
+		else:
+			vmid = data[0]
+
+		# image_name = 'vm-'+vmid or VHD-UUID
+		sourceDataset = backup_vm.sourcePool.getDataset( image_name )
+		backupDataset = backup_vm.backupPool.getDatasetOrCreate( image_name )
+
+		lastBackupIncrementSnapshot = None
+		lastSourceIncrementSnapshot = None
+		# snapshots shared by both sides, latest first, resolved once
+		commonSnapshots = None
+		if sourceDataset != None and backupDataset != None:
+			commonSnapshots = sourceDataset.getMatchingSnapshots( backupDataset.snapshots )
+
+		if sourceDataset != None :
+			lastSourceIncrementSnapshot = sourceDataset.getLastBackupSnapshot()
+			# do some cleaning if last run failed
+			currentSourceSnapshot = sourceDataset.getCurrentBackupSnapshot()
+			if currentSourceSnapshot != None:
+				if not currentSourceSnapshot.renameToLastBackup():
+					sys.exit(2)
+
+			# be sure it exists or maybe we could find another old one
+			if backupDataset != None and ( lastSourceIncrementSnapshot == None or backupDataset.getSnapshot( lastSourceIncrementSnapshot.name ) == None ) :
+				lastSourceIncrementSnapshot = commonSnapshots[0][1] if commonSnapshots else None
+		else:
+			logging.error("Impossible to find source dataset for VM %s" % (vmid) )
+
 		if backupDataset != None:
-			backupDataset.rollBackupNames()
-		# keep only last snapshot available for later increment
-			lastBackupSnapshot = sourceDataset.getMostRecentMatchingSnapshot( backupDataset.snapshots )
-		if lastBackupSnapshot != None:
-			# lastBackupSnapshot exists on both sides for later increment: delete others (olders)
-			logging.info("cleaning dataset %s from pool %s, keep %s" % (sourceDataset.name, sourceDataset.pool.name, lastBackupSnapshot.name) )
-			destroylist = [snap for snap in sourceDataset.snapshots if snap.name != lastBackupSnapshot.name and snap.creation != lastBackupSnapshot.creation ]
-			for snap in destroylist:
-				snap.destroy()
-	else:
-		logging.error("Cannot import: might need to clean old snapshots.")
+			# do some cleaning if last failed
+			currentBackupSnapshot = backupDataset.getCurrentBackupSnapshot()
+			if currentBackupSnapshot != None:
+				if not currentBackupSnapshot.renameToLastBackup():
+					sys.exit(2)
+
+			lastBackupIncrementSnapshot = backupDataset.getLastBackupSnapshot()
+			# be sure it exists or maybe we could find another old one
+			if sourceDataset != None and ( lastBackupIncrementSnapshot == None or sourceDataset.getSnapshot( lastBackupIncrementSnapshot.name ) == None ) :
+				lastBackupIncrementSnapshot = commonSnapshots[0][0] if commonSnapshots else None
+		else:
+			logging.error("Impossible to find backup dataset for VM %s" % (vmid) )
+
+		self.sourceDataset = sourceDataset
+		self.backupDataset = backupDataset
+		self.lastSourceIncrementSnapshot = lastSourceIncrementSnapshot
+		self.lastBackupIncrementSnapshot = lastBackupIncrementSnapshot
+
+		# resume an interrupted full export of the same snapshot
+		self.snapshot = sourceDataset.getPendingFullExport()
+		if self.snapshot != None:
+			logging.info("Resuming full export of %s@%s" % (image_name, self.snapshot.name))
+			self.lastSourceIncrementSnapshot = None
+			return False
+		return True
+
+
+	def createSnapshot(self):
+		# called while the VM is paused: nothing else here
+		with profiler.phase(self.name, 'snapshot'):
+			self.snapshot = self.sourceDataset.createBackupSnapshot()
+
+
+	def transfer(self, limits):
+		sourceDataset = self.sourceDataset
+		backupDataset = self.backupDataset
+		newsnapshot = self.snapshot
+		# always take source then backup slot to avoid deadlocks between workers
+		with limits.sourceReads:
+			with limits.backupWrites:
+				with profiler.phase(self.name, 'transfer'):
+					start = time.time()
+					if self.lastSourceIncrementSnapshot != None and self.lastBackupIncrementSnapshot != None:
+						# incremental send possible
+						success = sourceDataset.exportSnapshot(backupDataset, newsnapshot, self.lastSourceIncrementSnapshot)
+					else:
+						# we create a new fresh send
+						success = sourceDataset.exportSnapshot(backupDataset, newsnapshot)
+		if success:
+			stats = sourceDataset.lastTransfer
+			metrics.recordTransfer(self.name, stats.bytes if stats != None else None, time.time() - start, stats.ratio if stats != None else None)
+
+		if success:
+			#if lastLocalIncrementSnapshot != None:
+			#    lastLocalIncrementSnapshot.destroy()
+			newsnapshot.renameToLastBackup()
+			backupDataset = backup_vm.backupPool.getDataset( self.name )
+			lastBackupSnapshot = None
+			if backupDataset != None:
+				backupDataset.rollBackupNames()
+			# keep only last snapshot available for later increment
+				commonSnapshots = sourceDataset.getMatchingSnapshots( backupDataset.snapshots )
+				if commonSnapshots:
+					lastBackupSnapshot = commonSnapshots[0][0]
+			if lastBackupSnapshot != None:
+				# lastBackupSnapshot exists on both sides for later increment: delete others (olders)
+				logging.info("cleaning dataset %s from pool %s, keep %s" % (sourceDataset.name, sourceDataset.pool.name, lastBackupSnapshot.name) )
+				destroylist = [snap for snap in sourceDataset.snapshots if snap.name != lastBackupSnapshot.name and snap.creation != lastBackupSnapshot.creation ]
+				with profiler.phase(self.name, 'prune'):
+					SnapshotRemover().remove(destroylist)
+		else:
+			logging.error("Cannot import: might need to clean old snapshots.")
+		return success
+
+
+def backup_vm( image_name , xapi_session = None, limits = None):
+	if limits == None:
+		limits = ConcurrencyLimits()
+
+	backup = ImageBackup(image_name)
+	if backup.prepare():
+		vms = []
+		if xapi_session is not None:
+			with limits.xapiLock:
+				vms = getVMs(xapi_session, image_name)
+		with pausedVMs(xapi_session, vms, limits, image_name):
+			backup.createSnapshot()
+	return backup.transfer(limits)
+
+
+def backup_vm_group( image_names, vms, xapi_session = None, limits = None ):
+	"""
+	Backup the disks of one VM: it is paused once while the snapshots of all
+	its disks are created back to back, then the disks are sent one by one.
+	Returns { image name: success }.
+	"""
+	if limits == None:
+		limits = ConcurrencyLimits()
+
+	results = dict()
+	prepared = []
+	toSnapshot = []
+	for name in image_names:
+		backup = ImageBackup(name)
+		try:
+			if backup.prepare():
+				toSnapshot.append(backup)
+			prepared.append(backup)
+		except Exception, e:
+			logging.error("Cannot prepare backup of %s: %s" % (name, e))
+			results[name] = False
+
+	if toSnapshot:
+		with pausedVMs(xapi_session, vms, limits):
+			for backup in toSnapshot:
+				try:
+					backup.createSnapshot()
+				except Exception, e:
+					logging.error("Cannot snapshot %s: %s" % (backup.name, e))
+					results[backup.name] = False
+
+	for backup in prepared:
+		if backup.name in results:
+			continue
+		try:
+			results[backup.name] = backup.transfer(limits)
+		except Exception, e:
+			logging.error("Backup of %s failed: %s" % (backup.name, e))
+			results[backup.name] = False
+	return results
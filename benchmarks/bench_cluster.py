@@ -0,0 +1,233 @@
+#!/usr/local/bin/python
+#
+# Hot paths measured on the in-memory rados/rbd stand-in (fakeceph):
+#   load      CephPool loading and snapshot listing of every image
+#   matching  getMostRecentMatchingSnapshot between source and backup images
+#   cleanup   CephSnapshotsCleanup.cleanAll on two years of daily snapshots
+#   librbd    full then incremental exportSnapshot with the librbd engine
+#   cli       full then incremental exportSnapshot through the fake rbd
+#             command: plain pipe, relay and gzip compression
+# Results can be saved with --json and compared with a former run with
+# --compare, ie: between two releases.
+# usage: bench_cluster.py [--images N] [--snapshots N] [--size MiB] [--json file] [--compare file] [case ...]
+#
+
+import os, sys, time, json, getopt, logging, tempfile, shutil, random, subprocess
+from datetime import datetime, timedelta
+here = os.path.dirname(os.path.abspath(__file__))
+fakeceph = os.path.join(here, 'fakeceph')
+sys.path.insert(0, fakeceph)
+sys.path.insert(0, os.path.join(here, '..'))
+import fakecluster
+from CephPool import *
+from CephSnapshotsCleanup import *
+
+CASES = ('load', 'matching', 'cleanup', 'librbd', 'cli')
+MiB = 1024**2
+
+
+def snapshotNames(count, end=datetime(2024, 1, 1, 2, 0, 0)):
+	"""Daily backup snapshot names, oldest first."""
+	return [(end - timedelta(days=day)).strftime(Dataset.snapshotPattern) for day in range(count - 1, -1, -1)]
+
+
+def populate(conf, pool, images, snapshots, size, writes=4, writeSize=256 * 1024):
+	"""images of size bytes with one snapshot a day, writes random extents before each."""
+	generator = random.Random(1)
+	cluster = fakecluster.getCluster(conf)
+	cluster.createPool(pool)
+	names = []
+	for i in range(images):
+		image = cluster.createImage(pool, 'vm-%d' % (100 + i), size)
+		for name in snapshots:
+			for w in range(writes):
+				image.write(generator.randrange(0, size // writeSize) * writeSize, writeSize)
+			image.createSnap(name)
+		cluster.save(pool, image)
+		names.append(image.name)
+	return names
+
+
+def openPool(name, conf):
+	return CephPool(name, conf, 'admin', None, False)
+
+
+def reset():
+	CephPool._registry.shutdown()
+	fakecluster.reset()
+
+
+def result(case, metric, value, unit, seconds):
+	return { 'case': case, 'metric': metric, 'value': value, 'unit': unit, 'seconds': seconds }
+
+
+def benchLoad(options):
+	snapshots = snapshotNames(options['snapshots'])
+	populate('source.conf', 'rbd', options['images'], snapshots, 1024 * MiB, writes=1)
+	start = time.time()
+	pool = openPool('rbd', 'source.conf')
+	count = 0
+	for dataset in pool.datasets:
+		count += len(dataset.snapshots)
+	seconds = time.time() - start
+	return [result('load', 'images', options['images'] / seconds, 'images/s', seconds),
+		result('load', 'snapshots', count / seconds, 'snapshots/s', seconds)]
+
+
+def benchMatching(options):
+	snapshots = snapshotNames(options['snapshots'])
+	populate('source.conf', 'rbd', options['images'], snapshots, 1024 * MiB, writes=0)
+	# the backup side misses the two most recent snapshots
+	populate('backup.conf', 'rbdbackup', options['images'], snapshots[:-2], 1024 * MiB, writes=0)
+	source = openPool('rbd', 'source.conf')
+	backup = openPool('rbdbackup', 'backup.conf')
+	pairs = [(dataset, backup.getDataset(dataset.name)) for dataset in source.datasets]
+	for (local, remote) in pairs:
+		local.snapshots
+		remote.snapshots
+	rounds = 10
+	start = time.time()
+	for i in range(rounds):
+		for (local, remote) in pairs:
+			if local.getMostRecentMatchingSnapshot(remote.snapshots) == None:
+				raise Exception("no matching snapshot for %s" % local.name)
+	seconds = time.time() - start
+	return [result('matching', 'lookups', rounds * len(pairs) / seconds, 'lookups/s', seconds)]
+
+
+def benchCleanup(options):
+	images = max(1, options['images'] // 10)
+	populate('backup.conf', 'rbdbackup', images, snapshotNames(730), 1024 * MiB, writes=1)
+	backup = openPool('rbdbackup', 'backup.conf')
+	for dataset in backup.datasets:
+		dataset.snapshots
+	before = sum([len(dataset.snapshots) for dataset in backup.datasets])
+	start = time.time()
+	for dataset in list(backup.datasets):
+		CephSnapshotsCleanup(backup, dataset.name, '30d,4w,12m,1y', False).cleanAll()
+	seconds = time.time() - start
+	removed = before - sum([len(dataset.snapshots) for dataset in backup.datasets])
+	return [result('cleanup', 'removed', removed / seconds, 'snapshots/s', seconds)]
+
+
+def exportImages(case, options, configure):
+	"""Full then incremental export of images of options['size'] MiB (half allocated, 5% changed)."""
+	size = options['size'] * MiB
+	names = snapshotNames(2)
+	cluster = fakecluster.getCluster('source.conf')
+	cluster.createPool('rbd')
+	fakecluster.getCluster('backup.conf').createPool('rbdbackup')
+	images = []
+	for i in range(options['exports']):
+		image = cluster.createImage('rbd', 'vm-%d' % (100 + i), size)
+		image.write(0, size // 2)
+		image.createSnap(names[0])
+		for offset in range(0, size, size // 20):
+			image.write(offset, 64 * 1024)
+		image.createSnap(names[1])
+		cluster.save('rbd', image)
+		images.append(image)
+
+	results = []
+	for (label, configuration) in configure:
+		source = openPool('rbd', 'source.conf')
+		backup = openPool('rbdbackup', 'backup.conf')
+		configuration()
+		for (step, fromName) in (('full', None), ('incremental', names[0])):
+			toName = names[0] if fromName == None else names[1]
+			bytes = 0
+			start = time.time()
+			for image in images:
+				local = source.getDataset(image.name)
+				remote = backup.getDatasetOrCreate(image.name)
+				fromSnap = local.getSnapshot(fromName) if fromName != None else None
+				if not local.exportSnapshot(remote, local.getSnapshot(toName), fromSnap):
+					raise Exception("export of %s@%s failed" % (image.name, toName))
+				bytes += sum([length for (offset, length, exists) in image.changedExtents(fromName, toName) if exists])
+			seconds = time.time() - start
+			results.append(result(case, "%s %s" % (label, step), bytes / seconds / MiB, 'MiB/s', seconds))
+		# next configuration starts from empty backup images
+		for image in images:
+			fakecluster.getCluster('backup.conf').removeImage('rbdbackup', image.name)
+		reset()
+		Dataset.transferRelay = False
+		Dataset.compression = None
+	return results
+
+
+def benchLibrbd(options):
+	def configure():
+		Dataset.transferEngine = 'librbd'
+	try:
+		return exportImages('librbd', options, [('librbd', configure)])
+	finally:
+		Dataset.transferEngine = 'cli'
+
+
+def benchCli(options):
+	directory = tempfile.mkdtemp(prefix='fakeceph')
+	os.environ['FAKE_CEPH_DIR'] = directory
+	os.makedirs(os.path.join(directory, 'bin'))
+	# run the fake rbd command with this interpreter
+	wrapper = os.path.join(directory, 'bin', 'rbd')
+	with open(wrapper, 'w') as f:
+		f.write('#!/bin/sh\nexec %s %s "$@"\n' % (sys.executable, os.path.join(fakeceph, 'rbd')))
+	os.chmod(wrapper, 0755)
+	path = os.environ['PATH']
+	os.environ['PATH'] = os.path.join(directory, 'bin') + os.pathsep + path
+	configure = [('pipe', lambda: None)]
+	configure.append(('relay', lambda: setattr(Dataset, 'transferRelay', True)))
+	if subprocess.call('command -v gzip >/dev/null', shell=True) == 0:
+		configure.append(('gzip', lambda: setattr(Dataset, 'compression', 'gzip')))
+	try:
+		return exportImages('cli', options, configure)
+	finally:
+		os.environ['PATH'] = path
+		del os.environ['FAKE_CEPH_DIR']
+		shutil.rmtree(directory)
+
+
+def revision():
+	try:
+		return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=here, stderr=subprocess.STDOUT).strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+if __name__ == '__main__':
+	options = { 'images': 200, 'snapshots': 60, 'size': 512, 'exports': 2 }
+	jsonFile = None
+	compareFile = None
+	opts, cases = getopt.getopt(sys.argv[1:], "", ["images=", "snapshots=", "size=", "exports=", "json=", "compare="])
+	for (opt, arg) in opts:
+		if opt == '--json':
+			jsonFile = arg
+		elif opt == '--compare':
+			compareFile = arg
+		else:
+			options[opt[2:]] = int(arg)
+	cases = cases or list(CASES)
+	logging.basicConfig(level=logging.WARNING)
+
+	benchmarks = { 'load': benchLoad, 'matching': benchMatching, 'cleanup': benchCleanup, 'librbd': benchLibrbd, 'cli': benchCli }
+	results = []
+	for case in cases:
+		reset()
+		results.extend(benchmarks[case](options))
+	reset()
+
+	previous = dict()
+	if compareFile != None:
+		with open(compareFile) as f:
+			for entry in json.load(f)['results']:
+				previous[(entry['case'], entry['metric'])] = entry['value']
+	print "%s" % ', '.join(["%s=%s" % item for item in sorted(options.items())])
+	for entry in results:
+		line = "%-9s %-22s %12.1f %-12s %8.3f s" % (entry['case'], entry['metric'], entry['value'], entry['unit'], entry['seconds'])
+		if (entry['case'], entry['metric']) in previous:
+			line += "  x%.2f" % (entry['value'] / previous[(entry['case'], entry['metric'])])
+		print line
+
+	if jsonFile != None:
+		with open(jsonFile, 'w') as f:
+			json.dump({ 'revision': revision(), 'python': sys.version.split()[0], 'options': options, 'results': results }, f, indent=1)
@@ -0,0 +1,95 @@
+#!/usr/local/bin/python
+#
+# Dataset registry / snapshot index lookups compared to the former linear scans.
+# usage: bench_index.py [images] [snapshots per image]
+#
+
+import os, sys, time, random
+from datetime import datetime, timedelta
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from CephIndex import *
+
+
+class FakeDataset(object):
+	__slots__ = ('name', 'snapshots')
+
+	def __init__(self, name):
+		self.name = name
+		self.snapshots = None
+
+
+class FakeSnapshot(object):
+	__slots__ = ('name', 'creation')
+
+	def __init__(self, name, creation):
+		self.name = name
+		self.creation = creation
+
+
+def timeit(label, func, count):
+	start = time.time()
+	func()
+	elapsed = time.time() - start
+	print "%-40s %10.3f s %12.2f us/op" % (label, elapsed, elapsed * 1e6 / count)
+	return elapsed
+
+
+def main(images, snapshots):
+	origin = datetime(2015, 1, 1)
+	names = ["vm-%d" % i for i in range(images)]
+	lookups = 10000
+	random.seed(0)
+	lookupNames = [random.choice(names) for i in range(lookups)]
+
+	datasetSet = set()
+	registry = DatasetRegistry()
+	for name in names:
+		dataset = FakeDataset(name)
+		datasetSet.add(dataset)
+		registry.add(dataset)
+
+	print "%d images x %d snapshots" % (images, snapshots)
+	def linearDataset():
+		for name in lookupNames:
+			for dataset in datasetSet:
+				if dataset.name == name:
+					break
+	def indexedDataset():
+		for name in lookupNames:
+			registry.get(name)
+	linear = timeit("dataset by name (linear, %d)" % lookups, linearDataset, lookups)
+	indexed = timeit("dataset by name (registry, %d)" % lookups, indexedDataset, lookups)
+	print "speedup x%.0f" % (linear / max(indexed, 1e-9))
+
+	def build():
+		for name in names:
+			dataset = registry.get(name)
+			dataset.snapshots = SnapshotIndex()
+			for i in range(snapshots):
+				creation = origin + timedelta(hours=i)
+				dataset.snapshots.append(FakeSnapshot(creation.strftime('backup%Y-%m-%dT%H.%M.%S'), creation))
+	timeit("index build (%d snapshots)" % (images * snapshots), build, images * snapshots)
+
+	probes = [registry.get(name).snapshots for name in lookupNames]
+	probeNames = [(origin + timedelta(hours=random.randrange(snapshots))).strftime('backup%Y-%m-%dT%H.%M.%S') for i in range(lookups)]
+	def linearSnapshot():
+		for (index, name) in zip(probes, probeNames):
+			for snapshot in index[:]:
+				if snapshot.name == name:
+					break
+	def indexedSnapshot():
+		for (index, name) in zip(probes, probeNames):
+			index.get(name)
+	def indexedCreation():
+		for index in probes:
+			index.getByCreation(origin)
+	linear = timeit("snapshot by name (linear, %d)" % lookups, linearSnapshot, lookups)
+	indexed = timeit("snapshot by name (index, %d)" % lookups, indexedSnapshot, lookups)
+	timeit("snapshot by creation (index, %d)" % lookups, indexedCreation, lookups)
+	print "speedup x%.0f" % (linear / max(indexed, 1e-9))
+
+
+if __name__ == '__main__':
+	images = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+	snapshots = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+	main(images, snapshots)
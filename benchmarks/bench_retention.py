@@ -0,0 +1,60 @@
+#!/usr/local/bin/python
+#
+# Retention planning of synthetic snapshots.
+# usage: bench_retention.py [snapshots] [policy]
+#
+
+import os, sys, time
+from datetime import datetime, timedelta
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from RetentionPlanner import *
+
+
+class FakeDataset(object):
+	__slots__ = ('name', 'snapshots')
+
+	def __init__(self, name, snapshots):
+		self.name = name
+		self.snapshots = snapshots
+
+
+class FakeSnapshot(object):
+	__slots__ = ('name', 'creation')
+
+	def __init__(self, creation):
+		self.name = creation.strftime('backup%Y-%m-%dT%H.%M.%S')
+		self.creation = creation
+
+
+def hourly(count, end):
+	# latest first, like Dataset.snapshots
+	return [FakeSnapshot(end - timedelta(hours=i)) for i in range(count)]
+
+
+def main(count, policy):
+	end = datetime(2020, 6, 15, 12)
+	planner = RetentionPlanner(policy)
+
+	snapshots = hourly(count, end)
+	start = time.time()
+	plan = planner.plan(snapshots)
+	elapsed = time.time() - start
+	print "1 image x %d hourly snapshots, policy %s" % (count, policy)
+	print "%-40s %10.3f s %12.2f us/snapshot" % ("plan", elapsed, elapsed * 1e6 / count)
+	print "kept: %s, trashed: %d" % (", ".join(["%s=%d" % (tier, len(plan.keep[tier])) for tier in sorted(plan.keep)]), len(plan.trash))
+
+	images = 200
+	perImage = count // images
+	datasets = [FakeDataset("vm-%d" % i, hourly(perImage, end)) for i in range(images)]
+	start = time.time()
+	plans = planner.planAll(datasets)
+	elapsed = time.time() - start
+	print "%d images x %d snapshots" % (images, perImage)
+	print "%-40s %10.3f s %12.2f us/snapshot" % ("planAll", elapsed, elapsed * 1e6 / (images * perImage))
+	print "trashed: %d" % sum([len(p.trash) for p in plans.values()])
+
+
+if __name__ == '__main__':
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	policy = sys.argv[2] if len(sys.argv) > 2 else '24h,30d,4w,12m,1y'
+	main(count, policy)
@@ -0,0 +1,65 @@
+#!/usr/local/bin/python
+#
+# Snapshot construction CPU time and memory, compared to the former
+# regex + strptime class with a __dict__.
+# usage: bench_snapshot.py [snapshots]
+#
+
+import os, sys, time, re, gc, logging
+from datetime import datetime, timedelta
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from CephPool import Snapshot, Dataset
+
+
+class LegacySnapshot(object):
+	snapshotPattern = "^backup\d{4}-\d{2}-\d{2}T\d{2}\.\d{2}\.\d{2}$"
+
+	def __init__(self, id, name, dataset, dryrun=True):
+		self.id = id
+		self.name = name
+		self.dataset = dataset
+		self.dryrun = dryrun
+		self.__keep = None
+		self.__keepTested = False
+		self.__tags = None
+		self.creation = None
+		self.used = 0
+		self.isCurrent = False
+		self.isLast = False
+		try:
+			snaptime = re.search("("+LegacySnapshot.snapshotPattern+")", name).group(1)
+			self.creation = datetime.strptime(snaptime, Dataset.snapshotPattern )
+		except AttributeError:
+			pass
+
+
+def size(obj):
+	total = sys.getsizeof(obj)
+	if hasattr(obj, '__dict__'):
+		total += sys.getsizeof(obj.__dict__)
+	return total
+
+
+def run(cls, names):
+	gc.collect()
+	start = time.clock()
+	snapshots = [cls(i, name, None, False) for (i, name) in enumerate(names)]
+	elapsed = time.clock() - start
+	memory = sum([size(snapshot) for snapshot in snapshots])
+	print "%-16s %8.3f s cpu %8.2f us/snapshot %10.1f MiB %6d bytes/snapshot" % (cls.__name__, elapsed, elapsed * 1e6 / len(names), memory / 1024.0**2, memory // len(names))
+	assert snapshots[0].creation == datetime.strptime(names[0], Dataset.snapshotPattern)
+	return elapsed, memory
+
+
+def main(count):
+	logging.disable(logging.INFO)
+	origin = datetime(2015, 1, 1)
+	names = [(origin + timedelta(hours=i)).strftime(Dataset.snapshotPattern) for i in range(count)]
+	print "%d snapshots (object and attribute dict sizes, shared strings excluded)" % count
+	legacyTime, legacyMemory = run(LegacySnapshot, names)
+	newTime, newMemory = run(Snapshot, names)
+	print "cpu x%.1f faster, memory x%.1f smaller" % (legacyTime / newTime, float(legacyMemory) / newMemory)
+
+
+if __name__ == '__main__':
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,108 @@
+#!/usr/local/bin/python
+#
+# XenAPI calls per second against a local stand-in XML-RPC server: the
+# stock xmlrpclib transport, the keep-alive transport, and system.multicall
+# batches. rtt (ms) is added by the server to each request and twice to
+# each new connection (TCP + TLS handshakes) to mimic a remote pool master.
+# usage: bench_xapi.py [calls] [rtt] [batch]
+#
+
+import os, sys, time, threading
+import xmlrpclib
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from SocketServer import ThreadingMixIn
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import XenAPI
+
+
+def success(value):
+	return { 'Status': 'Success', 'Value': value }
+
+
+class FakeXapi(object):
+	"""Answers the calls made by Session.login and VM.get_power_state."""
+
+	values = {
+		'session.login_with_password': 'OpaqueRef:session',
+		'session.logout': '',
+		'pool.get_all': ['OpaqueRef:pool'],
+		'pool.get_master': 'OpaqueRef:host',
+		'host.get_API_version_major': '2',
+		'host.get_API_version_minor': '5',
+		'VM.get_power_state': 'Running',
+	}
+
+	def _dispatch(self, method, params):
+		if method not in FakeXapi.values:
+			return { 'Status': 'Failure', 'ErrorDescription': ['MESSAGE_METHOD_UNKNOWN', method] }
+		return success(FakeXapi.values[method])
+
+
+class Handler(SimpleXMLRPCRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	rtt = 0.0
+
+	def setup(self):
+		time.sleep(2 * Handler.rtt)
+		SimpleXMLRPCRequestHandler.setup(self)
+
+	def do_POST(self):
+		time.sleep(Handler.rtt)
+		SimpleXMLRPCRequestHandler.do_POST(self)
+
+
+class Server(ThreadingMixIn, SimpleXMLRPCServer):
+	daemon_threads = True
+
+
+class StockTransport(xmlrpclib.Transport):
+	"""xmlrpclib.Transport as is, counting the connections it opens."""
+	connections = 0
+
+	def make_connection(self, host):
+		if self._connection and host == self._connection[0]:
+			return self._connection[1]
+		StockTransport.connections += 1
+		return xmlrpclib.Transport.make_connection(self, host)
+
+
+def run(label, session, calls, batch, connections):
+	session.xenapi.login_with_password('root', 'password', '1.0', 'bench_xapi.py')
+	start = time.time()
+	done = 0
+	while done < calls:
+		if batch > 1:
+			multicall = session.multicall()
+			for i in range(min(batch, calls - done)):
+				multicall.VM.get_power_state('OpaqueRef:vm%d' % (done + i))
+			done += len(multicall())
+		else:
+			session.xenapi.VM.get_power_state('OpaqueRef:vm%d' % done)
+			done += 1
+	elapsed = time.time() - start
+	session.xenapi.session.logout()
+	session.transport.close()
+	print "%-22s %8.1f calls/s  %6.3f s  %d connections" % (label, calls / elapsed, elapsed, connections())
+
+
+if __name__ == '__main__':
+	calls = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+	Handler.rtt = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.0
+	batch = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+	server = Server(('127.0.0.1', 0), requestHandler=Handler, logRequests=False, allow_none=True)
+	server.register_instance(FakeXapi())
+	server.register_multicall_functions()
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+	uri = 'http://127.0.0.1:%d/' % server.server_address[1]
+	print "%d calls, rtt %.1f ms, batches of %d" % (calls, Handler.rtt * 1000, batch)
+
+	run('stock transport', XenAPI.Session(uri, transport=StockTransport()), calls, 1,
+		lambda: StockTransport.connections)
+	session = XenAPI.Session(uri)
+	run('keep-alive', session, calls, 1, lambda: session.transport.connections)
+	session = XenAPI.Session(uri)
+	run('keep-alive multicall', session, calls, batch, lambda: session.transport.connections)
+	server.shutdown()
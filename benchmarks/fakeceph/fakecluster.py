@@ -0,0 +1,411 @@
+#!/usr/local/bin/python
+#
+# In-memory clusters behind the fake rados and rbd modules and the fake rbd
+# command. Images keep the extents written between snapshots, not the data:
+# reads return a fixed pattern (about half random, half compressible).
+# With FAKE_CEPH_DIR set, images are also saved as json files in
+# <FAKE_CEPH_DIR>/<cluster>/<pool>/<image>.json so that the fake rbd command
+# and the benchmark process share them.
+#
+
+import os, json, struct, random, threading
+
+OBJECT_SIZE = 4 * 1024**2
+RBD_FEATURE_FAST_DIFF = 16
+DIFF_HEADER = "rbd diff v1\n"
+
+
+def _makePattern(size=1024**2):
+	generator = random.Random(42)
+	blocks = []
+	for i in range(size // 4096):
+		if i % 2:
+			blocks.append(struct.pack('<512Q', *[generator.getrandbits(64) for j in range(512)]))
+		else:
+			blocks.append(("block %08d " % i) * (4096 // 15) + ' ' * (4096 % 15))
+	return ''.join(blocks)
+
+PATTERN = _makePattern()
+
+
+def patternData(offset, length):
+	"""Bytes read at offset: PATTERN repeated over the whole image."""
+	chunks = []
+	position = offset % len(PATTERN)
+	while length > 0:
+		chunk = PATTERN[position:position + length]
+		chunks.append(chunk)
+		length -= len(chunk)
+		position = 0
+	return ''.join(chunks)
+
+
+def mergeExtents(extents, offset=0, length=None):
+	"""Sorted, coalesced (offset, length, exists) clipped to [offset, offset + length)."""
+	end = None if length == None else offset + length
+	merged = []
+	for (start, size, exists) in sorted(extents):
+		stop = start + size
+		if end != None:
+			start = max(start, offset)
+			stop = min(stop, end)
+		elif start < offset:
+			start = offset
+		if stop <= start:
+			continue
+		if merged and start <= merged[-1][0] + merged[-1][1]:
+			(lastStart, lastSize, lastExists) = merged[-1]
+			merged[-1] = (lastStart, max(lastStart + lastSize, stop) - lastStart, lastExists or exists)
+		else:
+			merged.append((start, stop - start, exists))
+	return merged
+
+
+class FakeImage(object):
+	"""
+	An rbd image: size, features and snapshots, each snapshot holding the
+	extents written since the previous one (delta), head the extents
+	written since the last snapshot.
+	"""
+
+	def __init__(self, name, size, features=0):
+		self.name = name
+		self.size = size
+		self.features = features
+		self.snaps = []
+		self.head = []
+		self.snapSeq = 0
+		self.lock = threading.RLock()
+		self.mtime = None
+
+
+	def getSnap(self, name):
+		for snap in self.snaps:
+			if snap['name'] == name:
+				return snap
+		return None
+
+
+	def createSnap(self, name):
+		with self.lock:
+			if self.getSnap(name) != None:
+				return False
+			self.snapSeq += 1
+			self.snaps.append({ 'id': self.snapSeq, 'name': name, 'size': self.size, 'protected': False, 'delta': self.head })
+			self.head = []
+			return True
+
+
+	def removeSnap(self, name):
+		with self.lock:
+			snap = self.getSnap(name)
+			index = self.snaps.index(snap)
+			# later views still include what was written before the removed snapshot
+			if index + 1 < len(self.snaps):
+				following = self.snaps[index + 1]
+				following['delta'] = mergeExtents(snap['delta'] + following['delta'])
+			else:
+				self.head = mergeExtents(snap['delta'] + self.head)
+			del self.snaps[index]
+
+
+	def write(self, offset, length, exists=True):
+		with self.lock:
+			self.head.append((offset, length, exists))
+
+
+	def changedExtents(self, fromSnap, toSnap, offset=0, length=None):
+		"""Extents written after fromSnap (None: since creation) up to toSnap (None: head)."""
+		with self.lock:
+			extents = []
+			collecting = fromSnap == None
+			for snap in self.snaps:
+				if collecting:
+					extents.extend(snap['delta'])
+				if snap['name'] == toSnap:
+					break
+				if snap['name'] == fromSnap:
+					collecting = True
+			else:
+				if toSnap == None:
+					extents.extend(self.head)
+			if not collecting:
+				return []
+			if fromSnap == None:
+				# a full diff only lists allocated data
+				extents = [extent for extent in extents if extent[2]]
+			return mergeExtents(extents, offset, length)
+
+
+	def usedBytes(self):
+		return sum([size for (offset, size, exists) in self.changedExtents(None, None)])
+
+
+	def toDict(self):
+		return { 'name': self.name, 'size': self.size, 'features': self.features, 'snapSeq': self.snapSeq,
+			'snaps': self.snaps, 'head': self.head }
+
+
+	@staticmethod
+	def fromDict(data):
+		image = FakeImage(data['name'], data['size'], data['features'])
+		image.snapSeq = data['snapSeq']
+		image.head = [tuple(extent) for extent in data['head']]
+		image.snaps = data['snaps']
+		for snap in image.snaps:
+			snap['delta'] = [tuple(extent) for extent in snap['delta']]
+		return image
+
+
+class FakeCluster(object):
+	"""Pools of FakeImage of one cluster, named after its configuration file."""
+	capacity = 100 * 1024**4
+
+	def __init__(self, name, directory=None):
+		self.name = name
+		self.directory = directory
+		self.pools = dict()
+		self.lock = threading.RLock()
+
+
+	def createPool(self, pool):
+		with self.lock:
+			self.pools.setdefault(pool, dict())
+			if self.directory != None and not os.path.isdir(self._poolPath(pool)):
+				os.makedirs(self._poolPath(pool))
+
+
+	def hasPool(self, pool):
+		if self.directory != None and os.path.isdir(self._poolPath(pool)):
+			self.pools.setdefault(pool, dict())
+		return pool in self.pools
+
+
+	def listImages(self, pool):
+		with self.lock:
+			if self.directory != None:
+				for filename in os.listdir(self._poolPath(pool)):
+					if filename.endswith('.json'):
+						self.getImage(pool, filename[:-5].replace('%2F', '/'))
+			return sorted(self.pools[pool].keys())
+
+
+	def getImage(self, pool, name):
+		"""FakeImage or None, reloaded when another process saved it."""
+		with self.lock:
+			image = self.pools[pool].get(name)
+			if self.directory == None:
+				return image
+			path = self._imagePath(pool, name)
+			try:
+				mtime = os.stat(path).st_mtime
+			except OSError:
+				self.pools[pool].pop(name, None)
+				return None
+			if image == None or image.mtime != mtime:
+				with open(path) as f:
+					image = FakeImage.fromDict(json.load(f))
+				image.mtime = mtime
+				self.pools[pool][name] = image
+			return image
+
+
+	def createImage(self, pool, name, size, features=0):
+		with self.lock:
+			if self.getImage(pool, name) != None:
+				return None
+			image = FakeImage(name, size, features)
+			self.pools[pool][name] = image
+			self.save(pool, image)
+			return image
+
+
+	def removeImage(self, pool, name):
+		with self.lock:
+			del self.pools[pool][name]
+			if self.directory != None:
+				os.remove(self._imagePath(pool, name))
+
+
+	def save(self, pool, image):
+		"""Write image to the cluster directory, if any."""
+		if self.directory == None:
+			return
+		path = self._imagePath(pool, image.name)
+		with image.lock:
+			with open(path + '.tmp', 'w') as f:
+				json.dump(image.toDict(), f)
+			os.rename(path + '.tmp', path)
+			image.mtime = os.stat(path).st_mtime
+
+
+	def getStats(self):
+		used = 0
+		objects = 0
+		with self.lock:
+			for images in self.pools.values():
+				for image in images.values():
+					used += image.usedBytes()
+					objects += (image.size + OBJECT_SIZE - 1) // OBJECT_SIZE
+		return { 'kb': FakeCluster.capacity // 1024, 'kb_used': used // 1024,
+			'kb_avail': (FakeCluster.capacity - used) // 1024, 'num_objects': objects }
+
+
+	def _poolPath(self, pool):
+		return os.path.join(self.directory, self.name, pool)
+
+
+	def _imagePath(self, pool, name):
+		return os.path.join(self._poolPath(pool), name.replace('/', '%2F') + '.json')
+
+
+_clusters = dict()
+_lock = threading.Lock()
+
+
+def getCluster(conffile):
+	"""The FakeCluster of a configuration file, persisted in FAKE_CEPH_DIR when set."""
+	name = os.path.basename(conffile or 'ceph.conf')
+	with _lock:
+		if name not in _clusters:
+			_clusters[name] = FakeCluster(name, os.environ.get('FAKE_CEPH_DIR'))
+		return _clusters[name]
+
+
+def reset():
+	with _lock:
+		_clusters.clear()
+
+
+def writeDiff(out, image, fromSnap, toSnap):
+	"""Write an 'rbd diff v1' stream of image from fromSnap to toSnap, return the data bytes."""
+	return _writeRecords(out, fromSnap, toSnap, image.getSnap(toSnap)['size'], image.changedExtents(fromSnap, toSnap))
+
+
+def _writeRecords(out, fromSnap, toSnap, size, extents):
+	out.write(DIFF_HEADER)
+	if fromSnap != None:
+		out.write('f' + struct.pack('<I', len(fromSnap)) + fromSnap)
+	out.write('t' + struct.pack('<I', len(toSnap)) + toSnap)
+	out.write('s' + struct.pack('<Q', size))
+	written = 0
+	for (offset, length, exists) in extents:
+		if not exists:
+			out.write('z' + struct.pack('<QQ', offset, length))
+			continue
+		end = offset + length
+		while offset < end:
+			chunk = min(OBJECT_SIZE, end - offset)
+			out.write('w' + struct.pack('<QQ', offset, chunk))
+			out.write(patternData(offset, chunk))
+			written += chunk
+			offset += chunk
+	out.write('e')
+	return written
+
+
+def _readExactly(stream, size):
+	data = stream.read(size)
+	if len(data) != size:
+		raise IOError("truncated diff stream")
+	return data
+
+
+def readDiff(stream, image):
+	"""
+	Apply an 'rbd diff v1' stream to image: extents are recorded, data is
+	read and dropped, and the end snapshot is created.
+	Returns (returncode, message) like the rbd command.
+	"""
+	if _readExactly(stream, len(DIFF_HEADER)) != DIFF_HEADER:
+		return 22, "rbd: invalid diff header"
+	toSnap = None
+	while True:
+		tag = _readExactly(stream, 1)
+		if tag in ('f', 't'):
+			(size,) = struct.unpack('<I', _readExactly(stream, 4))
+			name = _readExactly(stream, size)
+			if tag == 'f' and image.getSnap(name) == None:
+				return 2, "rbd: start snapshot '%s' does not exist in the image, aborting" % name
+			if tag == 't':
+				if image.getSnap(name) != None:
+					return 17, "rbd: snapshot '%s' already exists, aborting" % name
+				toSnap = name
+		elif tag == 's':
+			(image.size,) = struct.unpack('<Q', _readExactly(stream, 8))
+		elif tag in ('w', 'z'):
+			(offset, length) = struct.unpack('<QQ', _readExactly(stream, 16))
+			if tag == 'w':
+				remaining = length
+				while remaining > 0:
+					remaining -= len(_readExactly(stream, min(remaining, OBJECT_SIZE)))
+			image.write(offset, length, tag == 'w')
+		elif tag == 'e':
+			break
+		else:
+			return 22, "rbd: unknown diff record '%s'" % tag
+	if toSnap != None:
+		image.createSnap(toSnap)
+	return 0, ''
+
+
+def parseDiff(stream):
+	"""(fromSnap, toSnap, size, extents) of an 'rbd diff v1' stream, data dropped."""
+	if _readExactly(stream, len(DIFF_HEADER)) != DIFF_HEADER:
+		raise IOError("invalid diff header")
+	(fromSnap, toSnap, size) = (None, None, None)
+	extents = []
+	while True:
+		tag = _readExactly(stream, 1)
+		if tag in ('f', 't'):
+			(length,) = struct.unpack('<I', _readExactly(stream, 4))
+			name = _readExactly(stream, length)
+			if tag == 'f':
+				fromSnap = name
+			else:
+				toSnap = name
+		elif tag == 's':
+			(size,) = struct.unpack('<Q', _readExactly(stream, 8))
+		elif tag in ('w', 'z'):
+			(offset, length) = struct.unpack('<QQ', _readExactly(stream, 16))
+			if tag == 'w':
+				remaining = length
+				while remaining > 0:
+					remaining -= len(_readExactly(stream, min(remaining, OBJECT_SIZE)))
+			extents.append((offset, length, tag == 'w'))
+		elif tag == 'e':
+			return (fromSnap, toSnap, size, extents)
+		else:
+			raise IOError("unknown diff record '%s'" % tag)
+
+
+def _subtractExtents(extents, holes):
+	"""Parts of extents not covered by holes (sorted, non overlapping)."""
+	result = []
+	for (offset, length, exists) in extents:
+		start = offset
+		end = offset + length
+		for (holeOffset, holeLength, holeExists) in holes:
+			holeEnd = holeOffset + holeLength
+			if holeEnd <= start or holeOffset >= end:
+				continue
+			if holeOffset > start:
+				result.append((start, holeOffset - start, exists))
+			start = max(start, holeEnd)
+		if end > start:
+			result.append((start, end - start, exists))
+	return result
+
+
+def mergeDiff(first, second, out):
+	"""
+	'rbd merge-diff': write the diff from the start of first to the end of
+	second, the extents of second overriding those of first.
+	Returns (returncode, message) like the rbd command.
+	"""
+	(fromSnap, middle, size, older) = parseDiff(first)
+	(secondFrom, toSnap, size, newer) = parseDiff(second)
+	if secondFrom != middle:
+		return 22, "rbd: the end snapshot of the first diff does not match the start of the second"
+	_writeRecords(out, fromSnap, toSnap, size, sorted(_subtractExtents(older, sorted(newer)) + newer))
+	return 0, ''
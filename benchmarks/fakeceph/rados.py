@@ -0,0 +1,94 @@
+#!/usr/local/bin/python
+#
+# Stand-in for the python-rados binding, backed by fakecluster: only the
+# calls made by cephbackup are provided.
+#
+
+import fakecluster
+
+
+class Error(Exception):
+	pass
+
+
+class ObjectNotFound(Error):
+	pass
+
+
+class ObjectExists(Error):
+	pass
+
+
+class Rados(object):
+
+	def __init__(self, rados_id=None, name=None, clustername=None, conf_defaults=None, conffile=None, conf=None, flags=0):
+		self.conffile = conffile
+		self.rados_id = rados_id
+		self.conf = conf
+		self.state = 'configuring'
+		self.cluster = None
+
+
+	def connect(self, timeout=0):
+		self.cluster = fakecluster.getCluster(self.conffile)
+		self.state = 'connected'
+
+
+	def shutdown(self):
+		self.state = 'shutdown'
+
+
+	def _requireConnected(self):
+		if self.state != 'connected':
+			raise Error("Rados client is not connected (%s)" % self.state)
+
+
+	def create_pool(self, pool_name):
+		self._requireConnected()
+		if self.cluster.hasPool(pool_name):
+			raise ObjectExists("pool %s exists" % pool_name)
+		self.cluster.createPool(pool_name)
+
+
+	def pool_exists(self, pool_name):
+		self._requireConnected()
+		return self.cluster.hasPool(pool_name)
+
+
+	def list_pools(self):
+		self._requireConnected()
+		return sorted(self.cluster.pools.keys())
+
+
+	def open_ioctx(self, ioctx_name):
+		self._requireConnected()
+		if not self.cluster.hasPool(ioctx_name):
+			raise ObjectNotFound("error opening pool '%s'" % ioctx_name)
+		return Ioctx(self, ioctx_name)
+
+
+	def get_cluster_stats(self):
+		self._requireConnected()
+		return self.cluster.getStats()
+
+
+class Ioctx(object):
+
+	def __init__(self, client, name):
+		self.client = client
+		self.cluster = client.cluster
+		self.name = name
+		self.state = 'open'
+
+
+	def close(self):
+		self.state = 'closed'
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+		return False
@@ -0,0 +1,203 @@
+#!/usr/local/bin/python
+#
+# Stand-in for the python-rbd binding, backed by fakecluster: only the
+# calls made by cephbackup are provided. There is no aio_write, so
+# RbdDiffEngine uses synchronous writes.
+#
+
+import fakecluster
+from fakecluster import RBD_FEATURE_FAST_DIFF
+
+RBD_FEATURE_LAYERING = 1
+RBD_FEATURE_EXCLUSIVE_LOCK = 4
+RBD_FEATURE_OBJECT_MAP = 8
+
+
+class Error(Exception):
+	pass
+
+
+class ImageNotFound(Error):
+	pass
+
+
+class ImageExists(Error):
+	pass
+
+
+class ImageBusy(Error):
+	pass
+
+
+class InvalidArgument(Error):
+	pass
+
+
+class ReadOnlyImage(Error):
+	pass
+
+
+class RBD(object):
+
+	def list(self, ioctx):
+		return ioctx.cluster.listImages(ioctx.name)
+
+
+	def create(self, ioctx, name, size, order=None, old_format=False, features=None, *args, **kwargs):
+		if features == None:
+			features = RBD_FEATURE_LAYERING | RBD_FEATURE_EXCLUSIVE_LOCK | RBD_FEATURE_OBJECT_MAP | RBD_FEATURE_FAST_DIFF
+		if ioctx.cluster.createImage(ioctx.name, name, size, features) == None:
+			raise ImageExists("error creating image %s" % name)
+
+
+	def remove(self, ioctx, name):
+		image = ioctx.cluster.getImage(ioctx.name, name)
+		if image == None:
+			raise ImageNotFound("error removing image %s" % name)
+		if image.snaps:
+			raise ImageBusy("image %s has snapshots" % name)
+		ioctx.cluster.removeImage(ioctx.name, name)
+
+
+class Image(object):
+
+	def __init__(self, ioctx, name, snapshot=None, read_only=False):
+		self.ioctx = ioctx
+		self.name = name
+		self.snapshot = snapshot
+		self.read_only = read_only
+		self.closed = False
+		if ioctx.cluster.getImage(ioctx.name, name) == None:
+			raise ImageNotFound("error opening image %s at snapshot %s" % (name, snapshot))
+		if snapshot != None and self._image.getSnap(snapshot) == None:
+			raise ImageNotFound("error opening image %s at snapshot %s" % (name, snapshot))
+
+
+	def _getImage(self):
+		# the fake rbd command (import-diff) may have saved the image meanwhile
+		image = self.ioctx.cluster.getImage(self.ioctx.name, self.name)
+		if image == None:
+			raise ImageNotFound("image %s was removed" % self.name)
+		return image
+
+	_image = property(_getImage)
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+		return False
+
+
+	def close(self):
+		self.closed = True
+
+
+	def _save(self):
+		self.ioctx.cluster.save(self.ioctx.name, self._image)
+
+
+	def _requireWritable(self):
+		if self.read_only or self.snapshot != None:
+			raise ReadOnlyImage("image %s is read only" % self.name)
+
+
+	def size(self):
+		if self.snapshot != None:
+			return self._image.getSnap(self.snapshot)['size']
+		return self._image.size
+
+
+	def stat(self):
+		size = self.size()
+		return { 'size': size, 'obj_size': fakecluster.OBJECT_SIZE, 'num_objs': (size + fakecluster.OBJECT_SIZE - 1) // fakecluster.OBJECT_SIZE,
+			'order': 22, 'block_name_prefix': 'rbd_data.%x' % (hash(self.name) & 0xffffffff), 'parent_pool': -1, 'parent_name': '' }
+
+
+	def features(self):
+		return self._image.features
+
+
+	def resize(self, size):
+		self._requireWritable()
+		self._image.size = size
+		self._save()
+
+
+	def list_snaps(self):
+		return iter([{ 'id': snap['id'], 'size': snap['size'], 'name': snap['name'] } for snap in list(self._image.snaps)])
+
+
+	def create_snap(self, name):
+		self._requireWritable()
+		if not self._image.createSnap(name):
+			raise ImageExists("error creating snapshot %s@%s" % (self.name, name))
+		self._save()
+
+
+	def remove_snap(self, name):
+		snap = self._image.getSnap(name)
+		if snap == None:
+			raise ImageNotFound("error removing snapshot %s@%s" % (self.name, name))
+		if snap['protected']:
+			raise ImageBusy("snapshot %s@%s is protected" % (self.name, name))
+		self._image.removeSnap(name)
+		self._save()
+
+
+	def is_protected_snap(self, name):
+		snap = self._image.getSnap(name)
+		if snap == None:
+			raise ImageNotFound("snapshot %s@%s not found" % (self.name, name))
+		return snap['protected']
+
+
+	def protect_snap(self, name):
+		self._image.getSnap(name)['protected'] = True
+		self._save()
+
+
+	def unprotect_snap(self, name):
+		self._image.getSnap(name)['protected'] = False
+		self._save()
+
+
+	def diff_iterate(self, offset, length, from_snapshot, iterate_cb, include_parent=True, whole_object=False):
+		if from_snapshot != None and self._image.getSnap(from_snapshot) == None:
+			raise ImageNotFound("snapshot %s@%s not found" % (self.name, from_snapshot))
+		extents = self._image.changedExtents(from_snapshot, self.snapshot, offset, length)
+		if whole_object:
+			size = fakecluster.OBJECT_SIZE
+			objects = []
+			for (start, extentLength, exists) in extents:
+				first = start - start % size
+				objects.append((first, ((start + extentLength - 1) // size + 1) * size - first, exists))
+			extents = fakecluster.mergeExtents(objects, offset, length)
+		for (start, length, exists) in extents:
+			iterate_cb(start, length, exists)
+		return 0
+
+
+	def read(self, offset, length, fadvise_flags=0):
+		if offset >= self.size():
+			return ''
+		return fakecluster.patternData(offset, min(length, self.size() - offset))
+
+
+	def write(self, data, offset, fadvise_flags=0):
+		self._requireWritable()
+		self._image.write(offset, len(data))
+		return len(data)
+
+
+	def discard(self, offset, length):
+		self._requireWritable()
+		self._image.write(offset, length, False)
+		return 0
+
+
+	def flush(self):
+		self._save()
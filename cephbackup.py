@@ -12,9 +12,66 @@
 #source_ceph_user = admin
 #backup_ceph_keyring = /etc/ceph/<stdkeyring name>
 #source_ceph_keyring = /etc/ceph/<stdkeyring name>
+## backup_target: ceph (backup_ceph_* pool) or directory (diff stream files in backup_directory)
+#backup_target = ceph
+#backup_directory = /mnt/backup
+#archive_buffer_size = 8M
+#archive_fsync_bytes = 256M
+## after the cleanup, remove non mandatory snapshots while the backup pool is above max_capacity
+## best_effort_policy: morerem (largest first) or oldest; disabled eviction only reports
+#max_capacity = 0.8
+#best_effort_policy = morerem
+#capacity_eviction = false
+## exclusive bytes of backup snapshots (diff between adjacent snapshots) cached in this file, empty for provisioned sizes
+#snapshot_usage_cache = /var/lib/cephbackup/snapshot-usage.json
 #xenserver_master = 
 #xenserver_user = 
 #xenserver_password = 
+## parallel backups: 0 means unlimited for the max_* caps
+#workers = 1
+#max_source_reads = 0
+#max_backup_writes = 0
+#max_xapi_pauses = 1
+## opt-in: pause each VM once while the snapshots of all its disks are created,
+## then transfer them; by default each image is snapshotted and transferred on its own
+#pause_groups = false
+#snapshot_removal_concurrency = 4
+## seconds cluster stats (used/available) are cached
+#cluster_stats_ttl = 30
+## transfer_engine: cli (rbd export-diff | rbd import-diff) or librbd (in-process)
+#transfer_engine = cli
+#transfer_read_size = 4194304
+#transfer_queue_depth = 8
+## relay the cli pipe to log throughput (uses splice when available)
+#transfer_relay = false
+#relay_report_interval = 30
+#relay_stall_timeout = 300
+#relay_pipe_size = 1048576
+## compress the cli pipe: none, zstd, lz4 or gzip; level empty for algorithm default, threads 0 for all cpus
+## not applied by the librbd engine, nor to full sends with resumable_full_exports or sparse_full_sends
+## only saves bandwidth with backup_import_prefix: without it the stream is decompressed on this host
+#transfer_compression = none
+#transfer_compression_level =
+#transfer_compression_threads = 0
+## run decompression and rbd import-diff through this command (a remote shell), ie: ssh backup-gateway
+#backup_import_prefix =
+## transfer throttling, rates in bytes/s with K/M/G suffixes, 0 for unlimited
+## iops_limit only applies to the librbd engine
+#bandwidth_limit = 0
+#iops_limit = 0
+#image_bandwidth_limit = 0
+#image_bandwidth_limits = <image>:<rate> ...
+## time of day global bandwidth, first match wins, ie: 08:00-20:00=50M 20:00-08:00=0
+#bandwidth_profiles =
+## full sends in chunks with an on-disk checkpoint, resumed by the next run (librbd)
+#resumable_full_exports = false
+#checkpoint_dir = /var/lib/cephbackup/checkpoints
+#checkpoint_chunk_size = 1G
+## full sends only write allocated, non-zero blocks (librbd)
+#sparse_full_sends = false
+## Prometheus node_exporter textfile written at the end of each run, empty to disable
+## cli transfers are then relayed (as with transfer_relay) to count their bytes
+#metrics_textfile =
 #
 #[VMLIST]
 #<space separated xen machines>
@@ -29,6 +86,8 @@
 #
 #[POLICY]
 ## h: 1 every hour, d: 1 every day, w: 1 every week, m: 1 every month, y: 1 every year
+## counts are capped by time windows: hours of the same day, days of the last 31 days,
+## weeks of the last 52 weeks, months of the last 12 months (years are unbounded)
 #time_to_live = 30d,4w,12m,1y
 #
 
@@ -36,6 +95,12 @@ import subprocess, time, re, ConfigParser, logging, sys, os, getopt, fcntl
 from CephPool import *
 from CephSnapshotsCleanup import *
 from backup_vm import *
+from BackupScheduler import *
+from ArchivePool import *
+from XapiIndex import *
+from PhaseProfiler import *
+from BackupMetrics import *
+from CapacityEvictor import *
 
 ## Xenserver compat for atomic snapshots
 import XenAPI
@@ -66,6 +131,10 @@ class StreamToLogger(object):
          self.logger.log(self.log_level, line.rstrip())
 
 
+def is_backup_image(name):
+   return name in livebackups or name.replace('vm-','') in livebackups
+
+
 def get_local_backup_vms():
    result = []
 
@@ -74,7 +143,7 @@ def get_local_backup_vms():
       #data = re.split('[\s]+', dataset.name)
       #uuid = data[1]
       #name = data[0]
-      if ( dataset.name in livebackups or dataset.name.replace('vm-','') in livebackups ) :
+      if is_backup_image(dataset.name) :
           result += [dataset.name]
 
    return result
@@ -82,9 +151,9 @@ def get_local_backup_vms():
 
 		
 try:
-  opts, args = getopt.getopt( sys.argv[1:] ,"shdcv",["silent", "dry-run", "config-file=", "pid-file=", "log-file=", "clean-only", "verbose"])
+  opts, args = getopt.getopt( sys.argv[1:] ,"shdcv",["silent", "dry-run", "config-file=", "pid-file=", "log-file=", "clean-only", "verbose", "profile", "profile-dir="])
 except getopt.GetoptError:
-  print 'usage: -s or --silent / -d or --dry-run / --config-file <path> / --pid-file <path> / --log-file <path> / -v or --verbose'
+  print 'usage: -s or --silent / -d or --dry-run / --config-file <path> / --pid-file <path> / --log-file <path> / -v or --verbose / --profile / --profile-dir <path>'
   sys.exit(2)
 
 for opt, arg in opts:
@@ -105,6 +174,13 @@ for opt, arg in opts:
 		cleanOnly = True
 	elif opt in ("-v", "--verbose"):
 		loggingLevel = logging.DEBUG
+	elif opt == "--profile":
+		# per image and phase timers, summary at the end of the run
+		PhaseProfiler.enabled = True
+	elif opt == "--profile-dir":
+		# cProfile stats of each image phase written in arg
+		PhaseProfiler.enabled = True
+		PhaseProfiler.profileDir = arg
 
 
 if (silent) :
@@ -138,7 +214,7 @@ except IOError:
     sys.exit(0)
 
 
-Config = ConfigParser.SafeConfigParser({'source_ceph_conf': '/etc/ceph/ceph.conf', 'backup_ceph_conf':'/etc/ceph/ceph.backup.conf' , 'source_ceph_user': 'admin', 'backup_ceph_user': 'backup', 'source_ceph_pool': 'rbd', 'backup_ceph_pool': 'rbdbackup', 'source_ceph_keyring': None, 'backup_ceph_keyring': None, 'xenserver_master':None, 'xenserver_user':None, 'xenserver_password':None, 'time_to_live': '30d,4w,12m,1y' })
+Config = ConfigParser.SafeConfigParser({'source_ceph_conf': '/etc/ceph/ceph.conf', 'backup_ceph_conf':'/etc/ceph/ceph.backup.conf' , 'source_ceph_user': 'admin', 'backup_ceph_user': 'backup', 'source_ceph_pool': 'rbd', 'backup_ceph_pool': 'rbdbackup', 'source_ceph_keyring': None, 'backup_ceph_keyring': None, 'xenserver_master':None, 'xenserver_user':None, 'xenserver_password':None, 'workers': '1', 'max_source_reads': '0', 'max_backup_writes': '0', 'max_xapi_pauses': '1', 'pause_groups': 'false', 'snapshot_removal_concurrency': '4', 'cluster_stats_ttl': '30', 'transfer_engine': 'cli', 'transfer_read_size': '4194304', 'transfer_queue_depth': '8', 'transfer_relay': 'false', 'relay_report_interval': '30', 'relay_stall_timeout': '300', 'relay_pipe_size': '1048576', 'transfer_compression': 'none', 'transfer_compression_level': '', 'transfer_compression_threads': '0', 'backup_import_prefix': '', 'bandwidth_limit': '0', 'iops_limit': '0', 'image_bandwidth_limit': '0', 'image_bandwidth_limits': '', 'bandwidth_profiles': '', 'resumable_full_exports': 'false', 'checkpoint_dir': '/var/lib/cephbackup/checkpoints', 'checkpoint_chunk_size': '1G', 'sparse_full_sends': 'false', 'metrics_textfile': '', 'backup_target': 'ceph', 'backup_directory': '/mnt/backup', 'archive_buffer_size': '8M', 'archive_fsync_bytes': '256M', 'max_capacity': '0.8', 'best_effort_policy': 'morerem', 'capacity_eviction': 'false', 'snapshot_usage_cache': '/var/lib/cephbackup/snapshot-usage.json', 'time_to_live': '30d,4w,12m,1y' })
 configCandidates = [configfile]
 found = Config.read( configCandidates )
 missing = set(configCandidates) - set(found)
@@ -164,6 +240,66 @@ xenserver_master_host = Config.get("MAIN", "xenserver_master")
 xenserver_user = Config.get("MAIN", "xenserver_user")
 xenserver_pwd = Config.get("MAIN", "xenserver_password")
 
+workers = Config.getint("MAIN", "workers")
+pause_groups = Config.getboolean("MAIN", "pause_groups")
+limits = ConcurrencyLimits(
+	sourceReads=Config.getint("MAIN", "max_source_reads"),
+	backupWrites=Config.getint("MAIN", "max_backup_writes"),
+	xapiPauses=Config.getint("MAIN", "max_xapi_pauses"))
+
+SnapshotRemover.concurrency = Config.getint("MAIN", "snapshot_removal_concurrency")
+CephPool._clusterStats.ttl = Config.getint("MAIN", "cluster_stats_ttl")
+
+Dataset.transferEngine = Config.get("MAIN", "transfer_engine")
+RbdDiffEngine.readSize = Config.getint("MAIN", "transfer_read_size")
+RbdDiffEngine.queueDepth = Config.getint("MAIN", "transfer_queue_depth")
+Dataset.transferRelay = Config.getboolean("MAIN", "transfer_relay")
+PipeRelay.reportInterval = Config.getint("MAIN", "relay_report_interval")
+PipeRelay.stallTimeout = Config.getint("MAIN", "relay_stall_timeout")
+PipeRelay.pipeSize = Config.getint("MAIN", "relay_pipe_size")
+if Config.get("MAIN", "transfer_compression") != 'none':
+	Dataset.compression = Config.get("MAIN", "transfer_compression")
+	if Config.get("MAIN", "transfer_compression_level") != '':
+		Dataset.compressionLevel = Config.getint("MAIN", "transfer_compression_level")
+	Dataset.compressionThreads = Config.getint("MAIN", "transfer_compression_threads")
+Dataset.importPrefix = Config.get("MAIN", "backup_import_prefix").split()
+
+imageBandwidths = dict()
+for limit in re.split('[\s]+', Config.get("MAIN", "image_bandwidth_limits")):
+	if limit != '':
+		(image, rate) = limit.rsplit(':', 1)
+		imageBandwidths[image] = parseRate(rate)
+Dataset.throttle = Throttle(
+	bandwidth=parseRate(Config.get("MAIN", "bandwidth_limit")),
+	iops=parseRate(Config.get("MAIN", "iops_limit")),
+	imageBandwidth=parseRate(Config.get("MAIN", "image_bandwidth_limit")),
+	imageBandwidths=imageBandwidths,
+	profiles=parseProfiles(Config.get("MAIN", "bandwidth_profiles")))
+
+Dataset.resumableFull = Config.getboolean("MAIN", "resumable_full_exports")
+Dataset.checkpointDir = Config.get("MAIN", "checkpoint_dir")
+Dataset.checkpointChunkSize = parseSize(Config.get("MAIN", "checkpoint_chunk_size"))
+Dataset.sparseFull = Config.getboolean("MAIN", "sparse_full_sends")
+if Dataset.compression != None:
+	# the librbd engine has no pipe to compress
+	if Dataset.transferEngine == 'librbd':
+		logging.warning("transfer_compression is ignored with transfer_engine = librbd")
+	elif Dataset.resumableFull or Dataset.sparseFull:
+		logging.warning("transfer_compression is ignored for full sends with resumable_full_exports or sparse_full_sends")
+	if len(Dataset.importPrefix) == 0:
+		logging.warning("transfer_compression without backup_import_prefix decompresses on this host: it costs cpu and saves no bandwidth")
+if Config.get("MAIN", "metrics_textfile") != '':
+	BackupMetrics.textfile = Config.get("MAIN", "metrics_textfile")
+
+backup_target = Config.get("MAIN", "backup_target")
+backup_directory = Config.get("MAIN", "backup_directory")
+ArchivePool.bufferSize = parseSize(Config.get("MAIN", "archive_buffer_size"))
+ArchivePool.fsyncBytes = parseSize(Config.get("MAIN", "archive_fsync_bytes"))
+max_capacity = Config.getfloat("MAIN", "max_capacity")
+best_effort_policy = Config.get("MAIN", "best_effort_policy")
+capacity_eviction = Config.getboolean("MAIN", "capacity_eviction")
+snapshot_usage_cache = Config.get("MAIN", "snapshot_usage_cache")
+
 policy = Config.get("POLICY", "time_to_live")
 
 xapi_session = None
@@ -176,18 +312,93 @@ if xenserver_master_host is not None:
 		logging.error( "Failed to acquire a session: %s" % f.details)
 		sys.exit(1)
 
+def clean_image(name):
+	"""Retention cleanup of the backup image, returns the removal failures."""
+	cleaner = CephSnapshotsCleanup(backup_vm.backupPool, name, policy, dryrun)
+	if cleaner.dataset == None:
+		return []
+	before = len(cleaner.dataset.snapshots)
+	with limits.backupWrites:
+		with profiler.phase(name, 'cleanup'):
+			results = cleaner.cleanAll()
+	metrics.recordCleanup(name, before, len(cleaner.dataset.snapshots))
+	return [error for (snapshot, error) in results if error != None]
+
+def backup_image(name):
+	success = False
+	try:
+		success = backup_vm( name, xapi_session=xapi_session, limits=limits )
+		success = len(clean_image(name)) == 0 and success
+	finally:
+		metrics.recordResult(name, success)
+	return success
+
+def backup_group(names, vms):
+	results = backup_vm_group( names, vms, xapi_session=xapi_session, limits=limits )
+	success = True
+	for name in names:
+		imageSuccess = False
+		try:
+			imageSuccess = len(clean_image(name)) == 0 and results.get(name)
+		finally:
+			metrics.recordResult(name, imageSuccess)
+		if not imageSuccess:
+			logging.error("Backup of %s failed" % name)
+			success = False
+	return success
+
+def evict_backups():
+	"""Best effort eviction on the backup pool, returns the removal failures."""
+	pool = backup_vm.backupPool
+	evictor = CapacityEvictor(pool, policy, dryrun or not capacity_eviction)
+	with profiler.phase(pool.name, 'evict'):
+		report = evictor.evict()
+	if report.evicted and not capacity_eviction:
+		logging.warning("capacity_eviction is disabled: no snapshot was evicted from %s" % pool.name)
+	return report.failures
+
+scheduler = BackupScheduler(workers, limits)
+evictionFailures = []
+
 try:
-	backup_vm.backupPool = CephPool(backup_ceph_pool, backup_ceph_conf, backup_ceph_user, backup_ceph_keyring, dryrun)
-	backup_vm.sourcePool = CephPool(source_ceph_pool, source_ceph_conf, source_ceph_user, source_ceph_keyring, dryrun)
+	if xapi_session is not None:
+		# VM/VBD/VDI records for the whole run: a few calls instead of several per image
+		# (in the try block: the session is logged out if this fails)
+		backup_vm.xapiIndex = XapiIndex(xapi_session)
+	with profiler.phase(backup_ceph_pool if backup_target != 'directory' else backup_directory, 'load'):
+		if backup_target == 'directory':
+			backup_vm.backupPool = ArchivePool(backup_directory, dryrun, is_backup_image)
+		else:
+			backup_vm.backupPool = CephPool(backup_ceph_pool, backup_ceph_conf, backup_ceph_user, backup_ceph_keyring, dryrun, is_backup_image)
+	with profiler.phase(source_ceph_pool, 'load'):
+		backup_vm.sourcePool = CephPool(source_ceph_pool, source_ceph_conf, source_ceph_user, source_ceph_keyring, dryrun, is_backup_image)
+	backup_vm.backupPool.maxCapacity = max_capacity
+	backup_vm.backupPool.bestEffortPolicy = best_effort_policy
+	if snapshot_usage_cache != '' and not backup_vm.backupPool.isArchive:
+		# archives already know the size of each diff
+		backup_vm.backupPool.usageCache = SnapshotUsageCache(snapshot_usage_cache)
 
 	CephSnapshotsCleanup.logLevel = loggingLevel
-	for (name) in get_local_backup_vms():
-		timestamp = time.strftime("%Y%m%d-%H:%M", time.gmtime())
-		#print timestamp, uuid, name
-		if cleanOnly == False:
-			backup_vm( name, xapi_session=xapi_session )
-		cleaner = CephSnapshotsCleanup(backup_vm.backupPool, name, policy, dryrun)
-		cleaner.cleanAll()
+	if cleanOnly:
+		# no transfer: plan all images and trim their snapshots in one batch
+		with profiler.phase(backup_vm.backupPool.name, 'cleanup'):
+			remover = CephSnapshotsCleanup.cleanPool(backup_vm.backupPool, get_local_backup_vms(), policy, dryrun)
+		evictionFailures = evict_backups()
+		if len(remover.failures) > 0 or len(evictionFailures) > 0:
+			sys.exit(1)
+	else:
+		if pause_groups and xapi_session is not None:
+			for (group, vms, names) in groupByVM(xapi_session, get_local_backup_vms()):
+				if len(vms) == 0:
+					scheduler.submit(group, backup_image, group)
+				else:
+					scheduler.submit(group, backup_group, names, vms)
+		else:
+			for (name) in get_local_backup_vms():
+				scheduler.submit(name, backup_image, name)
+		scheduler.run()
+		scheduler.logSummary()
+		evictionFailures = evict_backups()
 
 	if Config.has_section("RADOSGW"):
 	    rgw_geo = Config.get("RADOSGW", "geographies")
@@ -204,4 +415,21 @@ except CephError, e:
 finally:
 	if xapi_session is not None:
 		xapi_session.xenapi.session.logout()
-
+	if hasattr(backup_vm, 'sourcePool'):
+		metrics.recordPool('source', backup_vm.sourcePool)
+	if hasattr(backup_vm, 'backupPool'):
+		metrics.recordPool('backup', backup_vm.backupPool)
+	if hasattr(backup_vm, 'backupPool') and getattr(backup_vm.backupPool, 'usageCache', None) != None:
+		backup_vm.backupPool.usageCache.save()
+	# rbd images are closed before the cluster connections
+	if hasattr(backup_vm, 'sourcePool'):
+		backup_vm.sourcePool.close()
+	if hasattr(backup_vm, 'backupPool'):
+		backup_vm.backupPool.close()
+	CephPool._registry.shutdown()
+	metrics.write()
+	profiler.logSummary()
+	profiler.dump()
+
+if len(scheduler.failures) > 0 or len(evictionFailures) > 0:
+	sys.exit(1)
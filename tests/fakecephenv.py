@@ -0,0 +1,38 @@
+#!/usr/local/bin/python
+#
+# Test environment on the benchmarks' stand-in cluster: fake rados and rbd
+# modules, and the fake rbd command on PATH.
+#
+
+import os, sys, shutil, tempfile, unittest
+here = os.path.dirname(os.path.abspath(__file__))
+fakeceph = os.path.join(here, '..', 'benchmarks', 'fakeceph')
+# stand-in rados and rbd modules: tests never need a cluster
+sys.path.insert(0, fakeceph)
+sys.path.insert(0, os.path.join(here, '..'))
+import fakecluster
+
+
+class FakeCephTestCase(unittest.TestCase):
+	"""Clusters persisted in a temporary FAKE_CEPH_DIR, shared with the fake rbd command."""
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp(prefix='fakeceph')
+		self.environ = dict(os.environ)
+		os.environ['FAKE_CEPH_DIR'] = self.directory
+		# the fake rbd command, run with this interpreter
+		os.makedirs(os.path.join(self.directory, 'bin'))
+		wrapper = os.path.join(self.directory, 'bin', 'rbd')
+		with open(wrapper, 'w') as f:
+			f.write('#!/bin/sh\nexec %s %s "$@"\n' % (sys.executable, os.path.join(fakeceph, 'rbd')))
+		os.chmod(wrapper, 0755)
+		os.environ['PATH'] = os.path.join(self.directory, 'bin') + os.pathsep + os.environ['PATH']
+		fakecluster.reset()
+
+	def tearDown(self):
+		from CephPool import CephPool
+		CephPool._registry.shutdown()
+		fakecluster.reset()
+		os.environ.clear()
+		os.environ.update(self.environ)
+		shutil.rmtree(self.directory)
@@ -0,0 +1,83 @@
+#!/usr/local/bin/python
+
+import os, json, unittest
+from fakecephenv import *
+from CephPool import *
+from ArchivePool import *
+
+SNAPSHOTS = ['backup2024-01-0%dT02.00.00' % day for day in (1, 2, 3, 4)]
+
+
+class ArchivePoolTest(FakeCephTestCase):
+
+	def setUp(self):
+		FakeCephTestCase.setUp(self)
+		cluster = fakecluster.getCluster('source.conf')
+		cluster.createPool('rbd')
+		self.image = cluster.createImage('rbd', 'vm-100', 64 * 1024**2)
+		for (index, name) in enumerate(SNAPSHOTS):
+			self.image.write(index * 4 * 1024**2, 8 * 1024**2)
+			self.image.write(32 * 1024**2 + index * 1024**2, 1024**2, index % 2 == 0)
+			self.image.createSnap(name)
+		cluster.save('rbd', self.image)
+		os.makedirs(os.path.join(self.directory, 'archive'))
+		self.source = CephPool('rbd', 'source.conf', 'admin', None, False)
+		self.archive = ArchivePool(os.path.join(self.directory, 'archive'), False)
+		local = self.source.getDataset('vm-100')
+		self.dataset = self.archive.getDatasetOrCreate('vm-100')
+		previous = None
+		for name in SNAPSHOTS:
+			self.assertTrue(local.exportSnapshot(self.dataset, local.getSnapshot(name), previous))
+			previous = local.getSnapshot(name)
+
+	def manifest(self):
+		with open(self.dataset.manifestPath) as f:
+			return dict([(entry['snapshot'], entry) for entry in json.load(f)['snapshots']])
+
+	def parse(self, name):
+		with open(self.dataset.getFile(name), 'rb') as f:
+			return fakecluster.parseDiff(f)
+
+	def assertRestores(self, name):
+		"""Applying the chain of name gives the extents of a full export of name."""
+		restored = fakecluster.FakeImage('restored', 0)
+		for entry in self.dataset.getChain(name):
+			with open(os.path.join(self.dataset.path, entry['file']), 'rb') as f:
+				self.assertEqual(fakecluster.readDiff(f, restored), (0, ''))
+		self.assertEqual(restored.changedExtents(None, name), self.image.changedExtents(None, name))
+
+	def testRemoveMiddle(self):
+		self.dataset.getSnapshot(SNAPSHOTS[1]).remove()
+		manifest = self.manifest()
+		self.assertFalse(SNAPSHOTS[1] in manifest)
+		self.assertFalse(os.path.exists(self.dataset.getFile(SNAPSHOTS[1])))
+		# the child now starts where the removed archive started
+		self.assertEqual(manifest[SNAPSHOTS[2]]['from'], SNAPSHOTS[0])
+		self.assertEqual(manifest[SNAPSHOTS[2]]['base'], SNAPSHOTS[0])
+		self.assertEqual(self.parse(SNAPSHOTS[2])[0:2], (SNAPSHOTS[0], SNAPSHOTS[2]))
+		self.assertEqual(manifest[SNAPSHOTS[2]]['size'], os.path.getsize(self.dataset.getFile(SNAPSHOTS[2])))
+		self.assertRestores(SNAPSHOTS[3])
+
+	def testRemoveBase(self):
+		self.dataset.getSnapshot(SNAPSHOTS[0]).remove()
+		manifest = self.manifest()
+		self.assertFalse(SNAPSHOTS[0] in manifest)
+		# the child became the full stream and the base of its descendants
+		self.assertEqual(manifest[SNAPSHOTS[1]]['from'], None)
+		self.assertEqual(self.parse(SNAPSHOTS[1])[0:2], (None, SNAPSHOTS[1]))
+		for name in SNAPSHOTS[1:]:
+			self.assertEqual(manifest[name]['base'], SNAPSHOTS[1])
+		self.assertRestores(SNAPSHOTS[3])
+
+	def testRotations(self):
+		# retention removing the oldest archive run after run
+		for name in SNAPSHOTS[:3]:
+			self.dataset.getSnapshot(name).remove()
+		manifest = self.manifest()
+		self.assertEqual(manifest.keys(), [SNAPSHOTS[3]])
+		self.assertEqual(manifest[SNAPSHOTS[3]]['from'], None)
+		self.assertRestores(SNAPSHOTS[3])
+
+
+if __name__ == '__main__':
+	unittest.main()
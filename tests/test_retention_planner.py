@@ -0,0 +1,75 @@
+#!/usr/local/bin/python
+
+import unittest
+from datetime import datetime, timedelta
+import fakecephenv
+from RetentionPlanner import *
+
+END = datetime(2024, 3, 15, 2, 0, 0)
+
+
+class FakeSnapshot(object):
+
+	def __init__(self, creation, name=None):
+		self.creation = creation
+		self.name = name or creation.strftime('backup%Y-%m-%dT%H.%M.%S')
+
+
+def every(count, step, end=END):
+	# latest first, like Dataset.snapshots
+	return [FakeSnapshot(end - step * i) for i in range(count)]
+
+
+def days(snapshots):
+	return [snapshot.creation.strftime('%Y-%m-%d') for snapshot in snapshots]
+
+
+class RetentionPlannerTest(unittest.TestCase):
+
+	def testDailyTiers(self):
+		snapshots = every(800, timedelta(days=1))
+		plan = RetentionPlanner('30d,4w,12m,1y').plan(snapshots)
+		self.assertEqual(days(plan.keep['mandatory']), ['2024-03-15', '2024-03-14'])
+		self.assertEqual(plan.keep['h'], [])
+		# 30 dailies, the 31 days window is not reached
+		self.assertEqual(days(plan.keep['d']), days(snapshots[2:32]))
+		self.assertEqual(days(plan.keep['w']), ['2024-02-11', '2024-02-04', '2024-01-28', '2024-01-21'])
+		# 2024-01-31 shares its week with 2024-02-04: kept as a monthly
+		self.assertEqual(days(plan.keep['m']), ['2024-01-31', '2023-12-31', '2023-11-30', '2023-10-31', '2023-09-30', '2023-08-31',
+			'2023-07-31', '2023-06-30', '2023-05-31', '2023-04-30', '2023-03-31', '2023-02-28'])
+		self.assertEqual(days(plan.keep['y']), ['2022-12-31'])
+		self.assertEqual(len(plan.trash), 800 - 2 - 30 - 4 - 12 - 1)
+
+	def testWindowsWithGap(self):
+		# 10 recent dailies, then nothing for 60 days
+		snapshots = every(10, timedelta(days=1)) + every(400, timedelta(days=1), END - timedelta(days=70))
+		plan = RetentionPlanner('30d,4w,12m,1y').plan(snapshots)
+		# older snapshots do not make up for the gap
+		self.assertEqual(len(plan.keep['d']), 8)
+		self.assertEqual(days(plan.keep['w']), ['2024-01-05', '2023-12-31', '2023-12-24', '2023-12-17'])
+		self.assertEqual(len(plan.keep['m']), 12)
+		self.assertEqual(days(plan.keep['m'])[0], '2023-11-30')
+		self.assertEqual(days(plan.keep['m'])[-1], '2022-12-31')
+
+	def testHoursOfTheSameDay(self):
+		snapshots = every(72, timedelta(hours=1), datetime(2024, 3, 15, 10, 0, 0))
+		plan = RetentionPlanner('24h').plan(snapshots)
+		self.assertEqual(len(plan.keep['mandatory']), 2)
+		# 08:00 down to 00:00, not the hours of the day before
+		self.assertEqual([snapshot.creation.hour for snapshot in plan.keep['h']], range(8, -1, -1))
+		self.assertEqual(len(plan.trash), 72 - 2 - 9)
+
+	def testWithoutCreation(self):
+		unknown = [FakeSnapshot(None, 'manual'), FakeSnapshot(None, 'before-upgrade')]
+		snapshots = unknown[:1] + every(40, timedelta(days=1)) + unknown[1:]
+		plan = RetentionPlanner('7d').plan(snapshots)
+		self.assertEqual(plan.keep['unknown'], unknown)
+		self.assertEqual(days(plan.keep['mandatory']), ['2024-03-15', '2024-03-14'])
+		self.assertEqual(len(plan.keep['d']), 7)
+		self.assertEqual(len(plan.trash), 40 - 2 - 7)
+		for snapshot in unknown:
+			self.assertFalse(snapshot in plan.trash)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,26 @@
+#!/usr/local/bin/python
+
+import shlex, pipes, unittest
+import fakecephenv
+from CephPool import shellCommand
+
+
+class ShellCommandTest(unittest.TestCase):
+
+	pipeline = "zstd -dcq | " + ' '.join([pipes.quote(arg) for arg in
+		['rbd', '-c', '/etc/ceph/ceph backup.conf', '--id', 'backup', 'import-diff', '-', 'rbdbackup/vm-100']])
+
+	def testLocal(self):
+		self.assertEqual(shellCommand([], self.pipeline), ['sh', '-c', self.pipeline])
+
+	def testRemoteShellPrefix(self):
+		prefix = ['ssh', 'backup-gateway']
+		command = shellCommand(prefix, self.pipeline)
+		self.assertEqual(command[:len(prefix)], prefix)
+		# ssh joins the remaining arguments, the remote shell splits them again
+		remote = shlex.split(' '.join(command[len(prefix):]))
+		self.assertEqual(remote, ['sh', '-c', self.pipeline])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,43 @@
+#!/usr/local/bin/python
+
+import os, unittest
+from fakecephenv import *
+from CephPool import *
+from BackupMetrics import *
+from backup_vm import *
+import backup_vm as backupModule
+
+
+class TransferMetricsTest(FakeCephTestCase):
+
+	def setUp(self):
+		FakeCephTestCase.setUp(self)
+		source = fakecluster.getCluster('source.conf')
+		source.createPool('rbd')
+		image = source.createImage('rbd', 'vm-100', 64 * 1024**2)
+		image.write(0, 8 * 1024**2)
+		source.save('rbd', image)
+		fakecluster.getCluster('backup.conf').createPool('rbdbackup')
+		BackupMetrics.textfile = os.path.join(self.directory, 'cephbackup.prom')
+		# samples of this test only
+		self.metrics = backupModule.metrics
+		backupModule.metrics = BackupMetrics()
+
+	def tearDown(self):
+		BackupMetrics.textfile = None
+		backupModule.metrics = self.metrics
+		FakeCephTestCase.tearDown(self)
+
+	def testPlainCliExport(self):
+		self.assertEqual(Dataset.transferEngine, 'cli')
+		self.assertFalse(Dataset.transferRelay)
+		backup_vm.sourcePool = CephPool('rbd', 'source.conf', 'admin', None, False)
+		backup_vm.backupPool = CephPool('rbdbackup', 'backup.conf', 'backup', None, False)
+		self.assertTrue(backup_vm('vm-100'))
+		lines = backupModule.metrics.format().splitlines()
+		self.assertTrue([line for line in lines if line.startswith('cephbackup_transfer_bytes{image="vm-100"} ')])
+		self.assertTrue([line for line in lines if line.startswith('cephbackup_transfer_duration_seconds{image="vm-100"} ')])
+
+
+if __name__ == '__main__':
+	unittest.main()